@@ -1,10 +1,28 @@
 import os
 import time
+import threading
 import math
-import pandas as pd
+from functools import partial
+import numpy as np
 import tkinter as tk
 from tkinter import filedialog
-from PIL import Image, ImageTk
+from PIL import ImageTk
+from image_cache import ImageCache, ImagePrefetcher, rescale_image, thumbnail_image, FAST, HIGH
+from thumbnail_cache import ThumbnailCache
+from annotation_journal import AnnotationJournal
+from annotation_model import AnnotationModel, WidgetMirror
+from pending_mask import PendingMask
+from annotation_storage import open_store, import_xlsx, export_xlsx
+from folder_scanner import FolderScanner, wav_path_for_image
+from annotation_schema import COUNT_COLUMNS, COLUMNS, DEFAULTS, KINDS, count_value
+from navigation import NavigationScheduler, ResizeDebouncer
+from grid_view import GridView
+from annotation_queue import AnnotationQueue, SCHEDULERS, QUEUE_TABLE, compute_queue, stored_queue
+from latency_profiler import Profiler, profiled
+from zoom_view import ImageSource, WavSource, TileView
+from spectrogram import SpectrogramSettings, render_spectrogram
+from audio_playback import AudioPlayer, PlaybackSettings, NORMAL, TIME_EXPANSION, HETERODYNE
+from prescreen import Prescreener, ScreenSettings, SCREENING_TABLE, SCREENING_COLUMNS, load_suggestions
 
 class ImageAnnotatorApp:
     def __init__(self, master):
@@ -15,26 +33,101 @@ class ImageAnnotatorApp:
         self.button_width = 10
 
         self.folder_path = ""
+        self.scanner = None
         self.image_names = []
         self.image_index = -1
 
-        self.social_call_counter = 0
-        self.feeding_buzz_counter = 0
         self.none_var = tk.BooleanVar()
         self.bat_var = tk.BooleanVar()
         self.keep_annotater_var = tk.BooleanVar()
 
         self.current_annotater = ""
         self.previous_annotater = ""
-
-        self.annotation_changes = 0
-        self.df = None
+        self.held_rows = set()  # Rows waiting for the annotater warning, not journaled until it is answered
+
+        self.model = None  # AnnotationModel of the folder, the widgets only show its current row
+        self.mirror = WidgetMirror()
+        self.pending = PendingMask([])  # Per position in self.image_names, True while not annotated
+        self.journal = None
+
+        # Changes go to the journal right away and are folded into the store by a timer and on quit.
+        # annotations.xlsx is only imported once and written by the export button
+        self.storage_backend = "sqlite"  # "sqlite", "parquet", "feather" or "shared"
+        self.store = None
+        self.compaction_interval_ms = 30 * 1000
+
+        # "shared": several annotators on one project, each works through leased batches of images
+        self.claimed = []  # (position, image name) of our current batch
+        self.claim_batch_size = 50
+        self.leased_by_others = {}  # Image name -> annotator
+        self.project_poll_ms = 5 * 1000
+        self.last_lease_renewal = 0.0
+
+        # Pre-screening suggests 'None' or 'Bat' per image, confident empties can be left for last
+        self.screen_settings = ScreenSettings()
+        self.screening_store = None
+        self.prescreener = None
+        self.suggestions = {}  # Image name -> (suggestion, confidence, score)
+        self.skip_confidence = 0.9
+        self.skip_empty_var = tk.BooleanVar()
+
+        # Order of navigation and of 'Next to annotate', scored per folder by one of annotation_queue.SCHEDULERS
+        self.queue_store = None
+        self.queue = None  # None keeps the folder order
+        self.queue_scores = None
+        self.scheduler_var = tk.StringVar(value="file order")
+        self.stratify_var = tk.BooleanVar()  # Hours of the night take turns
+
+        # Recordings are played in the window itself, the next ones are converted ahead
+        self.player = AudioPlayer(PlaybackSettings(mode=TIME_EXPANSION, expansion_factor=10, heterodyne_freq=45000))
+        self.playback_mode_var = tk.StringVar(value=self.player.settings.mode)
+        self.prebuffer_ahead = 2
+
+        # Decoded images are prepared on worker threads for the next and previous images
+        self.prefetch_ahead = 4
+        self.prefetch_behind = 2
+        self.prefetcher = ImagePrefetcher(self.load_display_image, ImageCache(max_bytes=256 * 1024 * 1024))
+        self.thumbnails = None  # Resized copies on disk, per folder
+
+        # Spectrograms can be rendered from the .wav recordings instead of read from IMG_*.jpg files
+        self.from_wav_var = tk.BooleanVar()
+        self.render_from_wav = False  # Taken from the checkbox when a folder is selected
+        self.spectrogram_settings = SpectrogramSettings(fft_size=512, overlap=0.75, min_freq=10000, max_freq=None)
+
+        # While stepping faster than this a cheap preview is shown, sharpened once the user stops
+        self.fast_preview_interval = 0.25
+        self.sharpen_delay_ms = 150
+        self.last_show_time = 0.0
+
+        # Per-stage timings of the annotation loop, F12 shows them and Shift-F12 writes a trace file
+        self.profiler = Profiler()
+        self.profile_overlay = None
+        self.profile_refresh_ms = 1000
+        self.profile_refresh_id = None
+
+        # Key presses move right away, the image is only rendered once the key events are handled
+        self.navigation = NavigationScheduler(self.master, self.show_image, self.profiler)
+        self.none_advance_delay_ms = 100
+
+        # Zoom with the mouse wheel or Control +/-, drag to pan, Control-0 shows the whole image again
+        self.zoom = None  # TileView of the current image while zoomed in
+        self.zoom_renders = NavigationScheduler(self.master, self.show_zoom)
+        self.pan_start = None
+
+        # While the window is resized the shown image is only rescaled, it is decoded again once the size settles
+        self.shown_image = None  # The PIL image behind the PhotoImage
+        self.resizes = ResizeDebouncer(self.master, self.preview_resize, self.resize_settled)
+
+        # Contact sheet of many images at once, marked in batches
+        self.grid = None
+        self.grid_layout = (4, 4)
 
         self.bindings = {}  # Dictionary to store original bindings
         self.unbind_keys = False
         self.master.geometry("800x600")
         self.create_widgets()
         self.bind_keys()
+        self.master.after(self.compaction_interval_ms, self.periodic_save)
 
     def create_widgets(self):
 
@@ -52,49 +145,51 @@ class ImageAnnotatorApp:
         # Button social call counter
         self.social_call_button = tk.Button(self.button_frame,
                                             text="Social Call",
-                                            command=self.increment_social_call,
+                                            command=self.settled(self.increment_social_call),
                                             width=self.button_width)
         self.social_call_button.grid(row=1, column=0, sticky="w")
 
         self.social_call_counter_label = tk.Label(self.button_frame,
-                                                  text=self.social_call_counter)
+                                                  text=0)
         self.social_call_counter_label.grid(row=1, column=1, sticky="w")
 
         self.social_call_button_sub = tk.Button(self.button_frame,
                                                 text="-",
-                                                command=self.sub_social_call)
+                                                command=self.settled(self.sub_social_call))
         self.social_call_button_sub.grid(row=1, column=2, sticky="w")
 
         # Button feeding buzz counter
         self.feeding_buzz_button = tk.Button(self.button_frame,
                                              text="Feeding buzz",
-                                             command=self.increment_feeding_buzz,
+                                             command=self.settled(self.increment_feeding_buzz),
                                              width=self.button_width)
         self.feeding_buzz_button.grid(row=2, column=0, sticky="w")
 
-        self.feeding_buzz_counter_label = tk.Label(self.button_frame, text=self.feeding_buzz_counter)
+        self.feeding_buzz_counter_label = tk.Label(self.button_frame, text=0)
         self.feeding_buzz_counter_label.grid(row=2, column=1, sticky="w")
 
         self.feeding_buzz_button_sub = tk.Button(self.button_frame,
                                                  text="-",
-                                                 command=self.sub_feeding_buzz)
+                                                 command=self.settled(self.sub_feeding_buzz))
         self.feeding_buzz_button_sub.grid(row=2, column=2, sticky="w")
 
         # None checkbox
         self.none_checkbox = tk.Checkbutton(self.button_frame, text="None", variable=self.none_var, onvalue=True,
-                                            offvalue=False)
+                                            offvalue=False,
+                                            command=self.settled(self.toggle_none_checkbox))
         self.none_checkbox.grid(row=3, column=0, sticky="w")
 
         # Bat checkbox
         self.bat_checkbox = tk.Checkbutton(self.button_frame, text="Bat", variable=self.bat_var, onvalue=True,
-                                            offvalue=False)
+                                            offvalue=False,
+                                            command=self.settled(self.toggle_bat))
         self.bat_checkbox.grid(row=4, column=0, sticky="w")
 
         # < and > button
-        self.previous_image_button = tk.Button(self.button_frame, text="<", command=self.previous_image)
+        self.previous_image_button = tk.Button(self.button_frame, text="<", command=self.settled(self.previous_image))
         self.previous_image_button.grid(row=5, column=0, sticky="w", pady=(10,10))
 
-        self.next_image_button = tk.Button(self.button_frame, text=">", command=self.next_image)
+        self.next_image_button = tk.Button(self.button_frame, text=">", command=self.settled(self.next_image))
         self.next_image_button.grid(row=5, column=0, sticky="e", pady=(10,10))
 
         # Notes
@@ -103,8 +198,8 @@ class ImageAnnotatorApp:
 
         # Open file button
         self.open_file_button = tk.Button(self.button_frame,
-                                          text="Open File",
-                                          command=self.open_current_file,
+                                          text="Play",
+                                          command=self.settled(self.open_current_file),
                                           width=self.button_width)
         self.open_file_button.grid(row=7, column=0, sticky="w")
 
@@ -118,7 +213,7 @@ class ImageAnnotatorApp:
         # Find next unannotated image
         self.next_unannotated_button = tk.Button(self.button_frame,
                                           text="Next to \nannotate",
-                                          command=self.next_unannotated_image,
+                                          command=self.settled(self.next_unannotated_image),
                                           width=self.button_width)
         self.next_unannotated_button.grid(row=9, column=0, sticky="w")
 
@@ -131,13 +226,77 @@ class ImageAnnotatorApp:
                                                       variable=self.keep_annotater_var, onvalue=True, offvalue=False)
         self.keep_annotater_checkbox.grid(row=11, column=0, sticky="w")
 
-        # Image viewer
-        self.master.update_idletasks()
-        window_width = self.master.winfo_width()
-        image_label_width = window_width * 0.95 - self.button_frame_width
-
+        # Export button
+        self.export_button = tk.Button(self.button_frame,
+                                       text="Export",
+                                       command=self.export_annotations,
+                                       width=self.button_width)
+        self.export_button.grid(row=12, column=0, sticky="w", pady=(10,10))
+
+        # Progress
+        self.progress_label = tk.Label(self.button_frame, text="")
+        self.progress_label.grid(row=13, column=0, sticky="w")
+
+        # Warm cache button
+        self.warm_cache_button = tk.Button(self.button_frame,
+                                           text="Warm cache",
+                                           command=self.warm_cache,
+                                           width=self.button_width)
+        self.warm_cache_button.grid(row=14, column=0, sticky="w", pady=(10,10))
+
+        # Render spectrograms from the recordings of the next selected folder
+        self.from_wav_checkbox = tk.Checkbutton(self.button_frame, text="From .wav", variable=self.from_wav_var,
+                                                onvalue=True, offvalue=False)
+        self.from_wav_checkbox.grid(row=15, column=0, sticky="w")
+
+        # Pre-screen button
+        self.prescreen_button = tk.Button(self.button_frame,
+                                          text="Pre-screen",
+                                          command=self.prescreen,
+                                          width=self.button_width)
+        self.prescreen_button.grid(row=16, column=0, sticky="w", pady=(10,10))
+
+        # Leave likely empty images for last when looking for the next one to annotate
+        self.skip_empty_checkbox = tk.Checkbutton(self.button_frame, text="Skip likely empty",
+                                                  variable=self.skip_empty_var, onvalue=True, offvalue=False)
+        self.skip_empty_checkbox.grid(row=17, column=0, sticky="w")
+
+        # Playback mode of the Play button
+        self.playback_mode_menu = tk.OptionMenu(self.button_frame, self.playback_mode_var,
+                                                NORMAL, TIME_EXPANSION, HETERODYNE, command=self.player.set_mode)
+        self.playback_mode_menu.grid(row=18, column=0, sticky="w")
+
+        # Grid button
+        self.grid_button = tk.Button(self.button_frame,
+                                     text="Grid",
+                                     command=self.settled(self.open_grid),
+                                     width=self.button_width)
+        self.grid_button.grid(row=19, column=0, sticky="w", pady=(10,10))
+
+        # Annotation order
+        self.scheduler_menu = tk.OptionMenu(self.button_frame, self.scheduler_var, *SCHEDULERS,
+                                            command=lambda value: self.build_queue())
+        self.scheduler_menu.grid(row=20, column=0, sticky="w")
+        self.stratify_checkbox = tk.Checkbutton(self.button_frame, text="Per hour", variable=self.stratify_var,
+                                                onvalue=True, offvalue=False, command=self.build_queue)
+        self.stratify_checkbox.grid(row=21, column=0, sticky="w")
+
+        # Image viewer, 95% of the window width minus the buttons, follows the window when it is resized
         self.image_label = tk.Label(self.master)
-        self.image_label.place(x=self.button_frame_width, y=0, width=image_label_width, relheight=1)
+        self.image_label.place(x=self.button_frame_width, y=0, relwidth=0.95, width=-self.button_frame_width,
+                               relheight=1)
+        self.image_label.bind("<MouseWheel>", lambda event: self.zoom_image(1 if event.delta > 0 else -1, event))
+        self.image_label.bind("<Button-4>", lambda event: self.zoom_image(1, event))  # Wheel on X11
+        self.image_label.bind("<Button-5>", lambda event: self.zoom_image(-1, event))
+        self.image_label.bind("<ButtonPress-1>", self.start_pan)
+        self.image_label.bind("<B1-Motion>", self.pan_image)
+
+        # Widgets showing the current row, only touched when their value changes
+        self.mirror.bind('Social Call', lambda value: self.social_call_counter_label.config(text=value))
+        self.mirror.bind('Feeding Buzz', lambda value: self.feeding_buzz_counter_label.config(text=value))
+        self.mirror.bind('None', lambda value: self.none_var.set(value == 'x'))
+        self.mirror.bind('Bat', lambda value: self.bat_var.set(value == 'x'))
+        self.mirror.bind('Notes', lambda value: self.set_text(self.note_text, value))
 
         # Essential binds
         self.note_text.bind("<FocusIn>", lambda event: self.textbox_focused())
@@ -147,97 +306,395 @@ class ImageAnnotatorApp:
 
     def bind_keys(self):
         # Bindings
-        self.bindings["<s>"] = self.master.bind("<s>", lambda event: self.increment_social_call())
-        self.bindings["<Shift-S>"] = self.master.bind("<Shift-S>", lambda event: self.sub_social_call())
-        self.bindings["<f>"] = self.master.bind("<f>", lambda event: self.increment_feeding_buzz())
-        self.bindings["<Shift-F>"] = self.master.bind("<Shift-F>", lambda event: self.sub_feeding_buzz())
-        self.bindings["<b>"] = self.master.bind("<b>", lambda event: self.toggle_bat())
-        self.bindings["<n>"] = self.master.bind("<n>", lambda event: self.toggle_none())
-        self.bindings["<space>"] = self.master.bind("<space>", lambda event: self.next_image())
-        self.bindings["<r>"] = self.master.bind("<r>", lambda event: self.previous_image())
-        self.bindings["<Shift-Escape>"] = self.master.bind("<Shift-Escape>", lambda event: self.quit())
+        self.bind_key("<s>", self.increment_social_call)
+        self.bind_key("<Shift-S>", self.sub_social_call)
+        self.bind_key("<f>", self.increment_feeding_buzz)
+        self.bind_key("<Shift-F>", self.sub_feeding_buzz)
+        self.bind_key("<b>", self.toggle_bat)
+        self.bind_key("<n>", self.toggle_none)
+        self.bind_key("<space>", self.next_image)
+        self.bind_key("<r>", self.previous_image)
+        self.bind_key("<Shift-Escape>", self.quit)
+        self.bind_key("<F12>", self.toggle_profile_overlay)
+        self.bind_key("<Shift-F12>", self.export_profile)
+        self.bind_key("<Control-plus>", lambda: self.zoom_image(1))
+        self.bind_key("<Control-minus>", lambda: self.zoom_image(-1))
+        self.bind_key("<Control-0>", self.reset_zoom)
+        self.bind_key("<g>", self.open_grid)
+
+    def settled(self, action):
+        # A move still waiting after 'n' happens first, so every key and button acts on the image the user expects
+        def handler(event=None):
+            self.navigation.settle()
+            action()
+        return handler
+
+    def bind_key(self, sequence, action):
+        self.bindings[sequence] = self.master.bind(sequence, self.settled(action))
 
     def open_current_file(self):
         current_file_path = os.path.join(self.folder_path, self.image_names[self.image_index])
-        file_name = os.path.basename(current_file_path)
-        wav_file_name = file_name[4:].split(".")[0] + ".wav"  # removes "IMG_", removes ".jpg", adds ".wav"
-        path = os.path.abspath(os.path.join(current_file_path, "../.."))
-        wav_path = os.path.join(path, wav_file_name)
+        wav_path = wav_path_for_image(current_file_path)
         print(wav_path)
-        try:
-            os.startfile(wav_path)
-        except FileNotFoundError:
-            print("Unable to open file. Please check your default application settings.")
+        self.player.play(wav_path)  # Streams on a background thread, errors are printed there
 
     def select_folder(self):
-        self.folder_path = filedialog.askdirectory()
-        if self.folder_path:
-            self.image_names = [f for f in os.listdir(self.folder_path) if f.endswith('.png') or f.endswith('.jpg')]
-            self.image_index = 0
-            self.load_annotations()
-            self.find_next_image_without_annotations()
+        folder_path = filedialog.askdirectory()
+        if folder_path:
+            self.navigation.cancel()
+            self.close_grid()
+            self.close_journal()
+            self.folder_path = folder_path
+            self.image_names = []
+            self.render_from_wav = self.from_wav_var.get()
+            if self.render_from_wav:
+                variant = "spectrogram-" + self.spectrogram_settings.key()
+                self.scanner = FolderScanner(self.folder_path, ('.wav',))
+            else:
+                variant = "thumbnail"
+                self.scanner = FolderScanner(self.folder_path, ('.png', '.jpg'), ignore_case=False)
+            self.thumbnails = ThumbnailCache.for_folder(self.folder_path, variant=variant)
+
+            # Reopened projects start from the manifest, new folders from the first batch of the scan
+            cached_names = self.scanner.cached_names()
+            self.scanner.start()
+            if cached_names:
+                self.open_images(cached_names)
+            self.poll_scanner()
+
+    def open_images(self, image_names):
+        self.image_names = list(image_names)
+        self.image_index = 0
+        self.load_annotations()
+        self.find_next_image_without_annotations()
+        self.show_image()
+
+    def poll_scanner(self):
+        scanner = self.scanner
+        for image_names in scanner.take_batches():
+            if scanner is not self.scanner:
+                return  # Another folder was selected meanwhile
+            if self.journal is None:
+                self.open_images(image_names)
+            else:
+                self.add_images(image_names)
+
+        if not scanner.done():
+            self.master.after(50, self.poll_scanner)
+        elif scanner.error is not None:
+            print(f"Scanning {self.folder_path} failed: {scanner.error}")
+        elif scanner is self.scanner:
+            result = scanner.result
+            if result.added or result.removed:
+                print(f"Folder changed since last scan: {len(result.added)} new images, "
+                      f"{len(result.removed)} images missing")
+            if result.removed and self.journal is not None:
+                self.remove_images(result.removed)
+
+    def add_images(self, image_names):
+        self.image_names.extend(image_names)
+        added = self.model.add_images(image_names)
+        if added:
+            self.store.write(*self.table_rows(added))
+        self.pending.extend(~self.annotated_mask(image_names))
+        self.defer_likely_empty()
+        self.extend_queue(image_names)
+        self.update_progress_label()
+        self.prefetch_neighbours()
+
+    def remove_images(self, image_names):
+        # Rows stay in the model so their annotations are still exported
+        self.update_annotations()
+        self.close_grid()  # Its positions moved
+        removed = set(image_names)
+        current_name = self.image_names[self.image_index]
+        self.image_names = [name for name in self.image_names if name not in removed]
+        self.pending = PendingMask(~self.annotated_mask(self.image_names))
+        self.defer_likely_empty()
+        self.build_queue()
+        self.claimed = []  # Positions moved
+        if not self.image_names:
+            return
+        if current_name in removed:
+            self.image_index = min(self.image_index, len(self.image_names) - 1)
             self.show_image()
+            self.check_annotations()
+        else:
+            self.image_index = self.image_names.index(current_name)
+            self.update_progress_label()
 
     def find_next_image_without_annotations(self):
-        while self.image_index < len(self.image_names):
-            social_call_value = self.df.at[self.image_index, 'Social Call']
-            feeding_buzz_value = self.df.at[self.image_index, 'Feeding Buzz']
-            none_value = self.df.at[self.image_index, 'None']
-            bat_value = self.df.at[self.image_index, 'Bat']
-
-            # If annotation is found in any column, move to the next image
-            if social_call_value > 0 or feeding_buzz_value > 0 or none_value == 'x' or bat_value == 'x':
-                self.image_index += 1
-            else:
-                break
+        if self.storage_backend == "shared":
+            next_index = self.next_claimed_image()
+        elif self.queue is not None:
+            skip = self.pending.deferred if self.skip_empty_var.get() else None
+            next_index = self.queue.next_pending(self.pending.pending, skip)
+        else:
+            next_index = self.pending.next_pending(self.image_index, wrap=False, defer=self.skip_empty_var.get())
 
         # If all images have annotations, reset the index
-        if self.image_index == len(self.image_names):
-            self.image_index = 0
+        self.image_index = next_index if next_index is not None else 0
 
 
     def load_annotations(self):
         excel_file_path = os.path.join(self.folder_path, 'annotations.xlsx')
+        self.store = open_store(self.folder_path, self.storage_backend)
+
+        # The store holds the live annotations, an existing annotations.xlsx is only imported once
+        table = self.store.load()
+        imported = table is None and os.path.exists(excel_file_path)
+        if imported:
+            table = import_xlsx(excel_file_path)
+
+        if table is not None:
+            columns, rows = table
+            self.model = AnnotationModel.from_table(columns, rows, DEFAULTS,
+                                                    {column: count_value for column in COUNT_COLUMNS}, KINDS)
+        else:
+            # Start an empty table if there are no annotations yet
+            self.model = AnnotationModel(COLUMNS, DEFAULTS, KINDS)
+        self.held_rows = set()
+
+        # Match the rows to the images that are in the folder now, rows are found by name from here on
+        added, _ = self.model.reconcile(self.image_names)
+        if added and table is not None:
+            print(f"{len(added)} images without annotations yet")
+
+        if table is None or imported or not self.store.incremental:
+            self.store.write(*self.table_rows())
+        elif added:
+            self.store.write(*self.table_rows(added))
+
+        # Replay changes that were not yet saved to the store
+        self.journal = AnnotationJournal(os.path.join(self.folder_path, self.store.journal_name))
+        for image_name, values in self.journal.replay().items():
+            row = self.model.row_of(image_name)
+            if row is not None:
+                self.model.update(row, values, dirty=False)
+
+        # Kept up to date by update_annotations afterwards
+        self.pending = PendingMask(~self.annotated_mask(self.image_names))
+
+        self.screening_store = open_store(self.folder_path, self.storage_backend, table=SCREENING_TABLE)
+        self.suggestions = load_suggestions(self.screening_store)
+        self.defer_likely_empty()
+
+        self.queue_store = open_store(self.folder_path, self.storage_backend, table=QUEUE_TABLE)
+        self.build_queue()
+
+        self.claimed = []
+        if self.storage_backend == "shared":
+            self.poll_project(self.store)
+
+
+    def claim_batch(self):
+        # Lease the next pending images no other annotator holds, starting at the current one
+        pending = np.flatnonzero(self.pending.pending)
+        if self.queue is not None:
+            pending = pending[np.argsort(self.queue.rank[pending], kind="stable")]
+        else:
+            pending = np.roll(pending, -int(np.searchsorted(pending, self.image_index)))
+        if self.skip_empty_var.get():
+            pending = np.concatenate([pending[~self.pending.deferred[pending]], pending[self.pending.deferred[pending]]])
+
+        window = self.claim_batch_size * 4
+        for offset in range(0, len(pending), window):
+            positions = {self.image_names[i]: int(i) for i in pending[offset:offset + window]}
+            claimed = self.store.claim(positions, self.claim_batch_size)
+            if claimed:
+                self.claimed = [(positions[name], name) for name in claimed]
+                return
+        self.claimed = []
+
+
+    def next_claimed_image(self):
+        for attempt in range(2):
+            while self.claimed:
+                position, name = self.claimed[0]
+                if position < len(self.image_names) and self.image_names[position] == name and \
+                        self.pending.is_pending(position):
+                    return position
+                self.claimed.pop(0)  # Annotated meanwhile
+            if attempt == 0:
+                self.claim_batch()
+        return None
+
+
+    def poll_project(self, store):
+        # Shared projects: keep our leases, pull what the others saved and report rows we could not save
+        if store is not self.store:
+            return  # Another folder was selected meanwhile
+
+        if time.monotonic() - self.last_lease_renewal > store.lease_seconds / 3:
+            store.renew()
+            self.last_lease_renewal = time.monotonic()
+
+        # The image on screen may still be edited here, the store holds its change back until we move on
+        current_name = self.image_names[self.image_index] if self.image_names else None
+        columns, rows = store.changes_since(on_screen=[current_name])
+        if rows:
+            self.apply_remote_rows(columns, rows)
+        for image_name, holder in store.take_conflicts():
+            print(f"Not saved: {image_name} was changed by {holder or 'another annotator'} meanwhile, "
+                  f"their annotation is kept")
+
+        self.leased_by_others = store.leases()
+        self.update_progress_label()
+        self.master.after(self.project_poll_ms, self.poll_project, store)
+
+
+    def apply_remote_rows(self, columns, rows):
+        positions = {name: i for i, name in enumerate(self.image_names)}
+        for row in rows:
+            values = dict(zip(columns, row))
+            image_name = row[0]
+            index = self.model.row_of(image_name)
+            if index is None:
+                continue
+            for column in COLUMNS[1:]:
+                value = values.get(column)
+                self.model.set(index, column, DEFAULTS[column] if value is None else value, dirty=False)
+            position = positions.get(image_name)
+            if position is not None:
+                self.set_annotated(position, self.is_annotated(index))
+        print(f"{len(rows)} annotations from other annotators")
+
+
+    def build_queue(self, rescore=False):
+        # Scores come from the queue table when it has them for this order, else they are computed once and stored
+        if self.queue_store is None:
+            return
+        scheduler, stratified = self.scheduler_var.get(), self.stratify_var.get()
+        if scheduler == "file order" and not stratified:
+            self.queue = None
+            return
+
+        queue = None if rescore else stored_queue(self.queue_store.load(), self.image_names, scheduler, stratified)
+        if queue is None:
+            columns, rows = compute_queue(self.image_names, self.suggestions, scheduler, stratified)
+            self.queue_store.write(columns, rows)
+            queue = [row[2] for row in rows], [row[3] for row in rows]
+        self.queue_scores = list(queue[0]), list(queue[1])  # Priorities and strata per position
+        self.queue = AnnotationQueue(*self.queue_scores, ~self.pending.pending)
+
+
+    def extend_queue(self, image_names):
+        # Only the new images of a scan are scored, the others keep the scores in memory
+        if self.queue is None or not image_names:
+            return
+        priorities, strata = self.queue_scores
+        columns, rows = compute_queue(image_names, self.suggestions, self.scheduler_var.get(),
+                                      self.stratify_var.get(), first=len(priorities))
+        priorities.extend(row[2] for row in rows)
+        strata.extend(row[3] for row in rows)
+        if not self.queue_store.incremental:
+            scheduler = rows[0][1]
+            rows = [[name, scheduler, priority, stratum]
+                    for name, priority, stratum in zip(self.image_names, priorities, strata)]
+        self.queue_store.write(columns, rows)
+        self.queue = AnnotationQueue(priorities, strata, ~self.pending.pending)
+
+
+    def set_annotated(self, position, annotated):
+        # The pending mask and the annotation order learn about every label
+        if self.pending.is_pending(position) == annotated:
+            self.pending.set_annotated(position, annotated)
+            if self.queue is not None:
+                self.queue.labelled(position, annotated)
+
 
-        # Check if the annotations Excel file exists
-        if os.path.exists(excel_file_path):
-            self.df = pd.read_excel(excel_file_path, keep_default_na=False)
+    def defer_likely_empty(self):
+        # Images the pre-screener is confident are empty come last in the next-to-annotate order
+        self.pending.set_deferred([self.is_likely_empty(name) for name in self.image_names])
+
+
+    def is_likely_empty(self, image_name):
+        suggestion, confidence, _ = self.suggestions.get(image_name, (None, 0.0, 0.0))
+        return suggestion == 'None' and confidence >= self.skip_confidence
+
+
+    def prescreen(self):
+        # Screens the images without a suggestion yet on a process pool, results arrive in poll_prescreen
+        if self.screening_store is None or self.prescreener is not None:
+            return
+        names = [name for name in self.image_names if name not in self.suggestions]
+        self.prescreener = Prescreener(self.folder_path, names, self.screen_settings)
+        self.prescreener.start()
+        self.poll_prescreen(self.prescreener)
+
+
+    def poll_prescreen(self, prescreener):
+        if prescreener is not self.prescreener:
+            return  # Another folder was selected meanwhile
+        results = prescreener.take_results()
+        if results:
+            for name, suggestion, confidence, score in results:
+                self.suggestions[name] = (suggestion, confidence, score)
+            if not self.screening_store.incremental:
+                results = [[name, *values] for name, values in self.suggestions.items()]
+            self.screening_store.write(SCREENING_COLUMNS, results)
+            self.defer_likely_empty()
+            self.update_progress_label()
+
+        if prescreener.done():
+            print(f"Pre-screened {prescreener.screened} images, {prescreener.failed} failed, "
+                  f"{self.pending.deferred_count()} likely empty")
+            self.prescreener = None
+            self.build_queue(rescore=True)  # The scores came from the suggestions
         else:
-            # Create a new DataFrame if the file doesn't exist
-            self.df = pd.DataFrame({'Image Name': self.image_names,
-                                   'Social Call': [0] * len(self.image_names),
-                                   'Feeding Buzz': [0] * len(self.image_names),
-                                   'None': [''] * len(self.image_names),
-                                   'Bat': [''] * len(self.image_names),
-                                   'Notes': [''] * len(self.image_names),
-                                   'Annotater': [''] * len(self.image_names)})
+            self.master.after(200, self.poll_prescreen, prescreener)
 
 
-    def check_annotations(self):
-        # Get the current image name
-        index = self.image_index
+    def annotated_mask(self, image_names):
+        # One vectorised pass over the columns for the given images
+        rows = np.fromiter((self.model.row_of(name) for name in image_names), dtype=np.int64,
+                           count=len(image_names))
+        mask = lambda name: self.model.mask(name)[rows]
+        return mask('Social Call') | mask('Feeding Buzz') | mask('None') | mask('Bat')
+
+
+    def is_annotated(self, row):
+        record = self.model.record(row)
+        return record['Social Call'] > 0 or record['Feeding Buzz'] > 0 or record['None'] == 'x' or \
+            record['Bat'] == 'x'
 
-        # Check 'Social Call' and 'Feeding Buzz' columns for current image
-        social_call_value = self.df.at[index, 'Social Call']
-        feeding_buzz_value = self.df.at[index, 'Feeding Buzz']
-        none_value = self.df.at[index, 'None']
-        bat_value = self.df.at[index, 'Bat']
-        note_value = self.df.at[index, "Notes"]
-        annotater_value = self.df.at[index, "Annotater"]
 
-        # Change values according to previous annotations
-        self.social_call_counter_label.config(text=int(social_call_value))
-        self.social_call_counter = int(social_call_value)
+    def table_rows(self, image_names=None):
+        # (columns, rows) for the store, either for the given images or for all of them
+        return self.model.table(image_names)
 
-        self.feeding_buzz_counter_label.config(text=int(feeding_buzz_value))
-        self.feeding_buzz_counter = int(feeding_buzz_value)
 
-        self.none_var.set(none_value == 'x')
-        self.bat_var.set(bat_value == 'x')
+    def current_row(self):
+        return self.model.row_of(self.image_names[self.image_index])
 
-        self.note_text.delete("1.0", tk.END)
-        if note_value: self.note_text.insert(tk.END, note_value)
 
+    def current_value(self, column):
+        return self.model.get(self.current_row(), column) if self.model is not None else DEFAULTS[column]
+
+
+    def set_value(self, column, value):
+        # Edits go to the model, the widgets follow it
+        if self.model is None or not self.image_names:
+            return
+        row = self.current_row()
+        self.model.set(row, column, value)
+        self.mirror.show(self.model.record(row))
+        self.update_progress_label()
+
+
+    @staticmethod
+    def set_text(text_widget, value):
+        text_widget.delete("1.0", tk.END)
+        if value:
+            text_widget.insert(tk.END, value)
+
+
+    @profiled("check_annotations")
+    def check_annotations(self):
+        # Show the annotations of the current image, widgets that already show the right value are left alone
+        record = self.model.record(self.current_row())
+        self.mirror.show(record)
+        annotater_value = record["Annotater"]
 
 
         self.current_annotater = self.annotater_text.get("1.0", "end-1c")
@@ -257,46 +714,294 @@ class ImageAnnotatorApp:
             print("wil annotater houden maar vorige was een andere annotater, on nee wat nu")
 
 
+    @profiled("render")
     def show_image(self):
         if self.image_index < 0:
             return
 
         image_path = os.path.join(self.folder_path, self.image_names[self.image_index])
-        image = Image.open(image_path)
-        w, h = self.master.winfo_width(), self.master.winfo_height()  # Get window width and height
-        image.thumbnail((w, h))  # Resize the image to fit the window
+        self.player.stop()  # The recording of the previous image
+        self.close_zoom()
+        if self.prefetcher.target_size is None:
+            self.prefetcher.set_target_size(self.display_size(self.window_size()))  # Before the first resize settled
+
+        now = time.perf_counter()
+        navigating_quickly = now - self.last_show_time < self.fast_preview_interval
+        self.last_show_time = now
+
+        image = self.prefetcher.peek(image_path)
+        needs_sharpening = image is None and navigating_quickly
+        if image is None:
+            with self.profiler.stage("wait_for_decode"):
+                image = self.prefetcher.get(image_path, FAST if needs_sharpening else HIGH)
+        self.display_image(image)
+
+        # Change title to image name
+        self.master.title(os.path.basename(image_path))
+
+        self.update_progress_label()
+        self.prefetch_neighbours(include_current=needs_sharpening)
+        if needs_sharpening:
+            self.master.after(self.sharpen_delay_ms, self.sharpen_image, self.image_index)
+
+
+    @profiled("photo_image")
+    def display_image(self, image):
+        self.shown_image = image
         photo = ImageTk.PhotoImage(image)
         self.image_label.configure(image=photo)
         self.image_label.image = photo
 
-        window_width = self.master.winfo_width()
-        image_label_width = window_width * 0.95 - self.button_frame_width
 
-        # Update the placement of the image label
-        self.image_label.place(x=self.button_frame_width, y=0, width=image_label_width, relheight=1)
+    def window_size(self):
+        return self.master.winfo_width(), self.master.winfo_height()
 
-        # Change title to image name
-        self.master.title(os.path.basename(image_path))
+
+    def display_size(self, window_size):
+        # Images are decoded to fit the whole window
+        return window_size
+
+
+    def preview_resize(self, window_size):
+        # Rescale what is decoded already, nothing is read from disk until the size settles
+        if self.shown_image is None or self.zoom is not None:
+            return
+        with self.profiler.stage("resize_preview"):
+            photo = ImageTk.PhotoImage(rescale_image(self.shown_image, self.display_size(window_size)))
+        self.image_label.configure(image=photo)
+        self.image_label.image = photo
+
+
+    def resize_settled(self, window_size):
+        # Everything prefetched so far has the old size, decode the current image again at the new one
+        size = self.display_size(window_size)
+        if size == self.prefetcher.target_size:
+            return
+        self.prefetcher.set_target_size(size)
+        self.close_zoom()
+        if self.image_index >= 0:
+            self.navigation.request_render()
+
+
+    def sharpen_image(self, image_index):
+        # Swap the fast preview for the full quality image once a worker has it ready
+        if image_index != self.image_index or self.zoom is not None:
+            return
+        image = self.prefetcher.peek(os.path.join(self.folder_path, self.image_names[image_index]))
+        if image is None:
+            self.master.after(50, self.sharpen_image, image_index)
+        else:
+            self.display_image(image)
+
+
+    def zoom_image(self, steps, event=None):
+        # The first step in opens the current image as tiles, zooming happens around the pointer
+        if self.image_index < 0 or not self.image_names:
+            return
+        if self.zoom is None:
+            if steps <= 0 or getattr(self.image_label, "image", None) is None:
+                return
+            image_path = os.path.join(self.folder_path, self.image_names[self.image_index])
+            try:
+                source = WavSource(image_path, self.spectrogram_settings) if self.render_from_wav \
+                    else ImageSource(image_path)
+            except (OSError, ValueError) as error:
+                print(f"Unable to zoom into {image_path}: {error}")
+                return
+            photo = self.image_label.image
+            self.zoom = TileView(source, (photo.width(), photo.height()))  # Where the image is shown now
+
+        anchor = None
+        if event is not None:
+            # The label centres the image
+            anchor = (event.x - (self.image_label.winfo_width() - self.zoom.viewport[0]) / 2,
+                      event.y - (self.image_label.winfo_height() - self.zoom.viewport[1]) / 2)
+        self.zoom.zoom(steps, anchor)
+        self.zoom_renders.request_render()
+
+
+    def start_pan(self, event):
+        self.pan_start = (event.x, event.y)
+
+
+    def pan_image(self, event):
+        if self.zoom is None or self.pan_start is None:
+            return
+        self.zoom.pan(event.x - self.pan_start[0], event.y - self.pan_start[1])
+        self.pan_start = (event.x, event.y)
+        self.zoom_renders.request_render()
+
+
+    def show_zoom(self):
+        # Only the visible tiles are rendered, panning reuses the ones rendered before
+        if self.zoom is None:
+            return
+        with self.profiler.stage("zoom"):
+            image = self.zoom.render()
+        self.display_image(image)
+
+
+    def reset_zoom(self):
+        if self.zoom is not None:
+            self.close_zoom()
+            self.navigation.request_render()
+
+
+    def close_zoom(self):
+        if self.zoom is not None:
+            self.zoom_renders.cancel()
+            self.zoom.close()
+            self.zoom = None
+
+
+    def update_progress_label(self):
+        text = f"{self.image_index + 1}/{len(self.image_names)}\n{self.pending.pending_count} to annotate"
+        unsaved = self.unsaved_count()
+        if unsaved:
+            text += f"\n{unsaved} not saved yet"
+        suggestion = self.suggestions.get(self.image_names[self.image_index]) if self.image_names else None
+        if suggestion is not None:
+            text += f"\nSuggested: {suggestion[0]} ({suggestion[1]:.0%})"
+        holder = self.leased_by_others.get(self.image_names[self.image_index]) if self.image_names else None
+        if holder is not None:
+            text += f"\nClaimed by {holder}"
+        self.progress_label.config(text=text)
+
+
+    @profiled("decode")
+    def load_display_image(self, image_path, size, quality):
+        # Runs on the prefetch worker threads, so no Tk calls in here
+        thumbnails = self.thumbnails
+        render = self.render_function()
+        if thumbnails is None:
+            return render(image_path, size, quality)
+        return thumbnails.get_or_render(image_path, size, render, quality)
+
+
+    def render_function(self):
+        # Module level functions only, the warm pass sends them to worker processes
+        if self.render_from_wav:
+            return partial(render_spectrogram, settings=self.spectrogram_settings)
+        return thumbnail_image
+
+
+    def warm_cache(self):
+        # Renders the resized copy of every image on a process pool, without blocking the window
+        if self.thumbnails is None or self.prefetcher.target_size is None:
+            return
+
+        thumbnails = self.thumbnails
+        size = self.prefetcher.target_size
+        image_paths = [os.path.join(self.folder_path, name) for name in self.image_names]
+        render = self.render_function()
+
+        def run():
+            rendered = thumbnails.warm(image_paths, size, render)
+            print(f"Warm cache: rendered {rendered} of {len(image_paths)} images")
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+    def prefetch_neighbours(self, include_current=False):
+        current = [self.image_index] if include_current else []
+        ahead = [self.neighbour(i) for i in range(1, self.prefetch_ahead + 1)]
+        behind = [self.neighbour(-i) for i in range(1, self.prefetch_behind + 1)]
+        indices = dict.fromkeys(current + ahead + behind)  # Keeps order, drops duplicates in small folders
+        if not include_current:
+            indices.pop(self.image_index, None)
+        self.prefetcher.schedule(os.path.join(self.folder_path, self.image_names[i]) for i in indices)
+
+        # The current recording first, it is the one most likely to be played
+        upcoming = [self.neighbour(i) for i in range(self.prebuffer_ahead + 1)]
+        self.player.prebuffer(wav_path_for_image(os.path.join(self.folder_path, self.image_names[i]))
+                              for i in dict.fromkeys(upcoming))
+
+
+    def neighbour(self, offset):
+        # The image `offset` steps away in the annotation order
+        if self.queue is not None:
+            return self.queue.step(self.image_index, offset)
+        return (self.image_index + offset) % len(self.image_names)
 
 
     def next_image(self):
         self.update_annotations()
-        self.image_index = (self.image_index + 1) % len(self.image_names)
-        self.show_image()
+        self.image_index = self.neighbour(1)
         self.check_annotations()
+        self.navigation.request_render()
 
 
     def next_unannotated_image(self):
         self.find_next_image_without_annotations()
-        self.show_image()
         self.check_annotations()
+        self.navigation.request_render()
 
 
     def previous_image(self):
         self.update_annotations()
-        self.image_index = (self.image_index - 1) % len(self.image_names)
-        self.show_image()
+        self.image_index = self.neighbour(-1)
         self.check_annotations()
+        self.navigation.request_render()
+
+
+    def open_grid(self):
+        if self.model is None or not self.image_names:
+            return
+        if self.grid is not None:
+            self.grid.lift()
+            return
+        self.update_annotations()
+        self.grid = GridView(self.master, lambda: len(self.image_names),
+                             lambda position: os.path.join(self.folder_path, self.image_names[position]),
+                             self.render_function(), self.grid_status, self.mark_images,
+                             open_image=self.open_from_grid, on_close=self.grid_closed, start=self.image_index,
+                             columns=self.grid_layout[0], rows=self.grid_layout[1], thumbnails=self.thumbnails)
+
+
+    def grid_status(self, position):
+        # What is under a cell, empty while the image has no annotations
+        record = self.model.record(self.model.row_of(self.image_names[position]))
+        marks = [column for column in ('None', 'Bat') if record[column] == 'x']
+        marks += [f"{column} {record[column]}" for column in COUNT_COLUMNS if record[column] > 0]
+        return ", ".join(marks)
+
+
+    @profiled("mark_batch")
+    def mark_images(self, positions, column):
+        # Toggles like the single image keys: set on all of them unless all of them are set already
+        rows = [self.model.row_of(self.image_names[position]) for position in positions]
+        value = '' if all(self.model.get(row, column) == 'x' for row in rows) else 'x'
+        annotater = self.annotater_text.get("1.0", "end-1c")
+        for position, row in zip(positions, rows):
+            self.model.set(row, column, value)
+            if annotater:
+                self.model.set(row, 'Annotater', annotater)
+            self.set_annotated(position, self.is_annotated(row))
+
+        # One journal write, then one store transaction for the whole batch
+        self.journal.append_many(self.model.take_dirty(keep=self.held_rows))
+        self.save_annotations()
+        self.mirror.show(self.model.record(self.current_row()))
+        self.update_progress_label()
+
+
+    def open_from_grid(self, position):
+        self.update_annotations()
+        self.image_index = position
+        self.check_annotations()
+        self.navigation.request_render()
+        self.master.lift()
+        self.master.focus_force()
+
+
+    def grid_closed(self):
+        self.grid_layout = (self.grid.columns, self.grid.rows)
+        self.grid = None
+
+
+    def close_grid(self):
+        if self.grid is not None:
+            self.grid.close()
 
 
     def textbox_focused(self):
@@ -312,96 +1017,181 @@ class ImageAnnotatorApp:
 
 
     def increment_social_call(self):
-        self.social_call_counter += 1
-        self.social_call_counter_label.config(text=self.social_call_counter)
-
-        if self.social_call_counter > 0:
-            self.bat_var.set(True)
+        self.set_value('Social Call', self.current_value('Social Call') + 1)
+        self.set_value('Bat', 'x')
 
 
     def sub_social_call(self):
-        if self.social_call_counter == 0:
+        if self.current_value('Social Call') == 0:
             return
 
-        self.social_call_counter -= 1
-        self.social_call_counter_label.config(text=self.social_call_counter)
+        self.set_value('Social Call', self.current_value('Social Call') - 1)
 
-        if self.social_call_counter == 0 and self.feeding_buzz_counter == 0:
-            self.bat_var.set(False)
+        if self.current_value('Social Call') == 0 and self.current_value('Feeding Buzz') == 0:
+            self.set_value('Bat', '')
 
 
     def increment_feeding_buzz(self):
-        self.feeding_buzz_counter += 1
-        self.feeding_buzz_counter_label.config(text=self.feeding_buzz_counter)
-
-        if self.feeding_buzz_counter > 0:
-            self.bat_var.set(True)
+        self.set_value('Feeding Buzz', self.current_value('Feeding Buzz') + 1)
+        self.set_value('Bat', 'x')
 
 
     def sub_feeding_buzz(self):
-        if self.feeding_buzz_counter == 0:
+        if self.current_value('Feeding Buzz') == 0:
             return
 
-        self.feeding_buzz_counter -= 1
-        self.feeding_buzz_counter_label.config(text=self.feeding_buzz_counter)
+        self.set_value('Feeding Buzz', self.current_value('Feeding Buzz') - 1)
 
-        if self.social_call_counter == 0 and self.feeding_buzz_counter == 0:
-            self.bat_var.set(False)
+        if self.current_value('Social Call') == 0 and self.current_value('Feeding Buzz') == 0:
+            self.set_value('Bat', '')
 
 
     def toggle_none(self):
-        self.none_var.set(not self.none_var.get())
+        self.set_value('None', '' if self.current_value('None') == 'x' else 'x')
+
+        if self.current_value('None') == 'x':
+            # Leave the tick visible for a moment without blocking the window
+            self.navigation.move_later(self.none_advance_delay_ms, self.next_image)
 
-        if self.none_var.get():
-            time.sleep(0.1)
-            self.next_image()
+
+    def toggle_none_checkbox(self):
+        # Unlike 'n', a click does not move on. The image toggles, not the checkbox state, which
+        # a move that was still waiting has set to the next image already
+        self.set_value('None', '' if self.current_value('None') == 'x' else 'x')
 
 
     def toggle_bat(self):
-        self.bat_var.set(not self.bat_var.get())
+        self.set_value('Bat', '' if self.current_value('Bat') == 'x' else 'x')
 
 
     def quit(self):
-        self.update_annotations(force=True)
+        self.navigation.cancel()
+        self.resizes.cancel()
+        self.close_grid()
+        self.close_zoom()
+        self.update_annotations()
+        self.close_journal()
+        self.prefetcher.stop()
+        self.player.close()
+        print(f"Image cache: {self.prefetcher.stats()}")
+        print(f"Navigation: {self.navigation.stats()}")
+        print(self.profiler.format_summary())
         root.destroy()
 
 
+    @profiled("update_annotations")
     def update_annotations(self, force=False):
-        if self.df is None:
+        if self.model is None:
             return
 
-        index = self.image_index
-        row_before_updating = self.df.loc[index].tolist()
-
-        # Update cells
-        self.df.at[index, 'Social Call'] = self.social_call_counter
-        self.df.at[index, 'Feeding Buzz'] = self.feeding_buzz_counter
-        self.df.at[index, 'None'] = 'x' if self.none_var.get() else ''
-        self.df.at[index, 'Bat'] = 'x' if self.bat_var.get() else ''
-        self.df.at[index, 'Notes'] = self.note_text.get("1.0", "end-1c")
-        self.df.at[index, 'Annotater'] = self.annotater_text.get("1.0", "end-1c")
-
-        row_after_updating = self.df.loc[index].tolist()
+        # Counters and checkboxes are in the model already, the text boxes are read now
+        index = self.current_row()
+        notes = self.note_text.get("1.0", "end-1c")
+        annotater = self.annotater_text.get("1.0", "end-1c")
 
+        # Overwriting another annotater waits for the warning, nothing else is written to the model before
         if self.previous_annotater and self.keep_annotater_var.get() and \
                 self.previous_annotater != self.current_annotater:
-            self.popup_annotater_warning()
+            self.held_rows.add(index)
+            self.popup_annotater_warning(index, self.image_index, notes, annotater)
+        else:
+            self.mirror.shown('Notes', notes)
+            self.apply_text_edits(index, self.image_index, notes, annotater)
+
+        self.journal_edits()
+
+        if force:
+            self.save_annotations()
+
+
+    def apply_text_edits(self, row, position, notes, annotater):
+        self.model.set(row, 'Notes', notes)
+        self.model.set(row, 'Annotater', annotater)
+        if self.model.is_dirty(row) and position < len(self.image_names) and \
+                self.model.row_of(self.image_names[position]) == row:
+            self.set_annotated(position, self.is_annotated(row))
+
+
+    def journal_edits(self):
+        # Persist only the edited values
+        for image_name, values in self.model.take_dirty(keep=self.held_rows):
+            self.journal.append(image_name, values)
+
+
+    @profiled("save")
+    def save_annotations(self, background=False):
+        # Fold the journal into the store, incremental stores only get the journaled rows
+        if self.journal is None:
+            return
+
+        store = self.store
+        snapshot = lambda changes: self.table_rows(changes if store.incremental else None)
+        self.journal.compact(snapshot, lambda table: store.write(*table), background)
+
+
+    def unsaved_count(self):
+        # Images with edits the store does not have yet, whether they are in the journal or not
+        if self.journal is None:
+            return 0
+        return len(self.journal.unsaved_images() | self.model.dirty_images())
+
+
+    def export_annotations(self):
+        if self.model is None:
+            return
+
+        self.update_annotations(force=True)
+        export_xlsx(os.path.join(self.folder_path, 'annotations.xlsx'), *self.table_rows())
+
+
+    def periodic_save(self):
+        self.save_annotations(background=True)
+        self.master.after(self.compaction_interval_ms, self.periodic_save)
+
+
+    def close_journal(self):
+        if self.journal is None:
+            return
+
+        self.save_annotations()
+        self.journal.close()
+        self.journal = None
+        self.store.close()
+        if self.prescreener is not None:
+            self.prescreener.stop()
+            self.prescreener = None
+        self.screening_store.close()
+        self.queue_store.close()
+        self.queue = None
+
+    def toggle_profile_overlay(self):
+        if self.profile_overlay is not None:
+            self.master.after_cancel(self.profile_refresh_id)
+            self.profile_overlay.destroy()
+            self.profile_overlay = None
             return
 
-        if row_before_updating != row_after_updating:
-            print("Something changed!")
+        self.profile_overlay = tk.Label(self.master, justify="left", font=("Courier", 9), bg="black", fg="white")
+        self.profile_overlay.place(relx=1.0, y=0, anchor="ne")
+        self.refresh_profile_overlay()
+
 
-            # Another update done
-            self.annotation_changes += 1
-            print(self.annotation_changes)
+    def refresh_profile_overlay(self):
+        # Milliseconds per stage over the recent calls
+        self.profile_overlay.config(text=self.profiler.format_summary())
+        self.profile_refresh_id = self.master.after(self.profile_refresh_ms, self.refresh_profile_overlay)
 
-            # Save the DataFrame to the annotations Excel file every 10 changes
-            if self.annotation_changes >= 10 or force:
-                excel_file_path = os.path.join(self.folder_path, 'annotations.xlsx')
-                self.df.to_excel(excel_file_path, index=False)
-                self.annotation_changes = 0  # Reset the counter after saving
 
-    def popup_annotater_warning(self):
+    def export_profile(self):
+        # The same trace as CSV for spreadsheets and as JSON with the percentiles
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.folder_path or os.getcwd(), f"speedybat_trace_{stamp}")
+        self.profiler.export(path + ".csv")
+        events = self.profiler.export(path + ".json")
+        print(f"Profile: {events} events written to {path}.csv and .json")
+
+
+    def popup_annotater_warning(self, row, position, notes, annotater):
         # Get the root window coordinates
         root_x = root.winfo_x()
         root_y = root.winfo_y()
@@ -427,9 +1217,27 @@ class ImageAnnotatorApp:
                                      f"Are you sure you want to \noverwrite the annotation?")
         label.pack(pady=10)
 
-        close_button = tk.Button(popup, text="Close", command=popup.destroy)
+        model = self.model
+
+        def answer(overwrite):
+            popup.destroy()
+            self.held_rows.discard(row)
+            if self.model is not model or self.journal is None:
+                return  # Another folder was opened meanwhile, or the window closed
+            if overwrite:
+                self.apply_text_edits(row, position, notes, annotater)
+            else:
+                # The edits of this image are dropped, it keeps the annotation of the previous annotater
+                self.model.discard(row)
+                if self.image_names and self.current_row() == row:
+                    self.mirror.show(self.model.record(row))
+            self.journal_edits()
+            self.update_progress_label()
+
+        popup.protocol("WM_DELETE_WINDOW", lambda: answer(False))
+        close_button = tk.Button(popup, text="Cancel", command=lambda: answer(False))
         close_button.pack()
-        close_button = tk.Button(popup, text="Continue", command=popup.destroy)
+        close_button = tk.Button(popup, text="Continue", command=lambda: answer(True))
         close_button.pack()
 
 
@@ -1,8 +1,27 @@
 import os
+import threading
+import time
+from functools import partial
+import numpy as np
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, Menu
-from PIL import Image, ImageTk
-import openpyxl
+from PIL import ImageTk
+from image_cache import ImageCache, ImagePrefetcher, fit_image, rescale_image, FAST, HIGH
+from thumbnail_cache import ThumbnailCache
+from annotation_journal import AnnotationJournal
+from annotation_index import RowIndex
+from annotation_model import AnnotationModel, WidgetMirror
+from pending_mask import PendingMask
+from annotation_storage import open_store, import_xlsx, export_xlsx
+from folder_scanner import FolderScanner, wav_path_for_image
+from annotation_schema import FIELDS_IMAGE_COLUMN, MARKER
+from field_schema import FieldSchema, SCHEMA_TABLE
+from navigation import NavigationScheduler, ResizeDebouncer
+from latency_profiler import Profiler, profiled
+from zoom_view import ImageSource, WavSource, TileView
+from spectrogram import SpectrogramSettings, render_spectrogram
+from audio_playback import AudioPlayer, PlaybackSettings, NORMAL, TIME_EXPANSION, HETERODYNE
+from prescreen import Prescreener, ScreenSettings, SCREENING_TABLE, SCREENING_COLUMNS, load_suggestions
 
 
 class ImageAnnotator:
@@ -14,23 +33,86 @@ class ImageAnnotator:
         self.root.state('zoomed')  # For Windows
 
         self.folder_path = ""
+        self.scanner = None  # Lists the folder on a worker thread
         self.image_list = []
+        self.image_positions = RowIndex()  # Image name -> position in self.image_list
+        self.pending = PendingMask([])  # Per position in self.image_list, True while no field is checked
         self.image_index = 0
-        self.annotations = {}
-        self.fields = []  # List to store added field names
+        self.schema = FieldSchema()  # Labels and shortcut keys of the fields, stored with the project
+        self.schema_store = None
+        self.fields = []  # Columns of the shown fields, in checkbox order
+        self.model = AnnotationModel([FIELDS_IMAGE_COLUMN])  # 'x' or None per image and field
         self.field_vars = {}  # Dictionary to map field names to IntVar for checkboxes
-        self.field_shortcuts = {}  # Dictionary to map field names to shortcut keys
-        self.xlsx_file = ""  # Path to annotations.xlsx
-        self.ws = None  # Worksheet object for writing annotations
-        self.wb = None  # Workbook object
+        self.field_checkboxes = {}  # Field name -> Checkbutton, made once and reused for every image
+        self.mirror = WidgetMirror()  # Sets only the checkboxes whose value changes between images
+        self.xlsx_file = ""  # Path to annotations.xlsx, only imported once and written on export
+        self.storage_backend = "sqlite"  # "sqlite", "parquet", "feather" or "shared"
+        self.store = None  # Live annotation table
+        self.journal = None  # Append-only log of saved rows, folded into the store later
+        self.compaction_interval_ms = 30 * 1000  # Background save of the journal into the store
+
+        # "shared": several annotators on one project, each works through leased batches of images
+        self.claimed = []  # Image names of our current batch
+        self.claim_batch_size = 50
+        self.leased_by_others = {}  # Image name -> annotator
+        self.project_poll_ms = 5 * 1000
+        self.last_lease_renewal = 0.0
+
+        # Pre-screening suggests 'None' or 'Bat' per image, confident empties can be left for last
+        self.screen_settings = ScreenSettings()
+        self.screening_store = None
+        self.prescreener = None
+        self.suggestions = {}  # Image name -> (suggestion, confidence, score)
+        self.skip_confidence = 0.9
+        self.skip_empty_var = tk.BooleanVar()
+
+        # Recordings are played in the window itself, the next ones are converted ahead
+        self.player = AudioPlayer(PlaybackSettings(mode=TIME_EXPANSION, expansion_factor=10, heterodyne_freq=45000))
+        self.playback_mode_var = tk.StringVar(value=self.player.settings.mode)
+        self.prebuffer_ahead = 2
+
+        # Decoded images are prepared on worker threads for the next and previous images
+        self.prefetch_ahead = 4
+        self.prefetch_behind = 2
+        self.prefetcher = ImagePrefetcher(self.load_display_image, ImageCache(max_bytes=256 * 1024 * 1024))
+        self.thumbnails = None  # Resized copies on disk, per folder
+
+        # Spectrograms can be rendered from the .wav recordings instead of read from image files
+        self.from_wav_var = tk.BooleanVar()
+        self.render_from_wav = False  # Taken from the checkbox when a folder is loaded
+        self.spectrogram_settings = SpectrogramSettings(fft_size=512, overlap=0.75, min_freq=10000, max_freq=None)
+
+        # While stepping faster than this a cheap preview is shown, sharpened once the user stops
+        self.fast_preview_interval = 0.25
+        self.sharpen_delay_ms = 150
+        self.last_show_time = 0.0
+
+        # Per-stage timings of the annotation loop, F12 shows them and Shift-F12 writes a trace file
+        self.profiler = Profiler()
+        self.profile_overlay = None
+        self.profile_refresh_ms = 1000
+        self.profile_refresh_id = None
+
+        # Key presses move right away, the image is only rendered once the key events are handled
+        self.navigation = NavigationScheduler(self.root, self.render_image, self.profiler)
+
+        # Zoom with the mouse wheel or Control +/-, drag to pan, Control-0 shows the whole image again
+        self.zoom = None  # TileView of the current image while zoomed in
+        self.zoom_renders = NavigationScheduler(self.root, self.show_zoom)
+        self.pan_start = None
+
+        # While the window is resized the shown image is only rescaled, it is decoded again once the size settles
+        self.shown_image = None  # The PIL image behind the PhotoImage
+        self.resizes = ResizeDebouncer(self.root, self.preview_resize, self.resize_settled)
+        self.root.protocol("WM_DELETE_WINDOW", self.quit)
 
         # Menu
         self.menu = Menu(self.root)
         self.root.config(menu=self.menu)
 
         self.fields_menu = Menu(self.menu)
-        self.menu.add_cascade(label="Add Fields", menu=self.fields_menu)
-        self.fields_menu.add_command(label="Add New Field", command=self.add_field)
+        self.menu.add_cascade(label="Fields", menu=self.fields_menu)
+        self.build_fields_menu()
 
         # Toolbar
         self.toolbar = tk.Frame(self.root)
@@ -45,9 +127,40 @@ class ImageAnnotator:
         self.forward_button = tk.Button(self.toolbar, text=">", command=self.show_next_image)
         self.forward_button.pack(side=tk.LEFT)
 
+        self.next_unannotated_button = tk.Button(self.toolbar, text="Next to annotate",
+                                                 command=self.show_next_unannotated_image)
+        self.next_unannotated_button.pack(side=tk.LEFT)
+
+        self.export_button = tk.Button(self.toolbar, text="Export", command=self.export_now)
+        self.export_button.pack(side=tk.LEFT)
+
+        self.warm_cache_button = tk.Button(self.toolbar, text="Warm cache", command=self.warm_cache)
+        self.warm_cache_button.pack(side=tk.LEFT)
+
+        self.from_wav_checkbox = tk.Checkbutton(self.toolbar, text="From .wav", variable=self.from_wav_var)
+        self.from_wav_checkbox.pack(side=tk.LEFT)
+
+        self.prescreen_button = tk.Button(self.toolbar, text="Pre-screen", command=self.prescreen)
+        self.prescreen_button.pack(side=tk.LEFT)
+
+        self.skip_empty_checkbox = tk.Checkbutton(self.toolbar, text="Skip likely empty", variable=self.skip_empty_var)
+        self.skip_empty_checkbox.pack(side=tk.LEFT)
+
+        self.play_button = tk.Button(self.toolbar, text="Play", command=self.play_current)
+        self.play_button.pack(side=tk.LEFT)
+
+        self.playback_mode_menu = tk.OptionMenu(self.toolbar, self.playback_mode_var,
+                                                NORMAL, TIME_EXPANSION, HETERODYNE, command=self.player.set_mode)
+        self.playback_mode_menu.pack(side=tk.LEFT)
+
         # Image display
         self.image_label = tk.Label(self.root)
         self.image_label.pack()
+        self.image_label.bind("<MouseWheel>", lambda event: self.zoom_image(1 if event.delta > 0 else -1, event))
+        self.image_label.bind("<Button-4>", lambda event: self.zoom_image(1, event))  # Wheel on X11
+        self.image_label.bind("<Button-5>", lambda event: self.zoom_image(-1, event))
+        self.image_label.bind("<ButtonPress-1>", self.start_pan)
+        self.image_label.bind("<B1-Motion>", self.pan_image)
 
         # Progress label
         self.progress_label = tk.Label(self.root, text="0/0", font=("Arial", 12))
@@ -60,62 +173,172 @@ class ImageAnnotator:
         self.root.bind("<Key>", self.toggle_field)
         self.root.bind("<Left>", lambda event: self.show_previous_image())  # Left arrow for previous
         self.root.bind("<Right>", lambda event: self.show_next_image())  # Right arrow for next
+        self.root.bind("<Shift-Left>", lambda event: self.show_previous_unannotated_image())
+        self.root.bind("<Shift-Right>", lambda event: self.show_next_unannotated_image())
+        self.root.bind("<F12>", lambda event: self.toggle_profile_overlay())
+        self.root.bind("<Shift-F12>", lambda event: self.export_profile())
+        self.root.bind("<Control-plus>", lambda event: self.zoom_image(1))
+        self.root.bind("<Control-minus>", lambda event: self.zoom_image(-1))
+        self.root.bind("<Control-0>", lambda event: self.reset_zoom())
+
+        self.root.after(self.compaction_interval_ms, self.periodic_save)
 
     def load_folder(self):
-        self.folder_path = filedialog.askdirectory()
-        if not self.folder_path:
+        folder_path = filedialog.askdirectory()
+        if not folder_path:
             return
 
-        self.image_list = [f for f in os.listdir(self.folder_path) if
-                           f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif'))]
-        if not self.image_list:
-            messagebox.showerror("Error", "No images found in the selected folder.")
-            return
+        self.navigation.cancel()
+        self.close_journal()
+        self.folder_path = folder_path
+        self.image_list = []
+        self.render_from_wav = self.from_wav_var.get()
+        if self.render_from_wav:
+            variant = "spectrogram-" + self.spectrogram_settings.key()
+            extensions = ('.wav',)
+        else:
+            variant = "lanczos"
+            extensions = ('.png', '.jpg', '.jpeg', '.gif')
+        self.thumbnails = ThumbnailCache.for_folder(self.folder_path, variant=variant)
+
+        # Reopened projects start from the manifest, new folders from the first batch of the scan
+        self.scanner = FolderScanner(self.folder_path, extensions)
+        cached_names = self.scanner.cached_names()
+        self.scanner.start()
+        if cached_names:
+            self.open_images(cached_names)
+        self.poll_scanner()
+
+    def poll_scanner(self):
+        scanner = self.scanner
+        for image_names in scanner.take_batches():
+            if scanner is not self.scanner:
+                return  # Another folder was loaded meanwhile
+            if self.journal is None:
+                self.open_images(image_names)
+            else:
+                self.add_images(image_names)
+
+        if not scanner.done():
+            self.root.after(50, self.poll_scanner)
+        elif scanner.error is not None:
+            messagebox.showerror("Error", f"Could not read the selected folder: {scanner.error}")
+        elif scanner is self.scanner:
+            result = scanner.result
+            if not result.names:
+                messagebox.showerror("Error", "No images found in the selected folder.")
+            elif result.removed and self.journal is not None:
+                self.remove_images(result.removed)
+
+    def add_images(self, image_names):
+        for image in image_names:
+            self.image_list.append(image)
+            self.image_positions.add(image)
+        self.model.add_images(image_names)
+        self.pending.extend([not self.is_annotated(image) for image in image_names])
+        self.defer_likely_empty()
+        self.update_progress_label()
+        self.prefetch_neighbours()
+
+    def remove_images(self, image_names):
+        # Annotations of removed images are kept so they are still exported
+        self.save_annotations()
+        removed = set(image_names)
+        current_image = self.image_list[self.image_index] if self.image_index < len(self.image_list) else None
+        self.image_list = [image for image in self.image_list if image not in removed]
+        self.image_positions = RowIndex(self.image_list)
+        self.pending = PendingMask([not self.is_annotated(image) for image in self.image_list])
+        self.defer_likely_empty()
+        if current_image in self.image_positions:
+            self.image_index = self.image_positions[current_image]
+            self.update_progress_label()
+        else:
+            self.image_index = min(self.image_index, max(len(self.image_list) - 1, 0))
+            self.update_progress_label()
+            self.show_image()
+
+    def open_images(self, image_list):
+        self.image_list = list(image_list)
+        self.image_positions = RowIndex(self.image_list)
 
-        # Initialize the path for the Excel file
+        # Initialize the path for the Excel file and the store
         self.xlsx_file = os.path.join(self.folder_path, 'annotations.xlsx')
+        self.store = open_store(self.folder_path, self.storage_backend)
 
-        # Check if any fields have been added
-        if not self.fields:  # Proceed only if no fields have been added
-            if os.path.exists(self.xlsx_file):
-                self.read_existing_annotations()
-            else:
-                # Initialize annotations for images based on fields
-                self.annotations = {image: {field: None for field in self.fields} for image in self.image_list}
-                self.create_annotation_file()  # Call without arguments
-                self.image_index = 0  # Start at the first image if there's no existing file
+        # Fields added before the first folder was loaded are added to the project, not written over it
+        added_fields = self.schema if self.schema_store is None else FieldSchema()
+        self.schema_store = open_store(self.folder_path, self.storage_backend, table=SCHEMA_TABLE)
+        if self.store.exists() or os.path.exists(self.xlsx_file):
+            self.read_existing_annotations()
         else:
-            # If fields have been added, initialize annotations without reading the existing file
-            self.annotations = {image: {field: None for field in self.fields} for image in self.image_list}
-            self.create_annotation_file()  # Call without arguments
-            self.image_index = 0  # Start at the first image
-
+            self.schema = FieldSchema()
+            self.new_model()
+            self.image_index = 0  # Start at the first image if there's no existing file
+        for column in added_fields.fields:
+            self.add_field_column(added_fields.label(column), added_fields.shortcuts.get(column))
+        self.schema_changed()
+
+        self.open_journal()
+        self.pending = PendingMask([not self.is_annotated(image) for image in self.image_list])
+        self.screening_store = open_store(self.folder_path, self.storage_backend, table=SCREENING_TABLE)
+        self.suggestions = load_suggestions(self.screening_store)
+        self.defer_likely_empty()
+        self.claimed = []
+        if self.image_index >= len(self.image_list):
+            self.image_index = self.get_first_unannotated_index()  # Last image was the last annotated one
+        if self.storage_backend == "shared":
+            self.poll_project(self.store)  # Shows the progress of the current image, so after the index is valid
         self.update_progress_label()
         self.show_image()
 
-    def read_existing_annotations(self):
-        self.wb = openpyxl.load_workbook(self.xlsx_file)
-        self.ws = self.wb.active
+    def open_journal(self):
+        self.journal = AnnotationJournal(os.path.join(self.folder_path, self.store.journal_name))
 
-        # Read field names from the header row (assuming the first row contains field names)
-        headers = [cell.value for cell in self.ws[1]]
-        self.fields = headers[1:]  # Ignore the "Image" column
+        # Replay changes that were not yet saved to the store
+        for image, values in self.journal.replay().items():
+            row = self.model.row_of(image)
+            if row is not None:
+                self.model.update(row, values, dirty=False)
 
-        # Ask for shortcut assignments for each field
-        for field in self.fields:
-            shortcut = simpledialog.askstring("Assign Shortcut", f"Assign a shortcut for '{field}':")
-            if shortcut and len(shortcut) == 1:
-                self.field_shortcuts[field] = shortcut
+    def new_model(self):
+        self.fields = self.schema.fields
+        self.model = AnnotationModel([FIELDS_IMAGE_COLUMN] + self.fields, kinds=self.field_kinds(self.fields))
+        self.model.add_images(self.image_list)
 
-        # Rebuild annotations dictionary based on existing data
-        self.annotations = {}
+    @staticmethod
+    def field_kinds(columns):
+        # Every field is 'x' or empty, stored as one bit per image
+        return {column: 'marker' for column in columns}
+
+    def read_existing_annotations(self):
+        table = self.store.load()
+        if table is None and os.path.exists(self.xlsx_file):
+            # First time this folder is opened with a store, import annotations.xlsx once
+            table = import_xlsx(self.xlsx_file)
+            self.store.write(*table)
+        headers, rows = table if table is not None else ([FIELDS_IMAGE_COLUMN], [])
+
+        # The fields and their shortcuts were stored with the project, only tables from before that ask for them
+        schema_table = self.schema_store.load()
+        self.schema = FieldSchema.from_table(schema_table, headers[1:])
+        self.fields = self.schema.fields
+        if schema_table is None:
+            for field in self.fields:
+                shortcut = simpledialog.askstring("Assign Shortcut", f"Assign a shortcut for '{field}':")
+                self.schema.assign(field, shortcut)
+
+        # Rebuild the annotation model based on existing data, removed fields are kept so their values stay
+        marker = lambda value: MARKER if value == MARKER else None
+        self.model = AnnotationModel.from_table(headers, rows, converters={column: marker for column in headers[1:]},
+                                                kinds=self.field_kinds(headers[1:]))
+        for field in self.fields:
+            self.model.add_column(field, kind='marker')  # Fields nothing was saved for yet
         last_annotated_image = None  # To track the last annotated image
 
-        for row in self.ws.iter_rows(min_row=2, values_only=True):
+        shown = [headers.index(field) for field in self.fields if field in headers]
+        for row in rows:
             image = row[0]
-            field_values = row[1:]
-            self.annotations[image] = {self.fields[i]: ('x' if field_values[i] == 'x' else None) for i in
-                                       range(len(self.fields))}
+            field_values = [row[i] for i in shown]
 
             # Check if the current image has any annotations
             if any(value == 'x' for value in field_values):
@@ -124,9 +347,15 @@ class ImageAnnotator:
 
         print(f"Last Annotated Image: {last_annotated_image}")  # Debugging line
 
+        # Images added to the folder since the file was written get empty rows, rows of
+        # images that disappeared are kept so their annotations are not lost on export
+        added = self.model.add_images(self.image_list)
+        if added:
+            print(f"{len(added)} images without annotations yet")
+
         # Set the image index to the last annotated image if found
-        if last_annotated_image and last_annotated_image in self.image_list:
-            self.image_index = self.image_list.index(last_annotated_image) + 1
+        if last_annotated_image and last_annotated_image in self.image_positions:
+            self.image_index = self.image_positions[last_annotated_image] + 1
             print(
                 f"Starting at Last Annotated Image: {last_annotated_image} (Index: {self.image_index})")  # Debugging line
         else:
@@ -134,136 +363,538 @@ class ImageAnnotator:
             print(
                 f"No last annotated image found. Starting at First Unannotated Image (Index: {self.image_index})")  # Debugging line
 
-    def get_first_unannotated_index(self):
-        for index, image in enumerate(self.image_list):
-            # Check if all fields for the image are annotated
-            if any(value is None for value in self.annotations.get(image, {}).values()):
-                return index
-        return 0  # If all images are annotated, start at the first image
+    def is_annotated(self, image):
+        row = self.model.row_of(image)
+        return row is not None and any(self.model.get(row, field) == MARKER for field in self.fields)
 
-    def create_annotation_file(self):
-        if os.path.exists(self.xlsx_file):
-            # Ask for confirmation to overwrite
-            if not messagebox.askyesno("Warning", "The annotation file already exists. Do you want to overwrite it?"):
-                return  # Exit if user chooses not to overwrite
+    def get_first_unannotated_index(self):
+        index = self.pending.first_pending(defer=self.skip_empty_var.get())
+        return index if index is not None else 0  # If all images are annotated, start at the first image
 
-            os.remove(self.xlsx_file)  # Remove the existing file if the user wants to overwrite
+    def defer_likely_empty(self):
+        # Images the pre-screener is confident are empty come last in the next-to-annotate order
+        self.pending.set_deferred([self.is_likely_empty(image) for image in self.image_list])
 
-        self.wb = openpyxl.Workbook()
-        self.ws = self.wb.active
-        headers = ["Image"] + self.fields
-        self.ws.append(headers)
+    def is_likely_empty(self, image):
+        suggestion, confidence, _ = self.suggestions.get(image, (None, 0.0, 0.0))
+        return suggestion == 'None' and confidence >= self.skip_confidence
 
-        # Populate the "Image" column with all filenames
-        for image in self.image_list:
-            row = [image] + [None] * len(self.fields)  # Fill with None for fields
-            self.ws.append(row)
+    def prescreen(self):
+        # Screens the images without a suggestion yet on a process pool, results arrive in poll_prescreen
+        if self.screening_store is None or self.prescreener is not None:
+            return
+        images = [image for image in self.image_list if image not in self.suggestions]
+        self.prescreener = Prescreener(self.folder_path, images, self.screen_settings)
+        self.prescreener.start()
+        self.poll_prescreen(self.prescreener)
+
+    def poll_prescreen(self, prescreener):
+        if prescreener is not self.prescreener:
+            return  # Another folder was loaded meanwhile
+        results = prescreener.take_results()
+        if results:
+            for image, suggestion, confidence, score in results:
+                self.suggestions[image] = (suggestion, confidence, score)
+            if not self.screening_store.incremental:
+                results = [[image, *values] for image, values in self.suggestions.items()]
+            self.screening_store.write(SCREENING_COLUMNS, results)
+            self.defer_likely_empty()
+            self.update_progress_label()
 
-        self.wb.save(self.xlsx_file)
+        if prescreener.done():
+            print(f"Pre-screened {prescreener.screened} images, {prescreener.failed} failed, "
+                  f"{self.pending.deferred_count()} likely empty")
+            self.prescreener = None
+        else:
+            self.root.after(200, self.poll_prescreen, prescreener)
 
     def show_image(self):
+        self.update_checkboxes()
+        self.render_image()
+
+    @profiled("render")
+    def render_image(self):
         if self.image_index < 0 or self.image_index >= len(self.image_list):
             return
 
         image_path = os.path.join(self.folder_path, self.image_list[self.image_index])
-        image = Image.open(image_path)
+        self.player.stop()  # The recording of the previous image
+        self.close_zoom()
 
-        # Get window dimensions and apply a 10-pixel margin
-        max_width = self.root.winfo_width() - 20
-        max_height = self.root.winfo_height() - 20
+        if self.prefetcher.target_size is None:
+            self.prefetcher.set_target_size(self.display_size(self.window_size()))  # Before the first resize settled
 
-        # Determine scale factor to fit the image within the target dimensions
-        scale_factor = min(max_width / image.width, max_height / image.height)
+        now = time.perf_counter()
+        navigating_quickly = now - self.last_show_time < self.fast_preview_interval
+        self.last_show_time = now
 
-        # Resize the image while maintaining the aspect ratio
-        new_width = int(image.width * scale_factor)
-        new_height = int(image.height * scale_factor)
-        resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        resized_image = self.prefetcher.peek(image_path)
+        needs_sharpening = resized_image is None and navigating_quickly
+        if resized_image is None:
+            with self.profiler.stage("wait_for_decode"):
+                resized_image = self.prefetcher.get(image_path, FAST if needs_sharpening else HIGH)
+        self.display_image(resized_image)
 
-        # Resize the image to fit within the adjusted dimensions
-        # image.thumbnail((max_width, max_height))
-        photo = ImageTk.PhotoImage(resized_image)
+        # Change title to image name
+        self.root.title(os.path.basename(image_path))
+        self.prefetch_neighbours(include_current=needs_sharpening)
+        if needs_sharpening:
+            self.root.after(self.sharpen_delay_ms, self.sharpen_image, self.image_index)
+
+    @profiled("photo_image")
+    def display_image(self, image):
+        self.shown_image = image
+        photo = ImageTk.PhotoImage(image)
         self.image_label.configure(image=photo)
         self.image_label.image = photo
 
-        # Change title to image name
-        self.root.title(os.path.basename(image_path))
-        self.update_checkboxes()
-        self.image_label.update_idletasks()  # Ensure geometry is updated
+    def window_size(self):
+        return self.root.winfo_width(), self.root.winfo_height()
+
+    def display_size(self, window_size):
+        # The window with a 10-pixel margin
+        return window_size[0] - 20, window_size[1] - 20
+
+    def preview_resize(self, window_size):
+        # Rescale what is decoded already, nothing is read from disk until the size settles
+        if self.shown_image is None or self.zoom is not None:
+            return
+        with self.profiler.stage("resize_preview"):
+            photo = ImageTk.PhotoImage(rescale_image(self.shown_image, self.display_size(window_size)))
+        self.image_label.configure(image=photo)
+        self.image_label.image = photo
+
+    def resize_settled(self, window_size):
+        # Everything prefetched so far has the old size, decode the current image again at the new one
+        size = self.display_size(window_size)
+        if size == self.prefetcher.target_size:
+            return
+        self.prefetcher.set_target_size(size)
+        self.close_zoom()
+        self.navigation.request_render()
 
+    def sharpen_image(self, image_index):
+        # Swap the fast preview for the full quality image once a worker has it ready
+        if image_index != self.image_index or image_index >= len(self.image_list) or self.zoom is not None:
+            return
+        image = self.prefetcher.peek(os.path.join(self.folder_path, self.image_list[image_index]))
+        if image is None:
+            self.root.after(50, self.sharpen_image, image_index)
+        else:
+            self.display_image(image)
+
+    def zoom_image(self, steps, event=None):
+        # The first step in opens the current image as tiles, zooming happens around the pointer
+        if not 0 <= self.image_index < len(self.image_list):
+            return
+        if self.zoom is None:
+            if steps <= 0 or getattr(self.image_label, "image", None) is None:
+                return
+            image_path = os.path.join(self.folder_path, self.image_list[self.image_index])
+            try:
+                source = WavSource(image_path, self.spectrogram_settings) if self.render_from_wav \
+                    else ImageSource(image_path)
+            except (OSError, ValueError) as error:
+                print(f"Unable to zoom into {image_path}: {error}")
+                return
+            photo = self.image_label.image
+            self.zoom = TileView(source, (photo.width(), photo.height()))  # Where the image is shown now
+
+        anchor = None
+        if event is not None:
+            # The label centres the image
+            anchor = (event.x - (self.image_label.winfo_width() - self.zoom.viewport[0]) / 2,
+                      event.y - (self.image_label.winfo_height() - self.zoom.viewport[1]) / 2)
+        self.zoom.zoom(steps, anchor)
+        self.zoom_renders.request_render()
+
+    def start_pan(self, event):
+        self.pan_start = (event.x, event.y)
+
+    def pan_image(self, event):
+        if self.zoom is None or self.pan_start is None:
+            return
+        self.zoom.pan(event.x - self.pan_start[0], event.y - self.pan_start[1])
+        self.pan_start = (event.x, event.y)
+        self.zoom_renders.request_render()
+
+    def show_zoom(self):
+        # Only the visible tiles are rendered, panning reuses the ones rendered before
+        if self.zoom is None:
+            return
+        with self.profiler.stage("zoom"):
+            image = self.zoom.render()
+        self.display_image(image)
+
+    def reset_zoom(self):
+        if self.zoom is not None:
+            self.close_zoom()
+            self.navigation.request_render()
+
+    def close_zoom(self):
+        if self.zoom is not None:
+            self.zoom_renders.cancel()
+            self.zoom.close()
+            self.zoom = None
+
+    @profiled("decode")
+    def load_display_image(self, image_path, size, quality):
+        # Runs on the prefetch worker threads, so no Tk calls in here
+        thumbnails = self.thumbnails
+        render = self.render_function()
+        if thumbnails is None:
+            return render(image_path, size, quality)
+        return thumbnails.get_or_render(image_path, size, render, quality)
+
+    def render_function(self):
+        # Module level functions only, the warm pass sends them to worker processes
+        if self.render_from_wav:
+            return partial(render_spectrogram, settings=self.spectrogram_settings)
+        return fit_image
+
+    def warm_cache(self):
+        # Renders the resized copy of every image on a process pool, without blocking the window
+        if self.thumbnails is None or self.prefetcher.target_size is None:
+            return
+        thumbnails = self.thumbnails
+        size = self.prefetcher.target_size
+        image_paths = [os.path.join(self.folder_path, image) for image in self.image_list]
+        render = self.render_function()
+
+        def run():
+            rendered = thumbnails.warm(image_paths, size, render)
+            print(f"Warm cache: rendered {rendered} of {len(image_paths)} images")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def prefetch_neighbours(self, include_current=False):
+        # No wrap-around here, navigation stops at the first and last image
+        current = [self.image_index] if include_current and self.image_index < len(self.image_list) else []
+        ahead = range(self.image_index + 1, min(self.image_index + 1 + self.prefetch_ahead, len(self.image_list)))
+        behind = range(self.image_index - 1, max(self.image_index - 1 - self.prefetch_behind, -1), -1)
+        indices = current + list(ahead) + list(behind)
+        self.prefetcher.schedule([os.path.join(self.folder_path, self.image_list[i]) for i in indices])
+
+        # The current recording first, it is the one most likely to be played
+        upcoming = range(self.image_index, min(self.image_index + 1 + self.prebuffer_ahead, len(self.image_list)))
+        self.player.prebuffer([self.wav_path(i) for i in upcoming])
+
+    def wav_path(self, index):
+        return wav_path_for_image(os.path.join(self.folder_path, self.image_list[index]))
+
+    def play_current(self):
+        if 0 <= self.image_index < len(self.image_list):
+            self.player.play(self.wav_path(self.image_index))  # Streams on a background thread
+
+    @profiled("update_checkboxes")
     def update_checkboxes(self):
-        # Clear previous checkboxes
-        for widget in self.checkboxes_frame.winfo_children():
-            widget.destroy()
+        # Checkboxes of fields that are gone, e.g. after loading a folder with other fields
+        for field in [field for field in self.field_checkboxes if field not in self.fields]:
+            self.field_checkboxes.pop(field).destroy()
+            del self.field_vars[field]
+            self.mirror.unbind(field)
 
-        # Show all fields as checkboxes
+        # One checkbox per field, made once
         for field in self.fields:
+            if field in self.field_checkboxes:
+                continue
             var = tk.IntVar()
             self.field_vars[field] = var  # Store IntVar for the field
-            checkbox = tk.Checkbutton(self.checkboxes_frame, text=field, variable=var,
+            checkbox = tk.Checkbutton(self.checkboxes_frame, text=self.schema.label(field), variable=var,
                                       command=lambda field=field, var=var: self.update_annotation(field, var))
             checkbox.pack(anchor='w')
+            self.field_checkboxes[field] = checkbox
+            self.mirror.bind(field, lambda value, var=var: var.set(1 if value == MARKER else 0))
 
-            # Restore state of checkbox if it exists in annotations
-            if self.image_list and self.image_index < len(self.image_list):
-                if self.annotations.get(self.image_list[self.image_index], {}).get(field):
-                    var.set(1)
+        # Restore state of the checkboxes from the annotations of the current image
+        if self.image_list and self.image_index < len(self.image_list):
+            row = self.model.row_of(self.image_list[self.image_index])
+            if row is not None:
+                self.mirror.show(self.model.record(row))
 
     def update_annotation(self, field, var):
-        checked = var.get()
-        self.annotations[self.image_list[self.image_index]][field] = 'x' if checked else None
+        value = MARKER if var.get() else None
+        image = self.image_list[self.image_index]
+        self.model.set(self.model.row_of(image), field, value)  # Marks the field dirty
+        self.mirror.shown(field, value)  # The checkbox was clicked, it shows the value already
+        self.pending.set_annotated(self.image_index, self.is_annotated(image))
+        self.update_progress_label()
 
     def show_next_image(self):
         if self.image_index < len(self.image_list) - 1:
-            self.save_annotations()  # Save current annotations before moving
-            self.image_index += 1
-            self.update_progress_label()
-            self.show_image()
+            self.go_to_image(self.image_index + 1)
 
     def show_previous_image(self):
         if self.image_index > 0:
-            self.save_annotations()  # Save current annotations before moving
-            self.image_index -= 1
-            self.update_progress_label()
-            self.show_image()
+            self.go_to_image(self.image_index - 1)
+
+    def show_next_unannotated_image(self):
+        if self.image_list and self.storage_backend == "shared":
+            index = self.next_claimed_image()
+            if index is not None:
+                self.go_to_image(index)
+        elif self.image_list:
+            index = self.pending.next_pending((self.image_index + 1) % len(self.image_list),
+                                              defer=self.skip_empty_var.get())
+            if index is not None:
+                self.go_to_image(index)
+
+    def show_previous_unannotated_image(self):
+        if self.image_list:
+            index = self.pending.previous_pending((self.image_index - 1) % len(self.image_list),
+                                                  defer=self.skip_empty_var.get())
+            if index is not None:
+                self.go_to_image(index)
+
+    def claim_batch(self):
+        # Lease the next pending images no other annotator holds, starting after the current one
+        pending = np.flatnonzero(self.pending.pending)
+        pending = np.roll(pending, -int(np.searchsorted(pending, self.image_index + 1)))
+        if self.skip_empty_var.get():
+            deferred = self.pending.deferred[pending]
+            pending = np.concatenate([pending[~deferred], pending[deferred]])
+
+        window = self.claim_batch_size * 4
+        for offset in range(0, len(pending), window):
+            candidates = [self.image_list[i] for i in pending[offset:offset + window]]
+            self.claimed = self.store.claim(candidates, self.claim_batch_size)
+            if self.claimed:
+                return
+        self.claimed = []
+
+    def next_claimed_image(self):
+        for attempt in range(2):
+            while self.claimed:
+                image = self.claimed[0]
+                position = self.image_positions.get(image)
+                if position is not None and self.pending.is_pending(position):
+                    return position
+                self.claimed.pop(0)  # Annotated or removed meanwhile
+            if attempt == 0:
+                self.claim_batch()
+        return None
+
+    def poll_project(self, store):
+        # Shared projects: keep our leases, pull what the others saved and report rows we could not save
+        if store is not self.store:
+            return  # Another folder was loaded meanwhile
+
+        if time.monotonic() - self.last_lease_renewal > store.lease_seconds / 3:
+            store.renew()
+            self.last_lease_renewal = time.monotonic()
+
+        # The image on screen may still be edited here, the store holds its change back until we move on
+        current_image = self.image_list[self.image_index] if self.image_index < len(self.image_list) else None
+        columns, rows = store.changes_since(on_screen=[current_image])
+        for row in rows:
+            image = row[0]
+            index = self.model.row_of(image)
+            if index is None:
+                continue
+            values = dict(zip(columns[1:], row[1:]))
+            self.model.update(index, {field: values.get(field) for field in self.fields}, dirty=False)
+            position = self.image_positions.get(image)
+            if position is not None:
+                self.pending.set_annotated(position, self.is_annotated(image))
+        if rows:
+            print(f"{len(rows)} annotations from other annotators")
+        for image, holder in store.take_conflicts():
+            print(f"Not saved: {image} was changed by {holder or 'another annotator'} meanwhile, "
+                  f"their annotation is kept")
+
+        self.leased_by_others = store.leases()
+        self.update_progress_label()
+        self.root.after(self.project_poll_ms, self.poll_project, store)
 
+    def go_to_image(self, index):
+        # Annotations move along with every key press, rendering waits until the key events are handled
+        self.save_annotations()  # Save current annotations before moving
+        self.image_index = index
+        self.update_progress_label()
+        self.update_checkboxes()
+        self.navigation.request_render()
+
+    @profiled("save_row")
     def save_annotations(self):
-        # Get the row index for the current image (first row is header)
-        for index, row in enumerate(self.ws.iter_rows(min_row=2, values_only=False)):
-            if row[0].value == self.image_list[self.image_index]:  # Check if the image matches
-                # Update the current row with the annotations
-                for i, field in enumerate(self.fields):
-                    row[i + 1].value = self.annotations[self.image_list[self.image_index]][field]
-                self.wb.save(self.xlsx_file)  # Save the workbook
-                break
+        # Only edited values are written, annotations.xlsx is rebuilt from the journal later
+        if self.journal is None:
+            return
+        for image, values in self.model.take_dirty():
+            self.journal.append(image, values)
+
+    def unsaved_count(self):
+        # Images with edits the store does not have yet, whether they are in the journal or not
+        if self.journal is None:
+            return 0
+        return len(self.journal.unsaved_images() | self.model.dirty_images())
+
+    def export_now(self):
+        if self.journal is None:
+            return
+        self.save_annotations()
+        self.flush_journal()
+        # The shown fields under their current names
+        _, rows = self.model.table(columns=self.fields)
+        export_xlsx(self.xlsx_file, [FIELDS_IMAGE_COLUMN] + [self.schema.label(field) for field in self.fields], rows)
+
+    @profiled("save")
+    def flush_journal(self, background=False):
+        # Fold the journal into the store, incremental stores only get the journaled rows
+        if self.journal is None:
+            return
+        store = self.store
+        snapshot = lambda changes: self.annotation_rows(changes if store.incremental else None)
+        self.journal.compact(snapshot, lambda table: store.write(*table), background)
+
+    def annotation_rows(self, images=None):
+        # (columns, rows) for the store, either for the given images or for all of them
+        return self.model.table(images)
+
+    def periodic_save(self):
+        self.flush_journal(background=True)
+        self.root.after(self.compaction_interval_ms, self.periodic_save)
+
+    def close_journal(self):
+        if self.journal is None:
+            return
+        self.save_annotations()
+        self.flush_journal()
+        self.journal.close()
+        self.journal = None
+        self.store.close()
+        if self.prescreener is not None:
+            self.prescreener.stop()
+            self.prescreener = None
+        self.screening_store.close()
+        self.schema_store.close()
+
+    def build_fields_menu(self):
+        # A submenu per field to rename it, remove it or give it another key
+        self.fields_menu.delete(0, tk.END)
+        self.fields_menu.add_command(label="Add New Field", command=self.add_field)
+        if self.fields:
+            self.fields_menu.add_separator()
+        for field in self.fields:
+            field_menu = Menu(self.fields_menu, tearoff=0)
+            field_menu.add_command(label="Rename...", command=lambda field=field: self.rename_field(field))
+            field_menu.add_command(label="Assign Shortcut...", command=lambda field=field: self.ask_shortcut(field))
+            field_menu.add_command(label="Remove", command=lambda field=field: self.remove_field(field))
+            shortcut = self.schema.shortcuts.get(field)
+            label = self.schema.label(field) + (f" ({shortcut})" if shortcut else "")
+            self.fields_menu.add_cascade(label=label, menu=field_menu)
 
     def add_field(self):
         field_name = simpledialog.askstring("Add Field", "Enter checkbox name:")
-        if field_name and field_name not in self.fields:
-            self.fields.append(field_name)
-            self.update_checkboxes()  # Immediately update checkboxes on screen
-            # Re-create annotation file headers if folder is loaded
-            if self.folder_path:
-                self.create_annotation_file(self.folder_path)
-
-            # Ask for shortcut assignment
-            shortcut = simpledialog.askstring("Assign Shortcut", f"Assign a shortcut for '{field_name}':")
-            if shortcut and len(shortcut) == 1:
-                self.field_shortcuts[field_name] = shortcut
+        if not field_name:
+            return
+        if self.schema.column_of(field_name) is not None:
+            messagebox.showerror("Error", f"There is a field '{field_name}' already.")
+            return
+        shortcut = simpledialog.askstring("Assign Shortcut", f"Assign a shortcut for '{field_name}':")
+        self.add_field_column(field_name, shortcut)
+        self.schema_changed()
+
+    def add_field_column(self, label, shortcut=None):
+        # A new column, existing rows are empty in it until they are annotated
+        column = self.schema.add(label, shortcut)
+        if column is not None:
+            self.model.add_column(column, kind='marker')
+        return column
+
+    def rename_field(self, field):
+        label = simpledialog.askstring("Rename Field", f"New name for '{self.schema.label(field)}':")
+        if not label:
+            return
+        if not self.schema.rename(field, label):
+            messagebox.showerror("Error", f"There is a field '{label}' already.")
+            return
+        self.schema_changed()
+
+    def remove_field(self, field):
+        if not messagebox.askyesno("Remove Field", f"Remove '{self.schema.label(field)}'? Its annotations are kept "
+                                                   f"and come back when a field with this name is added again."):
+            return
+        self.schema.remove(field)
+        self.schema_changed()
+
+    def ask_shortcut(self, field):
+        shortcut = simpledialog.askstring("Assign Shortcut", f"Assign a shortcut for '{self.schema.label(field)}':")
+        if shortcut:
+            self.schema.assign(field, shortcut)
+            self.schema_changed()
+
+    def schema_changed(self):
+        # Fields were added, renamed or removed: store the schema and show the fields as they are now
+        fields_before = self.fields
+        self.fields = self.schema.fields
+        if self.schema_store is not None:
+            self.schema_store.write(*self.schema.table())
+        self.build_fields_menu()
+        self.update_checkboxes()
+        for field, checkbox in self.field_checkboxes.items():
+            checkbox.config(text=self.schema.label(field))
+        if set(self.fields) != set(fields_before) and self.journal is not None:  # Not while a folder is opened
+            # Whether an image is annotated depends on the fields that are shown
+            for position, image in enumerate(self.image_list):
+                self.pending.set_annotated(position, self.is_annotated(image))
+            self.update_progress_label()
 
     def toggle_field(self, event):
-        field_name = next((name for name, shortcut in self.field_shortcuts.items() if shortcut == event.char), None)
+        field_name = self.schema.keys.get(event.char)  # Built once per assignment, one lookup per key press
         if field_name:
             var = self.field_vars[field_name]  # Get the IntVar for the field
             var.set(1 - var.get())  # Toggle checkbox state
             self.update_annotation(field_name, var)
 
+    def quit(self):
+        self.navigation.cancel()
+        self.resizes.cancel()
+        self.close_zoom()
+        self.close_journal()
+        self.prefetcher.stop()
+        self.player.close()
+        print(f"Image cache: {self.prefetcher.stats()}")
+        print(f"Navigation: {self.navigation.stats()}")
+        print(self.profiler.format_summary())
+        self.root.destroy()
+
+    def toggle_profile_overlay(self):
+        if self.profile_overlay is not None:
+            self.root.after_cancel(self.profile_refresh_id)
+            self.profile_overlay.destroy()
+            self.profile_overlay = None
+            return
+        self.profile_overlay = tk.Label(self.root, justify="left", font=("Courier", 9), bg="black", fg="white")
+        self.profile_overlay.place(relx=1.0, rely=1.0, anchor="se")
+        self.refresh_profile_overlay()
+
+    def refresh_profile_overlay(self):
+        # Milliseconds per stage over the recent calls
+        self.profile_overlay.config(text=self.profiler.format_summary())
+        self.profile_refresh_id = self.root.after(self.profile_refresh_ms, self.refresh_profile_overlay)
+
+    def export_profile(self):
+        # The same trace as CSV for spreadsheets and as JSON with the percentiles
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.folder_path or os.getcwd(), f"speedybat_trace_{stamp}")
+        self.profiler.export(path + ".csv")
+        events = self.profiler.export(path + ".json")
+        print(f"Profile: {events} events written to {path}.csv and .json")
+
     def update_progress_label(self):
         """Update the progress label with the current image index."""
         if self.image_list:
-            self.progress_label.config(
-                text=f"{self.image_index + 1}/{len(self.image_list)}"
-            )
+            text = f"{self.image_index + 1}/{len(self.image_list)} ({self.pending.pending_count} to annotate)"
+            unsaved = self.unsaved_count()
+            if unsaved:
+                text += f"\n{unsaved} not saved yet"
+            suggestion = self.suggestions.get(self.image_list[self.image_index])
+            if suggestion is not None:
+                text += f"\nSuggested: {suggestion[0]} ({suggestion[1]:.0%})"
+            holder = self.leased_by_others.get(self.image_list[self.image_index])
+            if holder is not None:
+                text += f"\nClaimed by {holder}"
+            self.progress_label.config(text=text)
         else:
             self.progress_label.config(text="0/0")
 
@@ -0,0 +1,47 @@
+import sys
+
+
+class RowIndex:
+    """Constant-time lookup from image name to its row in an annotation table.
+
+    Rows are never renumbered: images that disappeared from the folder keep their row
+    so their annotations survive an export, and new images are appended at the end.
+    Names are interned, so the folder listing and the index share one copy of each.
+    """
+
+    def __init__(self, names=()):
+        self.names = []
+        self._rows = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def __getitem__(self, name):
+        return self._rows[name]
+
+    def get(self, name, default=None):
+        return self._rows.get(name, default)
+
+    def add(self, name):
+        row = self._rows.get(name)
+        if row is None:
+            name = sys.intern(name)
+            row = len(self.names)
+            self._rows[name] = row
+            self.names.append(name)
+        return row
+
+    def reconcile(self, folder_names):
+        """Add rows for new images, returns (added, missing) name lists."""
+        folder_names = list(folder_names)
+        present = set(folder_names)
+        missing = [name for name in self.names if name not in present]
+        added = [name for name in folder_names if name not in self._rows]
+        for name in added:
+            self.add(name)
+        return added, missing
@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+import time
+
+
+def pending_changes(folder):
+    """Latest values per image of every journal in a folder, read without opening them for writing.
+    Shared projects keep one journal per machine, the most recently written one is applied last."""
+    paths = [os.path.join(folder, name) for name in os.listdir(folder)
+             if name.startswith("annotations.") and name.endswith(".journal")]
+    changes = {}
+    for path in sorted(paths, key=os.path.getmtime):
+        journal = AnnotationJournal._read(path + ".compacting", {})
+        for image, values in AnnotationJournal._read(path, journal).items():
+            changes.setdefault(image, {}).update(values)
+    return changes
+
+
+class AnnotationJournal:
+    """Append-only JSONL log of annotation row changes.
+
+    Every saved row is one line, so a save costs the same for 10 or 100k images.
+    The journal is folded into the annotation store by `compact`, which rotates
+    the log into a `.compacting` segment first so edits made while the export is
+    running are never lost. `replay` returns the latest values per image, including
+    anything left behind by a crash or an interrupted compaction.
+    """
+
+    def __init__(self, path, fsync_every=20, fsync_interval=2.0):
+        self.path = path
+        self.compacting_path = path + ".compacting"
+        self.fsync_every = fsync_every  # Force to disk after this many unsynced rows ...
+        self.fsync_interval = fsync_interval  # ... or after this many seconds
+
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._compaction = None  # Thread of a running background compaction
+        self._unsaved = set()  # Images in the journal that the store does not have yet
+        self._compacting = set()  # Images of the segment that is being written to the store
+
+    def append(self, image, values):
+        line = json.dumps({"image": image, "values": values}, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._unsaved.add(image)
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def append_many(self, changes):
+        """One write and one fsync for a batch of (image, values), e.g. a grid selection."""
+        lines = [json.dumps({"image": image, "values": values}, ensure_ascii=False) + "\n"
+                 for image, values in changes]
+        if not lines:
+            return
+        with self._lock:
+            self._file.write("".join(lines))
+            self._unsaved.update(image for image, _ in changes)
+            self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def has_entries(self):
+        with self._lock:
+            self._file.flush()
+            return os.path.getsize(self.path) > 0 or os.path.exists(self.compacting_path)
+
+    def replay(self):
+        compacting = self._read(self.compacting_path, {})
+        changes = self._read(self.path, {})
+        with self._lock:
+            self._compacting |= set(compacting)
+            self._unsaved |= set(changes)
+        for image, values in changes.items():
+            compacting.setdefault(image, {}).update(values)
+        return compacting
+
+    def unsaved_images(self):
+        """Images with journaled changes that are not in the store yet."""
+        with self._lock:
+            return self._unsaved | self._compacting
+
+    @staticmethod
+    def _read(path, changes):
+        if not os.path.exists(path):
+            return changes
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line after a crash
+                changes.setdefault(entry["image"], {}).update(entry["values"])
+        return changes
+
+    def begin_compaction(self):
+        with self._lock:
+            self._sync()
+            if os.path.getsize(self.path) == 0 and not os.path.exists(self.compacting_path):
+                return False
+
+            self._file.close()
+            if os.path.exists(self.compacting_path):
+                # A previous compaction did not finish, keep its entries in front of ours
+                with open(self.compacting_path, "a", encoding="utf-8") as segment, \
+                        open(self.path, encoding="utf-8") as current:
+                    segment.write(current.read())
+                    segment.flush()
+                    os.fsync(segment.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.compacting_path)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._compacting |= self._unsaved
+            self._unsaved = set()
+            return True
+
+    def finish_compaction(self):
+        with self._lock:
+            if os.path.exists(self.compacting_path):
+                os.remove(self.compacting_path)
+            self._compacting = set()
+
+    def compact(self, snapshot, write, background=False):
+        """Fold the journal into the annotation store.
+
+        `snapshot(changes)` runs on the calling (Tk) thread and must capture the current
+        state; `changes` maps every image that is being compacted to its journaled values,
+        so incremental stores only need those rows. `write(data)` receives the snapshot
+        and may run on a worker thread.
+        """
+        if self._compaction is not None and self._compaction.is_alive():
+            if background:
+                return False
+            self._compaction.join()
+
+        if not self.begin_compaction():
+            return False
+
+        data = snapshot(self._read(self.compacting_path, {}))
+
+        def run():
+            try:
+                write(data)
+            except Exception as error:
+                print(f"Saving annotations failed, changes stay in the journal: {error}")
+                return
+            self.finish_compaction()
+
+        if background:
+            self._compaction = threading.Thread(target=run, daemon=True)
+            self._compaction.start()
+        else:
+            run()
+        return True
+
+    def close(self):
+        if self._compaction is not None:
+            self._compaction.join()
+        with self._lock:
+            self._sync()
+            self._file.close()
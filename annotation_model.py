@@ -0,0 +1,189 @@
+from annotation_index import RowIndex
+from compact_columns import make_column
+
+
+class AnnotationModel:
+    """Annotation table of one folder in plain Python, one list per column.
+
+    Rows are found by image name through a RowIndex and, like there, never renumbered.
+    The annotator windows keep their state here and only mirror the current row in their
+    widgets, so annotations can be loaded, changed and saved without a display.
+
+    Edits mark their row and column dirty; `take_dirty` hands out what changed since it
+    was last called, so saving costs what was edited, not the size of the table. Until
+    then `discard` can put a row back the way it was saved.
+
+    `kinds` picks the storage of a column (see compact_columns): bits for 'x' markers,
+    small integers for counts, codes for annotator names and only the filled rows of
+    notes, so the table stays a few bytes per image next to its names.
+    """
+
+    def __init__(self, columns, defaults=None, kinds=None):
+        self.columns = list(columns)  # The first column holds the image names
+        self.defaults = dict(defaults or {})
+        self.kinds = dict(kinds or {})
+        self.index = RowIndex()
+        self.data = {column: make_column(self.kinds.get(column), self.defaults.get(column))
+                     for column in self.columns[1:]}
+        self.dirty = {}  # Row -> columns edited since take_dirty
+        self.saved = {}  # Row -> {column: value before its first unsaved edit}
+
+    @classmethod
+    def from_table(cls, columns, rows, defaults=None, converters=None, kinds=None):
+        """Model of a (columns, rows) table, the last row of an image wins.
+
+        Missing values get the column default, `converters` maps columns to a function
+        applied to every value of that column (e.g. counts read back as text).
+        """
+        model = cls(columns, defaults, kinds)
+        latest = {row[0]: row for row in rows}
+        model.index = RowIndex(latest)
+        converters = converters or {}
+        for i, column in enumerate(model.columns[1:], 1):
+            default = model.defaults.get(column)
+            convert = converters.get(column) or (lambda value: value)
+            values = (default if row[i] is None else convert(row[i]) for row in latest.values())
+            model.data[column] = make_column(model.kinds.get(column), default, values)
+        return model
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, image):
+        return image in self.index
+
+    @property
+    def names(self):
+        return self.index.names
+
+    def row_of(self, image):
+        return self.index.get(image)
+
+    def add_images(self, images):
+        """Empty rows for images that have none yet, returns those images."""
+        added = [image for image in dict.fromkeys(images) if image not in self.index]
+        for image in added:
+            self.index.add(image)
+        for values in self.data.values():
+            values.grow(len(added))
+        return added
+
+    def reconcile(self, folder_images):
+        """Empty rows for new images, returns (added, missing) like RowIndex.reconcile."""
+        folder_images = list(folder_images)
+        present = set(folder_images)
+        missing = [image for image in self.index.names if image not in present]
+        return self.add_images(folder_images), missing
+
+    def add_column(self, column, default=None, kind=None):
+        if column in self.data:
+            return
+        self.columns.append(column)
+        self.defaults[column] = default
+        self.kinds[column] = kind
+        self.data[column] = make_column(kind, default)
+        self.data[column].grow(len(self.index))
+
+    def get(self, row, column):
+        return self.data[column][row]
+
+    def set(self, row, column, value, dirty=True):
+        """Returns whether the value changed. Values that are saved already, e.g. read back
+        from the journal or from other annotators, are set with dirty=False."""
+        values = self.data[column]
+        if values[row] == value:
+            return False
+        if dirty:
+            self.dirty.setdefault(row, set()).add(column)
+            self.saved.setdefault(row, {}).setdefault(column, values[row])
+        values[row] = value
+        return True
+
+    def update(self, row, values, dirty=True):
+        """Set several columns of a row, unknown columns are ignored. Returns whether anything changed."""
+        changed = False
+        for column, value in values.items():
+            if column in self.data:
+                changed = self.set(row, column, value, dirty) or changed
+        return changed
+
+    def is_dirty(self, row):
+        return row in self.dirty
+
+    def dirty_images(self):
+        return {self.index.names[row] for row in self.dirty}
+
+    def take_dirty(self, keep=()):
+        """(image, {column: value}) of the edited values, which are clean afterwards.
+        Rows in `keep` are left out and stay dirty."""
+        dirty = {row: columns for row, columns in self.dirty.items() if row not in keep}
+        self.dirty = {row: columns for row, columns in self.dirty.items() if row in keep}
+        for row in dirty:
+            self.saved.pop(row, None)
+        return [(self.index.names[row], {column: self.data[column][row] for column in columns})
+                for row, columns in dirty.items()]
+
+    def discard(self, row):
+        """Undo the edits of a row that were not taken by take_dirty yet."""
+        for column, value in self.saved.pop(row, {}).items():
+            self.data[column][row] = value
+        self.dirty.pop(row, None)
+
+    def record(self, row):
+        """Column -> value of one row, without the image name."""
+        return {column: values[row] for column, values in self.data.items()}
+
+    def column(self, column):
+        return self.data[column].values()
+
+    def mask(self, column):
+        """Numpy bool array over the rows, True where the column holds something other than its default."""
+        return self.data[column].mask()
+
+    def table(self, images=None, columns=None):
+        """(columns, rows) for the store, either for the given images or for all of them.
+        `columns` limits the table to those columns after the image name."""
+        if images is None:
+            rows = range(len(self.index))
+        else:
+            rows = [row for row in (self.index.get(image) for image in images) if row is not None]
+        names = self.index.names
+        columns = self.columns[1:] if columns is None else list(columns)
+        values = [self.data[column].values(None if images is None else rows) for column in columns]
+        return [self.columns[0]] + columns, [[names[row], *row_values] for row, row_values in zip(rows, zip(*values))] \
+            if values else [[names[row]] for row in rows]
+
+
+class WidgetMirror:
+    """Shows one row of a model in widgets, touching only widgets whose value changed.
+
+    `bind(column, show)` registers the function that puts a value in the widget of a
+    column. `show(record)` calls it only if the value differs from the one shown last,
+    so stepping through images only updates the widgets that really change.
+    """
+
+    def __init__(self):
+        self._show = {}
+        self._shown = {}
+
+    def bind(self, column, show):
+        self._show[column] = show
+        self._shown.pop(column, None)
+
+    def unbind(self, column):
+        self._show.pop(column, None)
+        self._shown.pop(column, None)
+
+    def show(self, record):
+        for column, show in self._show.items():
+            value = record.get(column)
+            if column not in self._shown or self._shown[column] != value:
+                show(value)
+                self._shown[column] = value
+
+    def shown(self, column, value):
+        # The user changed the widget itself, it already shows this value
+        self._shown[column] = value
+
+    def invalidate(self):
+        self._shown = {}
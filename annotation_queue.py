@@ -0,0 +1,158 @@
+import heapq
+import re
+
+import numpy as np
+
+
+# Priorities are kept in their own table of the annotation store, like the pre-screening results
+QUEUE_TABLE = "queue"
+QUEUE_COLUMNS = ("Image", "Scheduler", "Priority", "Stratum")
+
+TIMESTAMP = re.compile(r"(\d{8})[_-]?(\d{2})\d{4}")  # 20230715_213000, the hour is 21
+
+
+def stratum_of(image_name):
+    """Hour of the night of an image, from the time stamp in its file name. A folder is one
+    deployment, so its images share a site."""
+    match = TIMESTAMP.search(image_name)
+    return match.group(2) if match else ""
+
+
+# Schedulers score images in one vectorised pass, higher is annotated sooner. `suggestions` maps
+# image names to the pre-screener's (suggestion, confidence, score), `first` is the position of
+# the first image, new images of a scan are scored on their own.
+
+def file_order(image_names, suggestions, first=0):
+    return -np.arange(first, first + len(image_names), dtype=float)
+
+
+def most_uncertain(image_names, suggestions, first=0):
+    # Confidence is 0.5 right at the pre-screener's threshold, images it did not screen count as that
+    confidence = np.fromiter((suggestions.get(name, (None, 0.5, 0.0))[1] for name in image_names), dtype=float,
+                             count=len(image_names))
+    return 1.0 - confidence
+
+
+def loudest(image_names, suggestions, first=0):
+    # The loudest moment in the bat band first, images that were not screened last
+    score = np.fromiter((suggestions.get(name, (None, 0.0, np.nan))[2] for name in image_names), dtype=float,
+                        count=len(image_names))
+    return np.where(np.isnan(score), -np.inf, score)
+
+
+SCHEDULERS = {"file order": file_order, "most uncertain": most_uncertain, "loudest": loudest}
+
+
+def compute_queue(image_names, suggestions, scheduler, stratified=False, first=0):
+    """(QUEUE_COLUMNS, rows) for the queue table of a folder."""
+    priorities = SCHEDULERS[scheduler](image_names, suggestions, first)
+    key = scheduler + (" per hour" if stratified else "")
+    return QUEUE_COLUMNS, [[name, key, float(priority), stratum_of(name) if stratified else ""]
+                           for name, priority in zip(image_names, priorities)]
+
+
+def stored_queue(table, image_names, scheduler, stratified=False):
+    """(priorities, strata) for the images from a stored queue table, or None if it is stale."""
+    if table is None:
+        return None
+    columns, rows = table
+    key = scheduler + (" per hour" if stratified else "")
+    index = {column: i for i, column in enumerate(columns)}
+    by_name = {row[0]: row for row in rows if row[index["Scheduler"]] == key}
+    if any(name not in by_name for name in image_names):
+        return None
+    priorities = np.fromiter((by_name[name][index["Priority"]] for name in image_names), dtype=float,
+                             count=len(image_names))
+    return priorities, [by_name[name][index["Stratum"]] for name in image_names]
+
+
+class AnnotationQueue:
+    """Order of the images of a folder by priority, with the strata taking turns.
+
+    The arrow keys step through `order`: the best image of every stratum, then the
+    second best of every stratum, and so on. 'Next to annotate' is ranked again with
+    every label instead: it takes the best pending image of the stratum that has the
+    fewest labels so far, so no hour of the night is left behind.
+
+    Every stratum keeps a cursor into its own order, which only moves past annotated
+    images, and images that become pending again go on a small heap. A label costs O(1)
+    and nothing is sorted again until the folder changes.
+    """
+
+    chunk_size = 4096
+
+    def __init__(self, priorities, strata, annotated):
+        priorities = np.asarray(priorities, dtype=float)
+        names, self.stratum = np.unique(np.asarray(strata, dtype=object).astype(str), return_inverse=True)
+        count = len(priorities)
+
+        # Positions of every stratum, best first
+        by_priority = np.argsort(-priorities, kind="stable")
+        grouped = by_priority[np.argsort(self.stratum[by_priority], kind="stable")]
+        bounds = np.searchsorted(self.stratum[grouped], np.arange(len(names) + 1))
+        self.members = [grouped[bounds[i]:bounds[i + 1]] for i in range(len(names))]
+
+        # Interleaved order for stepping, by rank within the stratum and then by priority
+        rank_in_stratum = np.empty(count, dtype=np.int64)
+        for members in self.members:
+            rank_in_stratum[members] = np.arange(len(members))
+        self.order = np.lexsort((-priorities, rank_in_stratum))
+        self.rank = np.empty(count, dtype=np.int64)
+        self.rank[self.order] = np.arange(count)
+
+        annotated = np.asarray(annotated, dtype=bool)
+        self.labels = np.bincount(self.stratum[annotated], minlength=len(names))
+        self._cursors = np.zeros(len(names), dtype=np.int64)
+        self._requeued = [[] for _ in names]  # Heaps of (rank, position) of images pending again
+
+    def __len__(self):
+        return len(self.order)
+
+    def step(self, position, offset):
+        """The position `offset` places further in the order, wrapping around."""
+        return int(self.order[(self.rank[position] + offset) % len(self.order)])
+
+    def labelled(self, position, annotated):
+        stratum = self.stratum[position]
+        if annotated:
+            self.labels[stratum] += 1
+        else:
+            self.labels[stratum] -= 1
+            heapq.heappush(self._requeued[stratum], (int(self.rank[position]), int(position)))
+
+    def _first(self, members, start, mask):
+        # Index of the first member at or after `start` that is set in the mask, in vectorised chunks
+        for chunk_start in range(start, len(members), self.chunk_size):
+            chunk = mask[members[chunk_start:chunk_start + self.chunk_size]]
+            hit = int(chunk.argmax())
+            if chunk[hit]:
+                return chunk_start + hit
+        return None
+
+    def _best(self, stratum, pending, mask):
+        members = self.members[stratum]
+        # The cursor moves past annotated images only, skipped ones stay in front of it
+        cursor = self._first(members, int(self._cursors[stratum]), pending)
+        self._cursors[stratum] = len(members) if cursor is None else cursor
+        index = cursor if mask is pending or cursor is None else self._first(members, cursor, mask)
+        best = None if index is None else int(members[index])
+
+        requeued = self._requeued[stratum]
+        while requeued and not pending[requeued[0][1]]:
+            heapq.heappop(requeued)
+        candidates = [entry for entry in requeued if mask[entry[1]]]
+        if candidates:
+            rank, position = min(candidates)
+            if best is None or rank < self.rank[best]:
+                return position
+        return best
+
+    def next_pending(self, pending, skip=None):
+        """Position to annotate next, or None. `pending` is a boolean array over positions,
+        `skip` an optional one of positions that only come once nothing else is pending."""
+        for mask in ((pending & ~skip, pending) if skip is not None else (pending,)):
+            for stratum in np.argsort(self.labels, kind="stable"):
+                position = self._best(stratum, pending, mask)
+                if position is not None:
+                    return position
+        return None
@@ -0,0 +1,40 @@
+# Column layouts of the annotation tables written by the two annotators.
+
+# SpeedyBat.py: fixed columns, counters are integers, checkboxes are 'x' or ''
+IMAGE_COLUMN = 'Image Name'
+COUNT_COLUMNS = ('Social Call', 'Feeding Buzz')
+FLAG_COLUMNS = ('None', 'Bat')
+TEXT_COLUMNS = ('Notes', 'Annotater')
+COLUMNS = (IMAGE_COLUMN,) + COUNT_COLUMNS + FLAG_COLUMNS + TEXT_COLUMNS
+DEFAULTS = {'Social Call': 0, 'Feeding Buzz': 0, 'None': '', 'Bat': '', 'Notes': '', 'Annotater': ''}
+# How AnnotationModel stores every column, see compact_columns
+KINDS = {'Social Call': 'count', 'Feeding Buzz': 'count', 'None': 'marker', 'Bat': 'marker', 'Notes': 'sparse',
+         'Annotater': 'category'}
+
+# SpeedyBatv2.0.py: an "Image" column followed by one column per user defined field, 'x' or empty
+FIELDS_IMAGE_COLUMN = 'Image'
+
+MARKER = 'x'
+
+
+def detect_layout(columns):
+    """'fixed' for SpeedyBat.py tables, 'fields' for SpeedyBatv2.0.py tables, None otherwise."""
+    columns = list(columns)
+    if columns and columns[0] == IMAGE_COLUMN and set(COLUMNS) <= set(columns):
+        return 'fixed'
+    if columns and columns[0] == FIELDS_IMAGE_COLUMN:
+        return 'fields'
+    return None
+
+
+def label_columns(columns):
+    """Every column except the image name."""
+    return list(columns)[1:]
+
+
+def count_value(value):
+    """A count read back from a table, text and floats included, 0 when it is not a number."""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,448 @@
+import getpass
+import os
+import pathlib
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import openpyxl
+
+
+# Tables are passed around as (columns, rows): a list of column names, the first one
+# holding the image name, and a list of row lists in the same column order.
+
+
+class SQLiteStore:
+    """Live annotation table in SQLite, rows are upserted so a save only touches changed images."""
+
+    incremental = True  # write() only needs the rows that changed
+    extension = ".sqlite"
+    journal_name = "annotations.journal"
+    journal_mode = "WAL"
+
+    def __init__(self, path, table="annotations", read_only=False):
+        self.path = path
+        self.read_only = read_only  # Readers must not change the journal mode of a shared file
+        self.table_name = table
+        self.table = self._quote(table)  # Other tables (e.g. pre-screening results) share the file
+        self._connection = None
+        self._lock = threading.Lock()  # The background compaction writes from another thread
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _connect(self):
+        if self._connection is None and self.read_only:
+            uri = pathlib.Path(os.path.abspath(self.path)).as_uri() + "?mode=ro"
+            self._connection = sqlite3.connect(uri, uri=True, timeout=30, check_same_thread=False)
+        elif self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        return self._connection
+
+    @classmethod
+    def for_folder(cls, folder_path, table="annotations"):
+        return cls(os.path.join(folder_path, "annotations" + cls.extension), table)
+
+    @staticmethod
+    def _quote(name):
+        return '"' + str(name).replace('"', '""') + '"'
+
+    def _table_columns(self, connection):
+        return [row[1] for row in connection.execute(f"PRAGMA table_info({self.table})")]
+
+    def columns(self):
+        with self._lock:
+            return self._table_columns(self._connect()) if self.exists() else []
+
+    def load(self):
+        if not self.exists():
+            return None
+        with self._lock:
+            connection = self._connect()
+            columns = self._table_columns(connection)
+            if not columns:
+                return None
+            rows = connection.execute(f"SELECT * FROM {self.table} ORDER BY rowid").fetchall()
+            return columns, [list(row) for row in rows]
+
+    def write(self, columns, rows):
+        with self._lock, self._connect() as connection:
+            self._upsert(connection, columns, rows)
+
+    def _upsert(self, connection, columns, rows):
+        existing = self._table_columns(connection)
+        if not existing:
+            definition = ", ".join([self._quote(columns[0]) + " PRIMARY KEY"] +
+                                   [self._quote(column) for column in columns[1:]])
+            connection.execute(f"CREATE TABLE {self.table} ({definition})")
+        else:
+            # Fields added since the table was created become new columns, old rows keep NULL
+            for column in columns:
+                if column not in existing:
+                    connection.execute(f"ALTER TABLE {self.table} ADD COLUMN {self._quote(column)}")
+
+        # Upsert in place so rows keep their original order
+        names = ", ".join(self._quote(column) for column in columns)
+        placeholders = ", ".join("?" * len(columns))
+        key = self._quote(self._table_columns(connection)[0])
+        updates = ", ".join(f"{self._quote(column)} = excluded.{self._quote(column)}" for column in columns[1:])
+        conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+        connection.executemany(f"INSERT INTO {self.table} ({names}) VALUES ({placeholders}) "
+                               f"ON CONFLICT({key}) {conflict}", rows)
+
+    def clear(self):
+        with self._lock, self._connect() as connection:
+            connection.execute(f"DROP TABLE IF EXISTS {self.table}")
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def default_annotator():
+    return f"{getpass.getuser()}@{socket.gethostname()}"
+
+
+class ProjectStore(SQLiteStore):
+    """Annotation table in a SQLite file on a shared path, for several annotators at once.
+
+    Every row has a version. A client remembers the version each row had when it last
+    read or wrote it, and `write` only replaces rows that nobody else changed since
+    (optimistic versioning). Rows someone else changed, or that another annotator holds
+    a lease on, are left alone and reported by `take_conflicts`; `changes_since` pulls
+    them in. Work is split with per-image leases: `claim` hands out a batch of images no
+    other annotator holds, in one short transaction per batch rather than per image.
+
+    The file lives on a network share, so it uses SQLite's rollback journal instead of
+    WAL, and every write is a single BEGIN IMMEDIATE transaction.
+    """
+
+    def __init__(self, path, table="annotations", annotator=None, lease_seconds=15 * 60):
+        super().__init__(path, table)
+        self.annotator = annotator or default_annotator()
+        self.lease_seconds = lease_seconds
+        self.versions = self._quote(table + "_versions")
+        self.journal_name = f"annotations.{socket.gethostname()}.journal"  # One per machine
+
+        self.base_versions = {}  # Image -> version this client last saw
+        self.last_seq = 0  # Highest change number this client has seen
+        self._conflicts = []
+        self._deferred = set()  # Images changed by others that were on screen, pulled in once they are not
+
+    @classmethod
+    def for_folder(cls, folder_path, table="annotations", annotator=None):
+        store = super().for_folder(folder_path, table)
+        if annotator:
+            store.annotator = annotator
+        return store
+
+    def _connect(self):
+        if self._connection is None:
+            # Autocommit, transactions are started explicitly with BEGIN IMMEDIATE
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=DELETE")  # WAL does not work on network shares
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {self.versions} "
+                                     "(image TEXT PRIMARY KEY, version INTEGER NOT NULL, seq INTEGER NOT NULL, "
+                                     "annotator TEXT)")
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {self._quote(self.table_name + '_seq')} "
+                                     f"ON {self.versions} (seq)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS leases "
+                                     "(image TEXT PRIMARY KEY, annotator TEXT NOT NULL, expires REAL NOT NULL)")
+        return self._connection
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")  # Takes the write lock up front, no deadlocks between clients
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def load(self):
+        table = super().load()
+        with self._lock:
+            connection = self._connect()
+            rows = connection.execute(f"SELECT image, version, seq FROM {self.versions}").fetchall()
+        self.base_versions = {image: version for image, version, _ in rows}
+        self.last_seq = max((seq for _, _, seq in rows), default=0)
+        return table
+
+    def write(self, columns, rows):
+        now = time.time()
+        with self._transaction() as connection:
+            seq = connection.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {self.versions}").fetchone()[0]
+            images = [row[0] for row in rows]
+            current = dict(self._select(connection, f"SELECT image, version FROM {self.versions}", images))
+            holders = dict(self._select(connection, "SELECT image, annotator FROM leases WHERE expires > ?",
+                                        images, (now,)))
+
+            accepted = []
+            for row in rows:
+                image = row[0]
+                holder = holders.get(image)
+                if holder is not None and holder != self.annotator:
+                    self._conflicts.append((image, holder))  # Someone else is annotating it right now
+                elif current.get(image, 0) != self.base_versions.get(image, 0) and holder != self.annotator:
+                    if image not in self._deferred:  # Those were reported by changes_since already
+                        self._conflicts.append((image, None))  # Changed by someone else since we read it
+                else:
+                    accepted.append(row)
+
+            if accepted:
+                self._upsert(connection, columns, accepted)
+                versions = []
+                for row in accepted:
+                    seq += 1
+                    versions.append((row[0], current.get(row[0], 0) + 1, seq, self.annotator))
+                connection.executemany(f"INSERT INTO {self.versions} (image, version, seq, annotator) "
+                                       "VALUES (?, ?, ?, ?) ON CONFLICT(image) DO UPDATE SET "
+                                       "version = excluded.version, seq = excluded.seq, annotator = excluded.annotator",
+                                       versions)
+                for image, version, _, _ in versions:
+                    self.base_versions[image] = version
+
+    @staticmethod
+    def _select(connection, query, images, parameters=(), chunk_size=500):
+        # IN lists are limited in length, look the images up in chunks
+        keyword = "AND" if "WHERE" in query else "WHERE"
+        for start in range(0, len(images), chunk_size):
+            chunk = images[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            yield from connection.execute(f"{query} {keyword} image IN ({placeholders})", (*parameters, *chunk))
+
+    def take_conflicts(self):
+        """(image, annotator holding it or None) for rows write() refused since the last call."""
+        with self._lock:
+            conflicts, self._conflicts = self._conflicts, []
+        return conflicts
+
+    def changes_since(self, on_screen=()):
+        """(columns, rows) changed by other annotators since this client last looked.
+
+        Rows of the images in `on_screen` are held back: this client may still be editing
+        them, so their change is reported as a conflict, a save of them is refused, and
+        they are returned by a later call once they are no longer on screen.
+        """
+        on_screen = set(on_screen)
+        with self._lock:
+            connection = self._connect()
+            changed = {image: (version, annotator) for image, version, annotator in connection.execute(
+                f"SELECT image, version, annotator FROM {self.versions} WHERE seq > ? AND annotator != ?",
+                (self.last_seq, self.annotator))}
+            changed.update((image, (version, annotator)) for image, version, annotator in self._select(
+                connection, f"SELECT image, version, annotator FROM {self.versions}", sorted(self._deferred)))
+            top = connection.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {self.versions}").fetchone()[0]
+            columns = self._table_columns(connection)
+
+            merged = []
+            for image, (version, annotator) in changed.items():
+                if image in on_screen:
+                    if image not in self._deferred:
+                        self._conflicts.append((image, annotator))
+                        self._deferred.add(image)
+                else:
+                    merged.append(image)
+                    self.base_versions[image] = version  # Only rows the caller takes in count as seen
+                    self._deferred.discard(image)
+
+            rows = []
+            if merged and columns:
+                key = self._quote(columns[0])
+                for start in range(0, len(merged), 500):
+                    chunk = merged[start:start + 500]
+                    placeholders = ", ".join("?" * len(chunk))
+                    rows += [list(row) for row in connection.execute(
+                        f"SELECT * FROM {self.table} WHERE {key} IN ({placeholders})", chunk)]
+            self.last_seq = max(self.last_seq, top)
+        return columns, rows
+
+    def claim(self, candidates, size=50):
+        """Lease up to `size` of the candidate images that no other annotator holds, in candidate order."""
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM leases WHERE expires <= ?", (now,))
+            candidates = list(candidates)
+            taken = {image for image, holder in self._select(connection, "SELECT image, annotator FROM leases",
+                                                             candidates)
+                     if holder != self.annotator}
+            claimed = [image for image in candidates if image not in taken][:size]
+            connection.executemany("INSERT INTO leases (image, annotator, expires) VALUES (?, ?, ?) "
+                                   "ON CONFLICT(image) DO UPDATE SET expires = excluded.expires",
+                                   [(image, self.annotator, now + self.lease_seconds) for image in claimed])
+        return claimed
+
+    def renew(self):
+        with self._transaction() as connection:
+            connection.execute("UPDATE leases SET expires = ? WHERE annotator = ?",
+                               (time.time() + self.lease_seconds, self.annotator))
+
+    def release(self, images=None):
+        with self._transaction() as connection:
+            if images is None:
+                connection.execute("DELETE FROM leases WHERE annotator = ?", (self.annotator,))
+            else:
+                connection.executemany("DELETE FROM leases WHERE image = ? AND annotator = ?",
+                                       [(image, self.annotator) for image in images])
+
+    def leases(self):
+        """Image -> annotator for every image another annotator currently holds."""
+        with self._lock:
+            return dict(self._connect().execute("SELECT image, annotator FROM leases WHERE expires > ? AND "
+                                                "annotator != ?", (time.time(), self.annotator)))
+
+    def close(self):
+        try:
+            self.release()
+        except sqlite3.Error:
+            pass  # The share went away, the leases expire on their own
+        super().close()
+
+
+class SharedTableStore(SQLiteStore):
+    """Another table in the file of a ProjectStore, e.g. the pre-screening results.
+
+    Rows are upserted as they are, without versions or leases, so writes are never refused
+    for images another annotator holds and closing it leaves this annotator's leases alone.
+    """
+
+    journal_mode = "DELETE"  # The file is on a network share, see ProjectStore
+
+
+class DataFrameStore:
+    """Live annotation table in a columnar file (Parquet or Feather), rewritten as a whole."""
+
+    incremental = False  # write() needs the complete table
+    extension = None
+    journal_name = "annotations.journal"
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_folder(cls, folder_path, table="annotations"):
+        # One file per table, e.g. annotations.screening.parquet next to annotations.parquet
+        suffix = "" if table == "annotations" else "." + table
+        return cls(os.path.join(folder_path, "annotations" + suffix + cls.extension))
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _read(self, path):
+        raise NotImplementedError
+
+    def _write(self, df, path):
+        raise NotImplementedError
+
+    def columns(self):
+        table = self.load()
+        return table[0] if table else []
+
+    def load(self):
+        if not self.exists():
+            return None
+        df = self._read(self.path)
+        return list(df.columns), df.astype(object).where(df.notna(), None).values.tolist()
+
+    def write(self, columns, rows):
+        import pandas as pd
+
+        # Mixed types ('x', None, numbers) in one column are stored as strings by pyarrow otherwise
+        df = pd.DataFrame(rows, columns=columns)
+        for column in df.columns[1:]:
+            if df[column].dtype == object:
+                df[column] = df[column].map(lambda value: None if value is None else str(value))
+        temp_path = self.path + ".tmp"
+        self._write(df, temp_path)
+        os.replace(temp_path, self.path)
+
+    def clear(self):
+        if self.exists():
+            os.remove(self.path)
+
+    def close(self):
+        pass
+
+
+class ParquetStore(DataFrameStore):
+    extension = ".parquet"
+
+    def _read(self, path):
+        import pandas as pd
+        return pd.read_parquet(path)
+
+    def _write(self, df, path):
+        df.to_parquet(path, index=False)
+
+
+class FeatherStore(DataFrameStore):
+    extension = ".feather"
+
+    def _read(self, path):
+        import pandas as pd
+        return pd.read_feather(path)
+
+    def _write(self, df, path):
+        df.to_feather(path)
+
+
+STORES = {"sqlite": SQLiteStore, "parquet": ParquetStore, "feather": FeatherStore, "shared": ProjectStore}
+
+
+def open_store(folder_path, backend="sqlite", table="annotations"):
+    # Only the annotations of a shared project are versioned and leased
+    if backend == "shared" and table != "annotations":
+        return SharedTableStore.for_folder(folder_path, table)
+    return STORES[backend].for_folder(folder_path, table)
+
+
+def open_read_only(path, table="annotations"):
+    """Store of one table of an annotation file, for tools that only read it. SQLite files
+    are opened read-only, so they keep their journal mode and a shared project its leases."""
+    if path.endswith(SQLiteStore.extension):
+        return SQLiteStore(path, table, read_only=True)
+    for store_class in STORES.values():
+        if path.endswith(store_class.extension):
+            return store_class.for_folder(os.path.dirname(path), table)
+    raise ValueError(f"Unknown annotation file: {path}")
+
+
+def import_xlsx(xlsx_file):
+    # read_only streams the rows instead of building a cell object for each of them
+    wb = openpyxl.load_workbook(xlsx_file, read_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        columns = list(next(rows, ()))
+        padding = [None] * len(columns)
+        return columns, [(list(row) + padding)[:len(columns)] for row in rows if row and row[0] is not None]
+    finally:
+        wb.close()
+
+
+def xlsx_columns(xlsx_file):
+    wb = openpyxl.load_workbook(xlsx_file, read_only=True)
+    try:
+        return list(next(wb.active.iter_rows(values_only=True), ()))
+    finally:
+        wb.close()
+
+
+def export_xlsx(xlsx_file, columns, rows):
+    # Write next to the real file first so a crash never leaves a half written workbook
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(columns)
+    for row in rows:
+        ws.append(row)
+    temp_file = xlsx_file[:-len('.xlsx')] + '.tmp.xlsx'
+    wb.save(temp_file)
+    os.replace(temp_file, xlsx_file)
@@ -0,0 +1,245 @@
+import copy
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from spectrogram import read_wav, read_wav_info
+
+
+# Playback modes for ultrasonic recordings
+NORMAL = "normal"  # As recorded, only what is audible remains
+TIME_EXPANSION = "time expansion"  # Slowed down, every frequency divided by the expansion factor
+HETERODYNE = "heterodyne"  # Real time, the band around the heterodyne frequency shifted down to audible
+
+
+class PlaybackSettings:
+    def __init__(self, mode=TIME_EXPANSION, expansion_factor=10, heterodyne_freq=45000, output_rate=48000,
+                 gain=1.0):
+        self.mode = mode
+        self.expansion_factor = expansion_factor
+        self.heterodyne_freq = heterodyne_freq  # Hz
+        self.output_rate = output_rate  # Hz, what the sound card plays
+        self.gain = gain
+
+    def key(self):
+        return f"{self.mode}-{self.expansion_factor}-{self.heterodyne_freq}-{self.output_rate}-{self.gain}"
+
+
+def lowpass_taps(cutoff, sample_rate, count=127):
+    # Windowed sinc, cutoff in Hz
+    n = np.arange(count) - (count - 1) / 2
+    taps = np.sinc(2 * cutoff / sample_rate * n) * np.hamming(count)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+def sample_scale(info):
+    """(offset, scale) that map the samples of a recording to -1..1, by the bits it was recorded
+    with: 24-bit samples come in int32, 8-bit ones are unsigned around 128."""
+    if info.audio_format == 3:  # Float
+        return 0.0, 1.0
+    return (128.0 if info.bits == 8 else 0.0), 1.0 / 2 ** (info.bits - 1)
+
+
+class AudioConverter:
+    """Turns blocks of a recording into blocks at the output rate for one playback mode.
+
+    Filter and resampling state is carried over between blocks, so a recording can be
+    converted while it is streamed without clicks at the block boundaries.
+    """
+
+    def __init__(self, sample_rate, settings, scale=1.0, offset=0.0):
+        self.settings = settings
+        self.sample_rate = sample_rate
+        self.offset = offset
+        self.scale = scale * settings.gain
+
+        output_rate = settings.output_rate
+        if settings.mode == TIME_EXPANSION:
+            played_rate = sample_rate / settings.expansion_factor
+        else:
+            played_rate = sample_rate
+        self.step = played_rate / output_rate  # Input samples per output sample
+
+        # Low-pass before resampling so nothing above the output Nyquist frequency folds back
+        cutoff = 0.45 * output_rate * (sample_rate / played_rate)
+        if settings.mode == HETERODYNE:
+            cutoff = min(cutoff, 12000)
+        self.taps = lowpass_taps(cutoff, sample_rate) if cutoff < sample_rate / 2 else None
+
+        self._history = np.zeros(0 if self.taps is None else len(self.taps) - 1, dtype=np.float32)
+        self._pending = np.zeros(0, dtype=np.float32)  # Filtered samples not yet resampled
+        self._position = 0.0  # Fractional index into _pending of the next output sample
+        self._mixed = 0  # Input samples mixed so far, keeps the heterodyne oscillator continuous
+
+    def process(self, block):
+        samples = (np.asarray(block, dtype=np.float32) - self.offset) * self.scale
+
+        if self.settings.mode == HETERODYNE:
+            t = (self._mixed + np.arange(len(samples))) / self.sample_rate
+            samples = samples * np.cos(2 * np.pi * self.settings.heterodyne_freq * t).astype(np.float32)
+            self._mixed += len(samples)
+
+        if self.taps is not None:
+            padded = np.concatenate([self._history, samples])
+            self._history = padded[len(padded) - len(self._history):]
+            samples = np.convolve(padded, self.taps, mode="valid").astype(np.float32)
+
+        pending = np.concatenate([self._pending, samples])
+        if len(pending) < 2:
+            self._pending = pending
+            return np.zeros(0, dtype=np.float32)
+        count = int(np.floor((len(pending) - 1 - self._position) / self.step)) + 1
+        positions = self._position + self.step * np.arange(count)
+        output = np.interp(positions, np.arange(len(pending)), pending).astype(np.float32)
+
+        next_position = self._position + self.step * count
+        consumed = min(int(next_position), len(pending) - 1)
+        self._pending = pending[consumed:]
+        self._position = next_position - consumed
+        return np.clip(output, -1.0, 1.0)
+
+
+class AudioPlayer:
+    """Plays recordings from memory-mapped files on a background thread.
+
+    Only one recording plays at a time; `play` stops the previous one. The first
+    seconds of the recordings the user is likely to play next can be converted ahead
+    with `prebuffer`, so playback starts at once. Audio output needs the optional
+    `sounddevice` package.
+    """
+
+    block_seconds = 0.1  # Of input audio per converted block
+
+    def __init__(self, settings=None, prebuffer_seconds=2.0, max_prebuffered=8):
+        self.settings = settings if settings is not None else PlaybackSettings()
+        self.prebuffer_seconds = prebuffer_seconds
+        self.max_prebuffered = max_prebuffered
+
+        self._play_thread = None
+        self._stop_event = threading.Event()
+
+        self._prebuffered = OrderedDict()  # key -> (head, converter, next input sample)
+        self._prebuffer_queue = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._prebuffer_thread = threading.Thread(target=self._prebuffer_worker, daemon=True)
+        self._prebuffer_thread.start()
+
+    @staticmethod
+    def _key(wav_path, settings):
+        try:
+            mtime = os.stat(wav_path).st_mtime_ns
+        except OSError:
+            return None
+        return wav_path, mtime, settings.key()
+
+    def _convert_head(self, wav_path, settings):
+        sample_rate, samples = read_wav(wav_path)
+        offset, scale = sample_scale(read_wav_info(wav_path))
+        converter = AudioConverter(sample_rate, settings, scale, offset)
+        block = max(1, int(sample_rate * self.block_seconds))
+        stop = min(len(samples), int(sample_rate * self.prebuffer_seconds))
+        blocks = [converter.process(samples[start:start + block]) for start in range(0, stop, block)]
+        head = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+        return head, converter, max(stop, 0)
+
+    def set_mode(self, mode):
+        # A new settings object, a recording that is playing keeps the mode it started with
+        settings = copy.copy(self.settings)
+        settings.mode = mode
+        self.settings = settings
+
+    def prebuffer(self, wav_paths):
+        # Replace whatever was queued, only the neighbours of the current image matter
+        with self._condition:
+            self._prebuffer_queue = list(wav_paths)
+            self._condition.notify_all()
+
+    def _prebuffer_worker(self):
+        while True:
+            with self._condition:
+                while not self._prebuffer_queue and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                wav_path = self._prebuffer_queue.pop(0)
+                settings = self.settings
+                key = self._key(wav_path, settings)
+                if key is None or key in self._prebuffered:
+                    continue
+            try:
+                entry = self._convert_head(wav_path, settings)
+            except (OSError, ValueError):
+                continue  # No recording for this image, or not one we can read
+            except Exception as error:
+                # Anything else only loses this recording, the worker keeps prebuffering the others
+                print(f"Prebuffer failed for {wav_path}: {error}")
+                continue
+            with self._condition:
+                self._prebuffered[key] = entry
+                while len(self._prebuffered) > self.max_prebuffered:
+                    self._prebuffered.popitem(last=False)
+
+    def play(self, wav_path):
+        self.stop()
+        self._stop_event = threading.Event()
+        self._play_thread = threading.Thread(target=self._play, args=(wav_path, self._stop_event), daemon=True)
+        self._play_thread.start()
+
+    def _play(self, wav_path, stop_event):
+        try:
+            import sounddevice
+        except ImportError:
+            print("Playback needs the sounddevice package: pip install sounddevice")
+            return
+
+        settings = self.settings
+        try:
+            sample_rate, samples = read_wav(wav_path)
+            key = self._key(wav_path, settings)
+            with self._condition:
+                entry = self._prebuffered.get(key)
+            if entry is None:
+                head, start = np.zeros(0, dtype=np.float32), 0
+                offset, scale = sample_scale(read_wav_info(wav_path))
+                converter = AudioConverter(sample_rate, settings, scale, offset)
+            else:
+                head, converter, start = entry
+                converter = copy.deepcopy(converter)  # The prebuffered state can be played again
+
+            with sounddevice.OutputStream(samplerate=settings.output_rate, channels=1,
+                                          dtype="float32") as stream:
+                for output in self._blocks(head, converter, samples, start, sample_rate, settings.output_rate):
+                    if stop_event.is_set():
+                        stream.abort()  # Drop what is still buffered instead of playing it out
+                        return
+                    stream.write(output)
+        except (OSError, ValueError) as error:
+            print(f"Unable to play {wav_path}: {error}")
+        except sounddevice.PortAudioError as error:
+            print(f"Unable to play {wav_path}, no audio output: {error}")
+
+    def _blocks(self, head, converter, samples, start, sample_rate, output_rate):
+        # The prebuffered head in small pieces, so stop() is noticed quickly, then the rest of the file
+        output_block = max(1, int(output_rate * self.block_seconds))
+        for offset in range(0, len(head), output_block):
+            yield head[offset:offset + output_block]
+        block = max(1, int(sample_rate * self.block_seconds))
+        for offset in range(start, len(samples), block):
+            output = converter.process(samples[offset:offset + block])
+            if len(output):
+                yield output
+
+    def stop(self):
+        self._stop_event.set()
+
+    def is_playing(self):
+        return self._play_thread is not None and self._play_thread.is_alive()
+
+    def close(self):
+        self.stop()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
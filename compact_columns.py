@@ -0,0 +1,205 @@
+from array import array
+
+import numpy as np
+
+
+# Storage for the columns of an AnnotationModel, picked per column by kind. A Python list
+# costs 8 bytes per row for the pointer alone; at 250k images that is what most of the
+# table is, while most values are 'x' or empty, small counts, or one of a few names.
+#
+# Every column supports len, [row] and [row] = value, `grow(count)` to add rows with the
+# default value, `values(rows)` to read many rows at once and `mask()`, a numpy bool array
+# that is True where a row holds something other than the default.
+
+
+class ListColumn:
+    """Any value, one Python object per row."""
+
+    def __init__(self, default=None, values=()):
+        self.default = default
+        self._values = list(values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, row):
+        return self._values[row]
+
+    def __setitem__(self, row, value):
+        self._values[row] = value
+
+    def grow(self, count):
+        self._values.extend([self.default] * count)
+
+    def values(self, rows=None):
+        return list(self._values) if rows is None else [self._values[row] for row in rows]
+
+    def mask(self):
+        default = self.default
+        return np.fromiter((value != default for value in self._values), dtype=bool, count=len(self._values))
+
+
+class MarkerColumn:
+    """'x' or empty, one bit per row. Any other value that is not empty reads back as the marker."""
+
+    def __init__(self, default='', values=(), marker='x'):
+        self.default = default
+        self.marker = marker
+        marked = np.fromiter((bool(value) and value != default for value in values), dtype=bool)
+        self._bits = bytearray(np.packbits(marked, bitorder="little").tobytes())
+        self._length = len(marked)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, row):
+        if not 0 <= row < self._length:
+            raise IndexError(row)
+        return self.marker if self._bits[row >> 3] >> (row & 7) & 1 else self.default
+
+    def __setitem__(self, row, value):
+        if not 0 <= row < self._length:
+            raise IndexError(row)
+        if value and value != self.default:
+            self._bits[row >> 3] |= 1 << (row & 7)
+        else:
+            self._bits[row >> 3] &= ~(1 << (row & 7)) & 0xFF
+
+    def grow(self, count):
+        self._length += count
+        self._bits.extend(bytes((self._length + 7) // 8 - len(self._bits)))
+
+    def mask(self):
+        return np.unpackbits(np.frombuffer(bytes(self._bits), dtype=np.uint8), count=self._length,
+                             bitorder="little").astype(bool)
+
+    def values(self, rows=None):
+        marked = self.mask() if rows is None else self.mask()[np.asarray(list(rows), dtype=np.int64)]
+        return [self.marker if value else self.default for value in marked.tolist()]
+
+
+class CountColumn:
+    """Small integers, 2 bytes per row until a count needs more."""
+
+    def __init__(self, default=0, values=()):
+        self.default = default
+        counts = [int(value) for value in values]
+        try:
+            self._counts = array('h', counts)
+        except OverflowError:
+            self._counts = array('q', counts)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __getitem__(self, row):
+        return self._counts[row]
+
+    def __setitem__(self, row, value):
+        try:
+            self._counts[row] = value
+        except OverflowError:
+            self._counts = array('q', self._counts)
+            self._counts[row] = value
+
+    def grow(self, count):
+        self._counts.extend(array(self._counts.typecode, [self.default]) * count)
+
+    def array(self):
+        return np.array(self._counts, dtype=np.int64)
+
+    def values(self, rows=None):
+        return self._counts.tolist() if rows is None else [self._counts[row] for row in rows]
+
+    def mask(self):
+        return self.array() != self.default
+
+
+class CategoryColumn:
+    """Few distinct values repeated over many rows, like annotator names: a code per row."""
+
+    def __init__(self, default='', values=()):
+        self.default = default
+        self.categories = [default]
+        self._codes_of = {default: 0}
+        self._codes = array('H')
+        for value in values:
+            self._codes.append(self._code(value))
+
+    def _code(self, value):
+        code = self._codes_of.get(value)
+        if code is None:
+            code = self._codes_of[value] = len(self.categories)
+            self.categories.append(value)
+            if code > 0xFFFF and self._codes.typecode == 'H':
+                self._codes = array('I', self._codes)
+        return code
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, row):
+        return self.categories[self._codes[row]]
+
+    def __setitem__(self, row, value):
+        self._codes[row] = self._code(value)
+
+    def grow(self, count):
+        self._codes.extend(array(self._codes.typecode, [0]) * count)
+
+    def values(self, rows=None):
+        categories = self.categories
+        codes = self._codes if rows is None else (self._codes[row] for row in rows)
+        return [categories[code] for code in codes]
+
+    def mask(self):
+        return np.array(self._codes, dtype=np.int64) != 0
+
+
+class SparseColumn:
+    """Mostly the default, like notes: only rows with another value are stored."""
+
+    def __init__(self, default='', values=()):
+        self.default = default
+        self._values = {}
+        self._length = 0
+        for row, value in enumerate(values):
+            if value != default:
+                self._values[row] = value
+            self._length = row + 1
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, row):
+        if not 0 <= row < self._length:
+            raise IndexError(row)
+        return self._values.get(row, self.default)
+
+    def __setitem__(self, row, value):
+        if not 0 <= row < self._length:
+            raise IndexError(row)
+        if value == self.default:
+            self._values.pop(row, None)
+        else:
+            self._values[row] = value
+
+    def grow(self, count):
+        self._length += count
+
+    def values(self, rows=None):
+        get, default = self._values.get, self.default
+        return [get(row, default) for row in (range(self._length) if rows is None else rows)]
+
+    def mask(self):
+        mask = np.zeros(self._length, dtype=bool)
+        mask[list(self._values)] = True
+        return mask
+
+
+COLUMN_KINDS = {"list": ListColumn, "marker": MarkerColumn, "count": CountColumn, "category": CategoryColumn,
+                "sparse": SparseColumn}
+
+
+def make_column(kind, default=None, values=()):
+    return COLUMN_KINDS[kind or "list"](default, values)
@@ -0,0 +1,219 @@
+import csv
+import hashlib
+import json
+import os
+import struct
+from multiprocessing import Pool
+
+from PIL import Image
+
+from annotation_schema import COUNT_COLUMNS, FLAG_COLUMNS, MARKER, count_value
+from folder_scanner import wav_path_for_image
+from image_cache import HIGH
+from spectrogram import SpectrogramSettings, read_wav, read_wav_info, spectrogram_columns, spectrogram_image
+
+
+# A dataset is a folder of shards, each with its clips, its spectrogram crops and its own
+# manifest. A shard is finished once its manifest exists, so an interrupted export picks up
+# at the first unfinished shard, and within it skips the files that were written already.
+DATASET_NAME = "dataset.json"
+MANIFEST_NAME = "manifest.csv"
+MANIFEST_COLUMNS = ("Id", "Site", "Folder", "Image", "Recording", "Clip", "Spectrogram", "Start", "Duration",
+                    "Annotater")
+
+
+class ExportSettings:
+    """What goes into a training set and how it is cut up."""
+
+    def __init__(self, clip_seconds=2.0, crop_size=(256, 128), shard_size=500, labels=None, spectrogram=None):
+        self.clip_seconds = clip_seconds  # Around the loudest moment in the bat band, 0 for whole recordings
+        self.crop_size = tuple(crop_size)  # Width and height of the spectrogram crops
+        self.shard_size = shard_size  # Samples per shard
+        self.labels = labels  # Labels to export, None for every label in the annotations
+        self.spectrogram = spectrogram if spectrogram is not None else SpectrogramSettings()
+
+    def key(self):
+        # Stored in dataset.json, a resumed export has to cut the samples the same way
+        return {"clip_seconds": self.clip_seconds, "crop_size": list(self.crop_size), "shard_size": self.shard_size,
+                "labels": self.labels, "spectrogram": self.spectrogram.key()}
+
+
+def annotated_samples(result, labels=None):
+    """(folder, image, site, annotator, {label: value}) of the annotated rows of one table, as
+    read by speedybat_cli.process_all, which has SpeedyBatv2.0.py fields under their labels
+    already. Counts keep their value, marked fields are 1."""
+    columns, layout = result['columns'], result['layout']
+    index = {column: i for i, column in enumerate(columns)}
+    names = COUNT_COLUMNS + FLAG_COLUMNS if layout == 'fixed' else columns[1:]
+
+    samples = []
+    for row in result['rows']:
+        values = {}
+        for label in names:
+            if label not in index or (labels is not None and label not in labels):
+                continue
+            value = row[index[label]]
+            value = count_value(value) if layout == 'fixed' and label in COUNT_COLUMNS else int(value == MARKER)
+            if value > 0:
+                values[label] = value
+        if values:
+            annotator = (row[index['Annotater']] or '') if layout == 'fixed' else ''
+            samples.append((result['folder'], row[0], result['site'], annotator, values))
+    return samples
+
+
+def recording_of(image_path):
+    # Projects annotated from .wav files directly have the recordings as their images
+    return image_path if image_path.lower().endswith('.wav') else wav_path_for_image(image_path)
+
+
+def clip_window(wav_path, info, settings):
+    """(first frame, frame count) of the clip: `clip_seconds` around the loudest moment in the bat band."""
+    length = int(round(settings.clip_seconds * info.sample_rate))
+    if length <= 0 or info.frames <= length:
+        return 0, info.frames
+
+    sample_rate, samples = read_wav(wav_path)
+    columns = max(1, int(info.frames / info.sample_rate * 100))  # 10 ms per column
+    db = spectrogram_columns(samples, sample_rate, columns, settings.spectrogram)
+    loudest = int(db.max(axis=0).argmax())
+    centre = int((loudest + 0.5) / db.shape[1] * len(samples))
+    del samples  # Releases the memory map
+    return min(max(centre - length // 2, 0), info.frames - length), length
+
+
+def write_wav_segment(wav_path, info, first, count, out_path, block_size=1 << 20):
+    """Frames first .. first + count of a WAV file as a file of their own, copied as they are stored,
+    so bit depth and channels stay the same. At most `block_size` bytes are in memory."""
+    fmt = info.fmt + b"\0" * (len(info.fmt) % 2)  # Chunks are padded to an even size
+    data_size = count * info.block_align
+    temp_path = out_path + ".tmp"
+    with open(wav_path, "rb") as source, open(temp_path, "wb") as target:
+        target.write(struct.pack("<4sI4s", b"RIFF", 4 + 8 + len(fmt) + 8 + data_size + data_size % 2, b"WAVE"))
+        target.write(struct.pack("<4sI", b"fmt ", len(info.fmt)) + fmt)
+        target.write(struct.pack("<4sI", b"data", data_size))
+        source.seek(info.data_offset + first * info.block_align)
+        remaining = data_size
+        while remaining:
+            block = source.read(min(block_size, remaining))
+            if not block:
+                raise ValueError(f"{wav_path} ends before its last frame")
+            target.write(block)
+            remaining -= len(block)
+        target.write(b"\0" * (data_size % 2))
+    os.replace(temp_path, out_path)
+
+
+def save_image(image, path):
+    temp_path = path + ".tmp"
+    image.save(temp_path, format="PNG")
+    os.replace(temp_path, path)
+
+
+def export_sample(shard_folder, number, sample, label_columns, settings):
+    """Clip and spectrogram crop of one sample, returns its manifest row. Files that exist are kept."""
+    folder, image, site, annotator, labels = sample
+    sample_id = f"{number:07d}_{os.path.splitext(os.path.basename(image))[0]}"
+    image_path = os.path.join(folder, image)
+    wav_path = recording_of(image_path)
+    clip = os.path.join("clips", sample_id + ".wav")
+    crop = os.path.join("spectrograms", sample_id + ".png")
+    crop_path = os.path.join(shard_folder, crop)
+
+    if os.path.exists(wav_path):
+        info = read_wav_info(wav_path)
+        first, count = clip_window(wav_path, info, settings)
+        if not os.path.exists(os.path.join(shard_folder, clip)):
+            write_wav_segment(wav_path, info, first, count, os.path.join(shard_folder, clip))
+        if not os.path.exists(crop_path):
+            sample_rate, samples = read_wav(wav_path)
+            save_image(spectrogram_image(samples[first:first + count], sample_rate, settings.crop_size, HIGH,
+                                         settings.spectrogram), crop_path)
+            del samples
+        start, duration = round(first / info.sample_rate, 6), round(count / info.sample_rate, 6)
+    else:
+        # Only the spectrogram image is there, it is the crop as a whole
+        wav_path, clip, start, duration = "", "", "", ""
+        if not os.path.exists(crop_path):
+            with Image.open(image_path) as source:
+                save_image(source.convert("L").resize(settings.crop_size, Image.Resampling.BICUBIC), crop_path)
+
+    return [sample_id, site, folder, image, wav_path, clip, crop, start, duration, annotator] + \
+        [labels.get(label, 0) for label in label_columns]
+
+
+def shard_name(shard):
+    return f"shard-{shard:05d}"
+
+
+def export_shard(job):
+    """Worker: every sample of one shard, then its manifest if none of them failed. Returns (shard, written, failed)."""
+    output, shard, first, samples, label_columns, settings = job
+    shard_folder = os.path.join(output, shard_name(shard))
+    for subfolder in ("clips", "spectrograms"):
+        os.makedirs(os.path.join(shard_folder, subfolder), exist_ok=True)
+
+    rows = []
+    failed = 0
+    for offset, sample in enumerate(samples):
+        try:
+            rows.append(export_sample(shard_folder, first + offset, sample, label_columns, settings))
+        except (OSError, ValueError, struct.error) as error:
+            print(f"Export of {os.path.join(sample[0], sample[1])} failed: {error}")
+            failed += 1
+    if failed:
+        return shard, len(rows), failed  # Unfinished, a resumed export tries the shard again
+
+    manifest = os.path.join(shard_folder, MANIFEST_NAME)
+    with open(manifest + ".tmp", "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(list(MANIFEST_COLUMNS) + label_columns)
+        writer.writerows(rows)
+    os.replace(manifest + ".tmp", manifest)
+    return shard, len(rows), failed
+
+
+def fingerprint(samples, settings):
+    digest = hashlib.sha1(json.dumps(settings.key(), sort_keys=True).encode())
+    for folder, image, site, annotator, labels in samples:
+        digest.update(json.dumps([folder, image, site, annotator, sorted(labels.items())]).encode())
+    return digest.hexdigest()
+
+
+def export_dataset(samples, output, settings, processes=None):
+    """Write the samples as a sharded dataset below `output` on a process pool. Shards that
+    were finished by an earlier run are skipped; a shard with failed samples is not finished,
+    so running the export again retries them. Returns the number of samples that failed,
+    or None if `output` holds an export of other annotations or settings."""
+    samples = sorted(samples, key=lambda sample: (sample[2], sample[0], sample[1]))
+    label_columns = list(dict.fromkeys(label for sample in samples for label in sample[4]))
+    shards = [(first, samples[first:first + settings.shard_size])
+              for first in range(0, len(samples), settings.shard_size)]
+    description = {"version": 1, "fingerprint": fingerprint(samples, settings), "settings": settings.key(),
+                   "labels": label_columns, "samples": len(samples),
+                   "shards": [shard_name(shard) for shard in range(len(shards))]}
+
+    os.makedirs(output, exist_ok=True)
+    dataset_path = os.path.join(output, DATASET_NAME)
+    if os.path.exists(dataset_path):
+        with open(dataset_path, encoding="utf-8") as file:
+            if json.load(file).get("fingerprint") != description["fingerprint"]:
+                print(f"{output} holds an export of other annotations or settings, export into a new folder")
+                return None
+    else:
+        with open(dataset_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(description, file, indent=1)
+        os.replace(dataset_path + ".tmp", dataset_path)
+
+    jobs = [(output, shard, first, shard_samples, label_columns, settings)
+            for shard, (first, shard_samples) in enumerate(shards)
+            if not os.path.exists(os.path.join(output, shard_name(shard), MANIFEST_NAME))]
+    if len(jobs) < len(shards):
+        print(f"{len(shards) - len(jobs)} of {len(shards)} shards were exported already")
+
+    failed = 0
+    with Pool(processes) as pool:
+        for shard, shard_written, shard_failed in pool.imap_unordered(export_shard, jobs):
+            print(f"{shard_name(shard)}: {shard_written} samples" + (f", {shard_failed} failed" if shard_failed else ""))
+            failed += shard_failed
+    return failed
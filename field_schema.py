@@ -0,0 +1,119 @@
+from annotation_schema import FIELDS_IMAGE_COLUMN, MARKER
+
+
+# The fields of a SpeedyBatv2.0.py project are kept in their own table of the annotation store,
+# like the pre-screening results, so reopening a project does not ask for them again
+SCHEMA_TABLE = "schema"
+SCHEMA_COLUMNS = ("Column", "Label", "Shortcut", "Removed")
+
+
+class FieldSchema:
+    """Fields of a SpeedyBatv2.0.py project and the keys that toggle them.
+
+    Every field is stored in a column whose name never changes once the field is made;
+    the label is what the checkbox and the exported workbook show. Renaming a field
+    changes its label and removing one hides its column, the values stay in the store.
+    A new field is a new column that existing rows leave empty. None of them rewrites
+    the annotations.
+
+    `keys` maps a key to the column it toggles, kept up to date with every assignment,
+    so a key press is a single lookup.
+    """
+
+    def __init__(self, fields=()):
+        self.labels = {}  # Column -> label of the shown fields, in checkbox order
+        self.removed = {}  # Column -> label of removed fields
+        self.shortcuts = {}  # Column -> key
+        self.keys = {}  # Key -> column
+        for label in fields:
+            self.add(label)
+
+    @property
+    def fields(self):
+        """Columns of the shown fields."""
+        return list(self.labels)
+
+    def label(self, column):
+        return self.labels.get(column, self.removed.get(column, column))
+
+    def column_of(self, label):
+        for column, field_label in self.labels.items():
+            if field_label == label:
+                return column
+        return None
+
+    def add(self, label, shortcut=None):
+        """Column of a new field, or None if a field with this label is shown already."""
+        if not label or self.column_of(label) is not None:
+            return None
+
+        # A removed field with the same label comes back with its values
+        column = next((column for column, old_label in self.removed.items() if old_label == label), None)
+        if column is not None:
+            del self.removed[column]
+        else:
+            column, number = label, 2
+            while column in self.labels or column in self.removed or column == FIELDS_IMAGE_COLUMN:
+                column = f"{label} ({number})"
+                number += 1
+        self.labels[column] = label
+        self.assign(column, shortcut)
+        return column
+
+    def rename(self, column, label):
+        """Returns False if another shown field has this label already."""
+        if not label or column not in self.labels:
+            return False
+        other = self.column_of(label)
+        if other is not None and other != column:
+            return False
+        self.labels[column] = label
+        return True
+
+    def remove(self, column):
+        if column in self.labels:
+            self.removed[column] = self.labels.pop(column)
+            self.unassign(column)
+
+    def assign(self, column, key):
+        """Let `key`, a single character, toggle the field in `column`; the field that had it loses it."""
+        if not key or len(key) != 1 or column not in self.labels:
+            return
+        self.unassign(column)
+        previous = self.keys.get(key)
+        if previous is not None:
+            del self.shortcuts[previous]
+        self.shortcuts[column] = key
+        self.keys[key] = column
+
+    def unassign(self, column):
+        key = self.shortcuts.pop(column, None)
+        if key is not None:
+            del self.keys[key]
+
+    def table(self):
+        """(SCHEMA_COLUMNS, rows) for the schema table, shown fields first."""
+        rows = [[column, label, self.shortcuts.get(column), None] for column, label in self.labels.items()]
+        rows += [[column, label, None, MARKER] for column, label in self.removed.items()]
+        return SCHEMA_COLUMNS, rows
+
+    @classmethod
+    def from_table(cls, table, columns=()):
+        """Schema from a stored schema table (None if there is none) and the columns of the
+        annotation table. Columns the schema does not know, e.g. of a table from before it
+        was stored or imported from annotations.xlsx, become fields labelled by their name."""
+        schema = cls()
+        if table is not None:
+            names, rows = table
+            index = {name: i for i, name in enumerate(names)}
+            for row in rows:
+                column, label = row[index["Column"]], row[index["Label"]] or row[index["Column"]]
+                if row[index["Removed"]] == MARKER:
+                    schema.removed[column] = label
+                else:
+                    schema.labels[column] = label
+                    schema.assign(column, row[index["Shortcut"]])
+        for column in columns:
+            if column not in schema.labels and column not in schema.removed:
+                schema.labels[column] = column
+        return schema
@@ -0,0 +1,136 @@
+import json
+import os
+import queue
+import sys
+import threading
+
+
+MANIFEST_NAME = "annotations.manifest.json"
+
+
+class ScanResult:
+    def __init__(self, names, added, removed, changed):
+        self.names = names  # All matching names, manifest order first, new ones appended
+        self.added = added
+        self.removed = removed
+        self.changed = changed  # Same name, different size or mtime
+
+
+class FolderScanner:
+    """Lists the images of a recording folder with os.scandir on a worker thread.
+
+    Names arrive in batches through `take_batches` so the first image can be shown
+    while a large or remote folder is still being listed. A manifest of name, size
+    and mtime is kept next to the annotations; reopening a project returns the
+    cached names at once and the rescan only reports what changed.
+    """
+
+    def __init__(self, folder_path, extensions, ignore_case=True, first_batch_size=200, batch_size=5000):
+        self.folder_path = folder_path
+        self.extensions = tuple(extension.lower() for extension in extensions) if ignore_case else tuple(extensions)
+        self.ignore_case = ignore_case
+        self.first_batch_size = first_batch_size
+        self.batch_size = batch_size
+        self.manifest_path = os.path.join(folder_path, MANIFEST_NAME)
+
+        self.entries = self._load_manifest()  # name -> (size, mtime_ns)
+        self.result = None  # ScanResult once the scan finished
+        self.error = None
+
+        self._batches = queue.Queue()
+        self._thread = None
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding="utf-8") as file:
+                # Interned, like the names of the annotation index, so both share one copy. The folder
+                # may have been scanned for other files before, e.g. "From .wav" and then as images
+                return {sys.intern(name): (size, mtime) for name, size, mtime in json.load(file)["entries"]
+                        if self.matches(name)}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def _save_manifest(self, entries):
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump({"version": 1, "entries": [[name, size, mtime] for name, (size, mtime) in entries.items()]},
+                      file)
+        os.replace(temp_path, self.manifest_path)
+
+    def cached_names(self):
+        """Names from the manifest of the previous scan, or None if there is none."""
+        return list(self.entries) if self.entries else None
+
+    def matches(self, name):
+        return (name.lower() if self.ignore_case else name).endswith(self.extensions)
+
+    def scan(self):
+        """Scan on the calling thread, streaming batches of new names, and return a ScanResult."""
+        known = self.entries
+        entries = {}
+        added = []
+        changed = []
+        batch = []
+        batch_size = self.first_batch_size
+
+        with os.scandir(self.folder_path) as iterator:
+            for entry in iterator:
+                if not self.matches(entry.name) or not entry.is_file():
+                    continue
+                name = sys.intern(entry.name)
+                stat = entry.stat()
+                entries[name] = (stat.st_size, stat.st_mtime_ns)
+
+                previous = known.get(name)
+                if previous is None:
+                    added.append(name)
+                    batch.append(name)
+                    if len(batch) >= batch_size:
+                        self._batches.put(batch)
+                        batch = []
+                        batch_size = self.batch_size
+                elif tuple(previous) != entries[name]:
+                    changed.append(name)
+
+        if batch:
+            self._batches.put(batch)
+
+        removed = [name for name in known if name not in entries]
+        names = [name for name in known if name in entries] + added
+        ordered = {name: entries[name] for name in names}
+        if added or removed or changed or not os.path.exists(self.manifest_path):
+            self._save_manifest(ordered)
+        self.entries = ordered
+        return ScanResult(names, added, removed, changed)
+
+    def start(self):
+        def run():
+            try:
+                self.result = self.scan()
+            except OSError as error:
+                self.error = error
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def take_batches(self):
+        """Batches of names not in the manifest that arrived since the last call."""
+        batches = []
+        while True:
+            try:
+                batches.append(self._batches.get_nowait())
+            except queue.Empty:
+                return batches
+
+    def done(self):
+        return self._thread is not None and not self._thread.is_alive() and self._batches.empty()
+
+
+def wav_path_for_image(image_path):
+    if image_path.lower().endswith(".wav"):
+        return image_path  # Rendered straight from the recording
+    # Spectrograms sit in a subfolder of the recordings: <recordings>/<images>/IMG_<name>.jpg -> <recordings>/<name>.wav
+    file_name = os.path.basename(image_path)
+    if file_name.startswith("IMG_"):
+        file_name = file_name[len("IMG_"):]
+    recordings_folder = os.path.dirname(os.path.dirname(os.path.abspath(image_path)))
+    return os.path.join(recordings_folder, file_name.split(".")[0] + ".wav")
@@ -0,0 +1,329 @@
+import queue
+import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import ImageTk
+
+from image_cache import ImageCache
+from navigation import ResizeDebouncer
+
+
+class GridView:
+    """Contact sheet of downscaled spectrograms, `columns` x `rows` cells per screen.
+
+    Scrolling is virtual: there is one label per visible cell, and only the images of
+    the screen that is shown and the next one are decoded, on a pool of worker threads,
+    into a cache of a few screens. Marks are made in batches, `mark(positions, column)`
+    gets every selected cell in one call.
+
+    The images are the positions 0 .. count() - 1, `path_of(position)` gives the file
+    and `status(position)` the text under a cell, empty for images without annotations.
+    """
+
+    layouts = {"3": (3, 3), "4": (4, 4), "6": (6, 6), "8": (8, 8)}  # Keys switching the number of cells
+
+    def __init__(self, master, count, path_of, render, status, mark, open_image=None, on_close=None,
+                 start=0, columns=4, rows=4, thumbnails=None, workers=4):
+        self.count = count
+        self.path_of = path_of
+        self.render = render  # render(path, size) -> PIL image, runs on the workers
+        self.status = status
+        self.mark = mark
+        self.open_image = open_image
+        self.on_close = on_close
+        self.thumbnails = thumbnails  # Disk cache of resized copies, shared with the annotator
+        self.columns, self.rows = columns, rows
+
+        self.first = start - start % columns  # Position of the top left cell
+        self.cursor = start
+        self.selected = set()
+        self.anchor = start  # Where a Shift-click range starts
+        self.cell_size = None  # Image size in a cell, known once the window is mapped
+
+        self.cache = ImageCache(max_bytes=96 * 1024 * 1024)
+        self.keys = {}  # Path -> cache key, so a file is stat'ed once per cell size and not on every refresh
+        self.executor = ThreadPoolExecutor(workers)
+        self.jobs = {}  # Cache key -> future of the decode
+        self.decoded = queue.Queue()  # (key, image) handed from the workers to the Tk thread
+
+        self.window = tk.Toplevel(master)
+        self.window.title("Grid")
+        self.window.geometry("1200x800")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.scrollbar = tk.Scrollbar(self.window, command=self.scroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.frame = tk.Frame(self.window)
+        self.frame.pack(side="left", fill="both", expand=True)
+        self.frame.grid_propagate(False)  # The images never make the cells grow
+        self.cells = []
+        self.cell_keys = []  # Cache key of the image every label shows now
+        self.visible_keys = set()
+
+        self.resizes = ResizeDebouncer(self.window, lambda size: None, self.resized, delay_ms=150)
+        self.bind_keys()
+        self.build_cells()
+        self.poll_id = self.window.after(30, self.poll)
+
+    def bind_keys(self):
+        window = self.window
+        window.bind("<n>", lambda event: self.mark_selection("None"))
+        window.bind("<b>", lambda event: self.mark_selection("Bat"))
+        window.bind("<Shift-N>", lambda event: self.mark_rest_none())
+        window.bind("<Control-a>", lambda event: self.select_screen())
+        window.bind("<Escape>", lambda event: self.clear_selection())
+        window.bind("<space>", lambda event: self.toggle_selected(self.cursor))
+        window.bind("<Return>", lambda event: self.open(self.cursor))
+        window.bind("<Left>", lambda event: self.move_cursor(-1))
+        window.bind("<Right>", lambda event: self.move_cursor(1))
+        window.bind("<Up>", lambda event: self.move_cursor(-self.columns))
+        window.bind("<Down>", lambda event: self.move_cursor(self.columns))
+        window.bind("<Prior>", lambda event: self.scroll("scroll", -1, "pages"))
+        window.bind("<Next>", lambda event: self.scroll("scroll", 1, "pages"))
+        window.bind("<Home>", lambda event: self.scroll("moveto", 0))
+        window.bind("<End>", lambda event: self.scroll("moveto", 1))
+        window.bind("<MouseWheel>", lambda event: self.scroll("scroll", -1 if event.delta > 0 else 1, "units"))
+        window.bind("<Button-4>", lambda event: self.scroll("scroll", -1, "units"))  # Wheel on X11
+        window.bind("<Button-5>", lambda event: self.scroll("scroll", 1, "units"))
+        for key, (columns, rows) in self.layouts.items():
+            window.bind(f"<Key-{key}>", lambda event, columns=columns, rows=rows: self.set_layout(columns, rows))
+
+    def visible_count(self):
+        return self.columns * self.rows
+
+    def visible_positions(self):
+        return range(self.first, min(self.first + self.visible_count(), self.count()))
+
+    def build_cells(self):
+        for cell in self.cells:
+            cell.destroy()
+        self.cells = []
+        self.cell_keys = [None] * self.visible_count()
+        for i in range(self.visible_count()):
+            cell = tk.Label(self.frame, compound="top", borderwidth=3, relief="flat")
+            cell.image = None
+            cell.grid(row=i // self.columns, column=i % self.columns, sticky="nsew", padx=1, pady=1)
+            cell.bind("<Button-1>", lambda event, i=i: self.click(i, event))
+            cell.bind("<Double-Button-1>", lambda event, i=i: self.open(self.first + i))
+            self.cells.append(cell)
+        for column in range(self.columns):
+            self.frame.columnconfigure(column, weight=1, uniform="cell")
+        for row in range(self.rows):
+            self.frame.rowconfigure(row, weight=1, uniform="cell")
+        # Rows and columns of a larger layout before this one would keep their weight
+        for column in range(self.columns, 8):
+            self.frame.columnconfigure(column, weight=0, uniform="")
+        for row in range(self.rows, 8):
+            self.frame.rowconfigure(row, weight=0, uniform="")
+
+    def set_layout(self, columns, rows):
+        if (columns, rows) == (self.columns, self.rows):
+            return
+        self.columns, self.rows = columns, rows
+        self.first = self.cursor - self.cursor % columns
+        self.build_cells()
+        self.resized((self.window.winfo_width(), self.window.winfo_height()))
+
+    def resized(self, size):
+        # Room for the status line and the border under every image
+        width = (size[0] - self.scrollbar.winfo_width()) // self.columns - 10
+        height = size[1] // self.rows - 30
+        cell_size = (max(width, 16), max(height, 16))
+        if cell_size != self.cell_size:
+            self.cell_size = cell_size
+            self.cancel_jobs(keep=())
+            self.cache.clear()
+            self.keys.clear()
+            self.cell_keys = [None] * self.visible_count()
+        self.refresh()
+
+    def key(self, position):
+        path = self.path_of(position)
+        key = self.keys.get(path)
+        if key is None:
+            key = self.keys[path] = self.cache.make_key(path, self.cell_size)
+        return key
+
+    def refresh(self):
+        """Show the cells of the current screen, decode what is missing and the next screen ahead."""
+        if self.cell_size is None:
+            return
+        count = self.count()
+        self.first = max(0, min(self.first, self.last_first(count)))
+        wanted = {}
+        for i, cell in enumerate(self.cells):
+            position = self.first + i
+            if position >= count:
+                if self.cell_keys[i] is not None or cell.cget("text"):
+                    cell.configure(image="", text="")
+                    cell.image = None
+                    self.cell_keys[i] = None
+                continue
+            key = self.key(position)
+            wanted[key] = position
+            self.show_cell(i, position, key)
+        self.visible_keys = set(wanted)
+
+        # The screen below is decoded after the visible one, so scrolling on shows it at once
+        ahead = range(self.first + self.visible_count(), min(self.first + 2 * self.visible_count(), count))
+        for position in ahead:
+            wanted[self.key(position)] = position
+        self.cancel_jobs(keep=wanted)
+        for key, position in wanted.items():
+            self.request(key, position)
+
+        total = max(count, 1)
+        self.scrollbar.set(self.first / total, min(self.first + self.visible_count(), total) / total)
+
+    def show_cell(self, i, position, key):
+        cell = self.cells[i]
+        if self.cell_keys[i] != key:
+            image = self.cache.get(key, count=False)
+            if image is not None:
+                photo = ImageTk.PhotoImage(image)
+                cell.configure(image=photo)
+                cell.image = photo
+                self.cell_keys[i] = key
+            elif cell.image is not None:
+                cell.configure(image="")
+                cell.image = None
+                self.cell_keys[i] = None
+        selected = position in self.selected
+        cell.configure(text=self.status(position) or " ",
+                       bg="#3a6ea5" if selected else self.frame.cget("bg"),
+                       relief="solid" if position == self.cursor else "flat")
+
+    def request(self, key, position):
+        if key in self.jobs or key in self.cache:
+            return
+        self.jobs[key] = self.executor.submit(self.decode, key, self.path_of(position), self.cell_size)
+
+    def decode(self, key, path, size):
+        # Runs on the worker threads, no Tk calls in here
+        try:
+            if self.thumbnails is not None:
+                image = self.thumbnails.get_or_render(path, size, self.render)
+            else:
+                image = self.render(path, size)
+        except Exception as error:
+            print(f"Unable to show {path} in the grid: {error}")
+            image = None
+        self.decoded.put((key, image))
+
+    def cancel_jobs(self, keep):
+        # Decodes that did not start yet and are not on or near the screen any more
+        for key in [key for key in self.jobs if key not in keep]:
+            if self.jobs[key].cancel():
+                del self.jobs[key]
+
+    def poll(self):
+        changed = False
+        while True:
+            try:
+                key, image = self.decoded.get_nowait()
+            except queue.Empty:
+                break
+            self.jobs.pop(key, None)
+            if image is not None and key[2] == self.cell_size:
+                self.cache.put(key, image)
+                changed = changed or key in self.visible_keys
+        if changed:
+            self.refresh()
+        self.poll_id = self.window.after(30, self.poll)
+
+    def last_first(self, count):
+        # The last screen starts at a whole row and is as full as possible
+        last_row_start = max(count - 1, 0) - max(count - 1, 0) % self.columns
+        return max(0, last_row_start - (self.rows - 1) * self.columns)
+
+    def scroll(self, action, amount=0, unit="units"):
+        count = self.count()
+        if action == "moveto":
+            first = int(float(amount) * count)
+        elif unit == "pages":
+            first = self.first + int(amount) * self.visible_count()
+        else:
+            first = self.first + int(amount) * self.columns
+        first = max(0, min(first - first % self.columns, self.last_first(count)))
+        if first != self.first:
+            self.first = first
+            self.cursor = min(max(self.cursor, first), first + self.visible_count() - 1, count - 1)
+            self.refresh()
+
+    def move_cursor(self, offset):
+        position = self.cursor + offset
+        if not 0 <= position < self.count():
+            return
+        self.cursor = position
+        if position < self.first:
+            self.first = position - position % self.columns
+        elif position >= self.first + self.visible_count():
+            self.first = position - position % self.columns - (self.rows - 1) * self.columns
+        self.refresh()
+
+    def click(self, i, event):
+        position = self.first + i
+        if position >= self.count():
+            return
+        if event.state & 0x0001:  # Shift, everything from the last click up to this cell
+            low, high = sorted((self.anchor, position))
+            self.selected.update(range(low, high + 1))
+        elif event.state & 0x0004:  # Control, add or remove one cell
+            self.selected.symmetric_difference_update({position})
+            self.anchor = position
+        else:
+            self.selected = {position}
+            self.anchor = position
+        self.cursor = position
+        self.refresh()
+
+    def toggle_selected(self, position):
+        self.selected.symmetric_difference_update({position})
+        self.anchor = position
+        self.refresh()
+
+    def select_screen(self):
+        self.selected.update(self.visible_positions())
+        self.refresh()
+
+    def clear_selection(self):
+        self.selected.clear()
+        self.refresh()
+
+    def mark_selection(self, column):
+        # The selected cells, or the cursor cell when nothing is selected
+        positions = sorted(self.selected) if self.selected else [self.cursor]
+        positions = [position for position in positions if position < self.count()]
+        if positions:
+            self.mark(positions, column)
+        self.selected.clear()
+        self.refresh()
+
+    def mark_rest_none(self):
+        # Every cell on the screen without annotations is 'None', then on to the next screen
+        positions = [position for position in self.visible_positions() if not self.status(position)]
+        if positions:
+            self.mark(positions, "None")
+        self.selected.clear()
+        self.scroll("scroll", 1, "pages")
+        self.refresh()
+
+    def open(self, position):
+        if self.open_image is not None and position < self.count():
+            self.open_image(position)
+
+    def lift(self):
+        self.window.deiconify()
+        self.window.lift()
+        self.window.focus_set()
+
+    def close(self):
+        self.window.after_cancel(self.poll_id)
+        self.resizes.cancel()
+        for future in self.jobs.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        self.cache.clear()
+        self.window.destroy()
+        if self.on_close is not None:
+            self.on_close()
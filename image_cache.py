@@ -0,0 +1,281 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from PIL import Image
+
+
+# Display quality. FAST is used while the user is flipping through images quickly,
+# HIGH once they stop on one.
+FAST = "fast"
+HIGH = "high"
+
+
+def open_reduced(image_path, size):
+    """Open and decode an image as cheaply as possible while staying at least `size` large.
+
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale straight from the file (draft mode),
+    other formats are box-reduced by an integer factor before the real resample.
+    """
+    image = Image.open(image_path)
+    if image.format == "JPEG":
+        image.draft(image.mode, size)
+    image.load()
+
+    factor = min(image.width // max(size[0], 1), image.height // max(size[1], 1))
+    if factor >= 2:
+        # reduce averages pixel values, palette indices, 1-bit and 16-bit images are converted first
+        mode = reducible_mode(image)
+        if mode != image.mode:
+            converted = image.convert(mode)
+            image.close()
+            image = converted
+        reduced = image.reduce(factor)
+        image.close()
+        image = reduced
+    return image
+
+
+def reducible_mode(image):
+    """The mode an image is converted to before Image.reduce, its own mode if reduce supports it."""
+    if image.mode in ("P", "PA"):
+        return "RGBA" if image.mode == "PA" or "transparency" in image.info else "RGB"
+    if image.mode == "1":
+        return "L"
+    if image.mode.startswith("I;16"):
+        return "I"
+    return image.mode
+
+
+# Decoders used by the annotators. They are module level functions so worker
+# processes (see thumbnail_cache.ThumbnailCache.warm) can run them too.
+
+def thumbnail_image(image_path, size, quality=HIGH):
+    # SpeedyBat.py: Pillow's thumbnail, never enlarges
+    image = open_reduced(image_path, size)
+    resample = Image.Resampling.BILINEAR if quality == FAST else Image.Resampling.BICUBIC
+    image.thumbnail(size, resample)  # Resize the image to fit the window
+    return image
+
+
+def fit_image(image_path, size, quality=HIGH):
+    # SpeedyBatv2.0.py: scale up or down to fit, LANCZOS resampling
+    max_width, max_height = size
+    with open_reduced(image_path, size) as image:
+        # Determine scale factor to fit the image within the target dimensions
+        scale_factor = min(max_width / image.width, max_height / image.height)
+
+        # Resize the image while maintaining the aspect ratio
+        new_width = int(image.width * scale_factor)
+        new_height = int(image.height * scale_factor)
+        resample = Image.Resampling.BILINEAR if quality == FAST else Image.Resampling.LANCZOS
+        return image.resize((new_width, new_height), resample)
+
+
+def rescale_image(image, size):
+    # Fit an image decoded for another window size into `size`, a preview while the window is resized
+    scale = min(size[0] / image.width, size[1] / image.height)
+    new_size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    return image.resize(new_size, Image.Resampling.BILINEAR)
+
+
+class ImageCache:
+    """Bounded LRU cache of decoded, display-sized images keyed by (path, mtime, size, quality)."""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # key -> (image, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(path, size, quality=HIGH):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        return path, mtime, tuple(size), quality
+
+    @staticmethod
+    def image_bytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key, count=True):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, image):
+        nbytes = self.image_bytes(image)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+            self._entries[key] = (image, nbytes)
+            self._bytes += nbytes
+
+            # Evict least recently used images until we are within budget
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "entries": len(self._entries),
+                    "bytes": self._bytes}
+
+
+class ImagePrefetcher:
+    """Decodes and resizes images on worker threads ahead of navigation.
+
+    `loader(path, size, quality)` must return a fully loaded PIL image. Only PIL work
+    happens on the workers; building the ImageTk.PhotoImage stays on the Tk thread.
+    Workers always decode at HIGH quality; FAST previews are only made on request.
+    """
+
+    def __init__(self, loader, cache=None, workers=2):
+        self.loader = loader
+        self.cache = cache if cache is not None else ImageCache()
+        self.target_size = None
+        self.decode_times = deque(maxlen=500)  # (quality, seconds) of recent decodes
+
+        self._pending = []  # Paths still to decode, most urgent first
+        self._inflight = {}  # key -> threading.Event, set when the decode finished
+        self._condition = threading.Condition()
+        self._stopped = False
+
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def set_target_size(self, size):
+        size = tuple(size)
+        if size == self.target_size:
+            return
+
+        # Window was resized, everything decoded so far has the wrong size
+        with self._condition:
+            self.target_size = size
+            self.cache.clear()
+            self._pending = []
+
+    def peek(self, path, quality=HIGH):
+        """The cached image, or None without decoding."""
+        return self.cache.get(self.cache.make_key(path, self.target_size, quality), count=False)
+
+    def get(self, path, quality=HIGH):
+        size = self.target_size
+        key = self.cache.make_key(path, size, quality)
+
+        image = self.cache.get(key)
+        if image is not None:
+            return image
+
+        # A worker may already be decoding this image, wait for it instead of decoding twice
+        with self._condition:
+            event = self._inflight.get(key)
+        if event is not None:
+            event.wait()
+            image = self.cache.get(key, count=False)
+            if image is not None:
+                return image
+
+        image = self._decode(path, size, quality)
+        self.cache.put(key, image)
+        return image
+
+    def _decode(self, path, size, quality):
+        start = time.perf_counter()
+        image = self.loader(path, size, quality)
+        self.decode_times.append((quality, time.perf_counter() - start))
+        return image
+
+    def decode_stats(self):
+        """Count, mean and 95th percentile decode time in milliseconds per quality."""
+        stats = {}
+        for quality in (FAST, HIGH):
+            times = sorted(seconds for kind, seconds in list(self.decode_times) if kind == quality)
+            if times:
+                stats[quality] = {"count": len(times),
+                                  "mean_ms": 1000 * sum(times) / len(times),
+                                  "p95_ms": 1000 * times[int(0.95 * (len(times) - 1))]}
+        return stats
+
+    def schedule(self, paths):
+        # Replace whatever was queued, only the neighbours of the current image matter
+        with self._condition:
+            if self.target_size is None:
+                return
+            self._pending = list(paths)
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._pending = []
+            self._condition.notify_all()
+
+    def stats(self):
+        return dict(self.cache.stats(), decode=self.decode_stats())
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                if self._stopped:
+                    return None
+                while self._pending:
+                    path = self._pending.pop(0)
+                    key = self.cache.make_key(path, self.target_size)
+                    if key in self._inflight or key in self.cache:
+                        continue
+                    event = threading.Event()
+                    self._inflight[key] = event
+                    return path, key, event
+                self._condition.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            path, key, event = job
+            try:
+                image = self._decode(path, key[2], HIGH)
+                # Drop results decoded for a window size that is no longer current
+                if key[2] == self.target_size:
+                    self.cache.put(key, image)
+            except Exception as error:
+                print(f"Prefetch failed for {path}: {error}")
+            finally:
+                with self._condition:
+                    del self._inflight[key]
+                event.set()
@@ -0,0 +1,100 @@
+import csv
+import functools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class Profiler:
+    """Rolling per-stage timings of the annotation loop.
+
+    Stages are timed with `with profiler.stage("decode"):` or `record`. The last `window`
+    timings of every stage are kept for percentiles; the raw events go to a bounded
+    trace that can be exported as CSV or JSON. Safe to use from worker threads.
+    """
+
+    def __init__(self, enabled=True, window=1000, trace_size=100000):
+        self.enabled = enabled
+        self.window = window
+        self.origin = time.perf_counter()
+
+        self._timings = {}  # Stage -> deque of seconds
+        self._trace = deque(maxlen=trace_size)  # (stage, start, seconds, thread name)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, start)
+
+    def record(self, name, seconds, start=None):
+        if not self.enabled:
+            return
+        if start is None:
+            start = time.perf_counter() - seconds
+        with self._lock:
+            timings = self._timings.get(name)
+            if timings is None:
+                timings = self._timings[name] = deque(maxlen=self.window)
+            timings.append(seconds)
+            self._trace.append((name, start - self.origin, seconds, threading.current_thread().name))
+
+    def summary(self):
+        """Stage -> count, total, p50, p95, p99 and max in milliseconds over the rolling window."""
+        with self._lock:
+            timings = {name: sorted(values) for name, values in self._timings.items() if values}
+        summary = {}
+        for name, values in timings.items():
+            def percentile(fraction):
+                return 1000 * values[min(len(values) - 1, int(fraction * len(values)))]
+            summary[name] = {"count": len(values),
+                             "total_ms": 1000 * sum(values),
+                             "p50_ms": percentile(0.50),
+                             "p95_ms": percentile(0.95),
+                             "p99_ms": percentile(0.99),
+                             "max_ms": 1000 * values[-1]}
+        return summary
+
+    def format_summary(self):
+        lines = [f"{'stage':<16}{'n':>6}{'p50':>8}{'p95':>8}{'p99':>8}"]
+        for name, stats in sorted(self.summary().items()):
+            lines.append(f"{name:<16}{stats['count']:>6}{stats['p50_ms']:>8.1f}"
+                         f"{stats['p95_ms']:>8.1f}{stats['p99_ms']:>8.1f}")
+        return "\n".join(lines)
+
+    def export(self, path):
+        """Write the trace, CSV for a .csv path and JSON (trace plus summary) otherwise."""
+        with self._lock:
+            trace = list(self._trace)
+        if path.endswith(".csv"):
+            with open(path, "w", newline="", encoding="utf-8") as file:
+                writer = csv.writer(file)
+                writer.writerow(["stage", "start_ms", "duration_ms", "thread"])
+                for name, start, seconds, thread in trace:
+                    writer.writerow([name, f"{1000 * start:.3f}", f"{1000 * seconds:.3f}", thread])
+        else:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump({"summary": self.summary(),
+                           "events": [{"stage": name, "start_ms": 1000 * start, "duration_ms": 1000 * seconds,
+                                       "thread": thread} for name, start, seconds, thread in trace]},
+                          file, indent=1)
+        return len(trace)
+
+
+def profiled(stage):
+    """Method decorator, times every call as `stage` with the `profiler` of the instance."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
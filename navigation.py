@@ -0,0 +1,144 @@
+import time
+
+
+class NavigationScheduler:
+    """Coalesces rapid navigation so only the image the user ends up on is rendered.
+
+    Moving to another image (saving the previous annotations, loading the new ones into
+    the widgets) is cheap and happens for every key event. Decoding and drawing is not:
+    `request_render` only asks for `render` to run once Tk is idle, so a burst of key
+    events (key repeat, fast typing) is handled first and renders a single image.
+
+    Timed moves, like the short pause after marking an image 'None', go through
+    `move_later` instead of sleeping on the Tk thread. `settle` runs a move that is
+    still waiting, so the next key acts on the image the user expects.
+
+    With a `profiler`, the time from the first request of a burst to the end of its
+    render is recorded as the "input_to_image" stage.
+    """
+
+    def __init__(self, widget, render, profiler=None):
+        self.widget = widget
+        self.render = render
+        self.profiler = profiler
+        self.requests = 0
+        self.renders = 0
+
+        self._requested_at = None
+        self._render_id = None
+        self._move_id = None
+        self._move = None
+
+    def request_render(self):
+        self.requests += 1
+        if self._render_id is None:
+            self._requested_at = time.perf_counter()
+            self._render_id = self.widget.after_idle(self._render)
+
+    def _render(self):
+        self._render_id = None
+        self.renders += 1
+        self.render()
+        if self.profiler is not None:
+            self.profiler.record("input_to_image", time.perf_counter() - self._requested_at, self._requested_at)
+
+    def flush(self):
+        """Render now if a render is still waiting."""
+        if self._render_id is not None:
+            self.widget.after_cancel(self._render_id)
+            self._render()
+
+    def move_later(self, delay_ms, move):
+        self.settle()
+        self._move = move
+        self._move_id = self.widget.after(delay_ms, self._run_move)
+
+    def _run_move(self):
+        move = self._move
+        self._move_id = None
+        self._move = None
+        if move is not None:
+            move()
+
+    def settle(self):
+        """Run a delayed move right away instead of waiting for its timer."""
+        if self._move_id is not None:
+            self.widget.after_cancel(self._move_id)
+            self._run_move()
+
+    def cancel(self):
+        for after_id in (self._render_id, self._move_id):
+            if after_id is not None:
+                self.widget.after_cancel(after_id)
+        self._render_id = None
+        self._move_id = None
+        self._move = None
+
+    def stats(self):
+        return {"requests": self.requests,
+                "renders": self.renders,
+                "coalesced": self.requests - self.renders}
+
+
+class ResizeDebouncer:
+    """Follows the size of a window without re-rendering for every step of a drag.
+
+    Tk sends a <Configure> event for every pixel a window is dragged larger or smaller.
+    `preview(size)` runs at most once per idle loop for the latest size, e.g. to rescale
+    the image that is already decoded. `settled(size)` runs once no new size came for
+    `delay_ms`, e.g. to decode the image again at the new size.
+    """
+
+    def __init__(self, widget, preview, settled, delay_ms=250):
+        self.widget = widget
+        self.preview = preview
+        self.settled = settled
+        self.delay_ms = delay_ms
+        self.size = None  # Last size that settled
+        self.events = 0
+        self.settles = 0
+
+        self._size = None  # Latest size, not settled yet
+        self._preview_id = None
+        self._settle_id = None
+        widget.bind("<Configure>", self._configure, add="+")
+
+    def _configure(self, event):
+        # The binding on a toplevel also gets the events of every widget inside it
+        if event.widget is not self.widget:
+            return
+        size = (event.width, event.height)
+        if size == (self._size or self.size):
+            return  # Moved, not resized
+        self.events += 1
+        self._size = size
+        if self._preview_id is None and self.size is not None:
+            self._preview_id = self.widget.after_idle(self._preview)
+        if self._settle_id is not None:
+            self.widget.after_cancel(self._settle_id)
+        self._settle_id = self.widget.after(self.delay_ms, self._settle)
+
+    def _preview(self):
+        self._preview_id = None
+        if self._size is not None:
+            self.preview(self._size)
+
+    def _settle(self):
+        self._settle_id = None
+        size, self._size = self._size, None
+        if size is None or size == self.size:
+            return
+        self.size = size
+        self.settles += 1
+        self.settled(size)
+
+    def cancel(self):
+        for after_id in (self._preview_id, self._settle_id):
+            if after_id is not None:
+                self.widget.after_cancel(after_id)
+        self._preview_id = None
+        self._settle_id = None
+
+    def stats(self):
+        return {"events": self.events,
+                "settles": self.settles}
@@ -0,0 +1,94 @@
+import numpy as np
+
+
+class PendingMask:
+    """Boolean array over navigation positions, True where an image still needs annotating.
+
+    Updates are O(1) and the pending count is kept up to date with them. Searches scan
+    in vectorised chunks starting at the current position, so their cost depends on the
+    distance to the next pending image rather than on the size of the folder.
+
+    Positions can also be deferred, e.g. recordings the pre-screener is confident are
+    empty. Searches with `defer=True` only return those once nothing else is pending.
+    """
+
+    chunk_size = 4096
+
+    def __init__(self, pending):
+        self.pending = np.array(pending, dtype=bool)
+        self.pending_count = int(self.pending.sum())
+        self.deferred = np.zeros(len(self.pending), dtype=bool)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def extend(self, pending):
+        pending = np.asarray(pending, dtype=bool)
+        self.pending = np.concatenate([self.pending, pending])
+        self.deferred = np.concatenate([self.deferred, np.zeros(len(pending), dtype=bool)])
+        self.pending_count += int(pending.sum())
+
+    def is_pending(self, position):
+        return bool(self.pending[position])
+
+    def set_annotated(self, position, annotated):
+        pending = not annotated
+        if self.pending[position] != pending:
+            self.pending[position] = pending
+            self.pending_count += 1 if pending else -1
+
+    def set_deferred(self, deferred):
+        self.deferred = np.array(deferred, dtype=bool)
+
+    def deferred_count(self):
+        """Pending positions that are deferred."""
+        return int(np.count_nonzero(self.pending & self.deferred))
+
+    def _chunk(self, start, stop, defer):
+        chunk = self.pending[start:stop]
+        return chunk & ~self.deferred[start:stop] if defer else chunk
+
+    def _search_forward(self, start, stop, defer=False):
+        for chunk_start in range(start, stop, self.chunk_size):
+            chunk = self._chunk(chunk_start, min(chunk_start + self.chunk_size, stop), defer)
+            hit = int(chunk.argmax())
+            if chunk[hit]:
+                return chunk_start + hit
+        return None
+
+    def _search_backward(self, start, stop, defer=False):
+        # Searches start, start - 1, ..., stop (inclusive)
+        for chunk_end in range(start + 1, stop, -self.chunk_size):
+            chunk_start = max(chunk_end - self.chunk_size, stop)
+            chunk = self._chunk(chunk_start, chunk_end, defer)[::-1]
+            hit = int(chunk.argmax())
+            if chunk[hit]:
+                return chunk_end - 1 - hit
+        return None
+
+    def next_pending(self, start, wrap=True, defer=False):
+        """First pending position at or after `start`, or None."""
+        if not self.pending_count:
+            return None
+        for skip in ((True, False) if defer else (False,)):
+            position = self._search_forward(start, len(self.pending), skip)
+            if position is None and wrap:
+                position = self._search_forward(0, start, skip)
+            if position is not None:
+                return position
+        return None
+
+    def previous_pending(self, start, wrap=True, defer=False):
+        """Last pending position at or before `start`, or None."""
+        if not self.pending_count:
+            return None
+        for skip in ((True, False) if defer else (False,)):
+            position = self._search_backward(start, 0, skip)
+            if position is None and wrap:
+                position = self._search_backward(len(self.pending) - 1, start + 1, skip)
+            if position is not None:
+                return position
+        return None
+
+    def first_pending(self, defer=False):
+        return self.next_pending(0, wrap=False, defer=defer)
@@ -0,0 +1,143 @@
+import math
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from image_cache import open_reduced
+from spectrogram import SpectrogramSettings, read_wav, spectrogram_columns
+
+
+# Pre-screening results are kept in their own table of the annotation store
+SCREENING_TABLE = "screening"
+SCREENING_COLUMNS = ("Image", "Suggestion", "Confidence", "Score")
+
+
+class ScreenSettings:
+    """How loud the bat band has to be above its own noise floor to suggest 'Bat'."""
+
+    def __init__(self, min_freq=15000, max_freq=None, fft_size=512, threshold_db=12.0, image_threshold=40.0,
+                 image_band=(0.0, 1.0), columns=512):
+        self.min_freq = min_freq  # Hz, recordings only
+        self.max_freq = max_freq  # Hz, None for the Nyquist frequency
+        self.fft_size = fft_size
+        self.threshold_db = threshold_db  # Recordings: dB above the noise floor
+        self.image_threshold = image_threshold  # Images: grey levels above the noise floor
+        self.image_band = image_band  # Images: rows to look at, as fractions from the top
+        self.columns = columns  # Time resolution of the screen
+
+
+def band_score(levels):
+    """Loudness of the strongest moment above the per-frequency noise floor.
+
+    `levels` is frequency by time. The floor of every frequency is its median over time,
+    so constant noise (insects, electronics) does not count. A column scores the mean of
+    its loudest tenth of frequencies, which a bat call fills but a single click does not.
+    """
+    if levels.size == 0:
+        return 0.0
+    excess = levels - np.median(levels, axis=1, keepdims=True)
+    top = max(1, levels.shape[0] // 10)
+    loudest = np.partition(excess, levels.shape[0] - top, axis=0)[-top:]
+    return float(loudest.mean(axis=0).max())
+
+
+def screen_wav(wav_path, settings):
+    sample_rate, samples = read_wav(wav_path)
+    stft = SpectrogramSettings(fft_size=settings.fft_size, overlap=0.5, min_freq=settings.min_freq,
+                               max_freq=settings.max_freq)
+    return band_score(spectrogram_columns(samples, sample_rate, settings.columns, stft)), settings.threshold_db
+
+
+def screen_image(image_path, settings):
+    with open_reduced(image_path, (settings.columns, settings.columns)) as image:
+        pixels = np.asarray(image.convert("L"), dtype=np.float32)
+    top, bottom = (int(round(fraction * pixels.shape[0])) for fraction in settings.image_band)
+    return band_score(pixels[top:bottom]), settings.image_threshold
+
+
+def screen_file(path, settings):
+    """(suggestion, confidence, score) for one image or recording."""
+    if path.lower().endswith(".wav"):
+        score, threshold = screen_wav(path, settings)
+    else:
+        score, threshold = screen_image(path, settings)
+
+    # Confidence grows with the distance from the threshold, 0.5 right at it
+    probability = 1 / (1 + math.exp(-(score - threshold) * 4 / threshold))
+    suggestion = 'Bat' if probability >= 0.5 else 'None'
+    return suggestion, max(probability, 1 - probability), score
+
+
+def _screen_one(job):
+    # Runs in a worker process
+    path, settings = job
+    try:
+        return path, screen_file(path, settings)
+    except (OSError, ValueError) as error:
+        return path, error
+
+
+class Prescreener:
+    """Screens files on a process pool from a background thread.
+
+    Like FolderScanner, results are collected on the Tk thread with `take_results`,
+    as (name, suggestion, confidence, score) rows in SCREENING_COLUMNS order.
+    """
+
+    def __init__(self, folder_path, names, settings=None, processes=None):
+        self.folder_path = folder_path
+        self.names = list(names)
+        self.settings = settings if settings is not None else ScreenSettings()
+        self.processes = processes
+        self.screened = 0
+        self.failed = 0
+
+        self._results = queue.Queue()
+        self._thread = None
+        self._stopped = False
+
+    def run(self):
+        jobs = [(os.path.join(self.folder_path, name), self.settings) for name in self.names]
+        with ProcessPoolExecutor(self.processes) as executor:
+            for name, (path, result) in zip(self.names, executor.map(_screen_one, jobs, chunksize=8)):
+                if self._stopped:
+                    executor.shutdown(cancel_futures=True)
+                    return
+                if isinstance(result, Exception):
+                    print(f"Pre-screening {path} failed: {result}")
+                    self.failed += 1
+                    continue
+                self._results.put([name, *result])
+                self.screened += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+
+    def take_results(self):
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def done(self):
+        return self._thread is not None and not self._thread.is_alive() and self._results.empty()
+
+
+def load_suggestions(store):
+    """Image name -> (suggestion, confidence, score) from the screening table of a store."""
+    table = store.load()
+    if table is None:
+        return {}
+    columns, rows = table
+    index = {column: i for i, column in enumerate(columns)}
+    return {row[0]: (row[index["Suggestion"]], float(row[index["Confidence"]] or 0), float(row[index["Score"]] or 0))
+            for row in rows}
@@ -0,0 +1,163 @@
+import os
+import struct
+
+import numpy as np
+from PIL import Image
+
+from image_cache import FAST, HIGH
+
+
+class SpectrogramSettings:
+    """STFT and display settings for spectrograms rendered straight from .wav recordings."""
+
+    def __init__(self, fft_size=512, overlap=0.75, min_freq=10000, max_freq=None, dynamic_range=70.0):
+        self.fft_size = fft_size
+        self.overlap = overlap  # Fraction of a window shared with the next one
+        self.min_freq = min_freq  # Hz, the band shown on screen
+        self.max_freq = max_freq  # Hz, None for the Nyquist frequency
+        self.dynamic_range = dynamic_range  # dB below the loudest bin that is still drawn
+
+    def hop(self):
+        return max(1, int(round(self.fft_size * (1 - self.overlap))))
+
+    def key(self):
+        # Part of the disk cache key, so changed settings never show an old rendering
+        return f"{self.fft_size}-{self.overlap}-{self.min_freq}-{self.max_freq}-{self.dynamic_range}"
+
+
+class WavInfo:
+    """Layout of a WAV file: its fmt chunk as stored and where the sample frames are."""
+
+    def __init__(self, fmt, data_offset, data_size):
+        self.fmt = fmt
+        audio_format, self.channels, self.sample_rate, _, self.block_align, self.bits = \
+            struct.unpack("<HHIIHH", fmt[:16])
+        if audio_format == 0xFFFE and len(fmt) >= 26:  # WAVE_FORMAT_EXTENSIBLE, the real format follows
+            audio_format = struct.unpack("<H", fmt[24:26])[0]
+        self.audio_format = audio_format
+        self.data_offset = data_offset
+        self.frames = data_size // self.block_align if self.block_align else 0
+
+
+def read_wav_info(wav_path):
+    """WavInfo of a WAV file, only its headers are read."""
+    with open(wav_path, "rb") as file:
+        header = file.read(12)
+        if len(header) < 12:
+            raise ValueError(f"{wav_path} is not a complete WAV file")
+        riff, _, wave = struct.unpack("<4sI4s", header)
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise ValueError(f"{wav_path} is not a WAV file")
+
+        fmt = None
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{wav_path} is not a complete WAV file")
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                fmt = file.read(chunk_size)
+                if len(fmt) < chunk_size:
+                    raise ValueError(f"{wav_path} is not a complete WAV file")
+                file.seek(chunk_size % 2, 1)
+            elif chunk_id == b"data":
+                data_offset = file.tell()
+                break
+            else:
+                file.seek(chunk_size + chunk_size % 2, 1)  # Chunks are padded to an even size
+
+    if fmt is None or len(fmt) < 16:
+        raise ValueError(f"{wav_path} has no fmt chunk")
+
+    # Recorders that were stopped abruptly may leave a wrong data size, trust the file size instead
+    return WavInfo(fmt, data_offset, min(chunk_size, os.path.getsize(wav_path) - data_offset))
+
+
+def read_wav(wav_path):
+    """(sample_rate, samples) with the samples memory-mapped, not read into memory.
+
+    Only the first channel is returned. 24-bit recordings cannot be mapped as a NumPy
+    dtype and are converted, which does read them.
+    """
+    info = read_wav_info(wav_path)
+    if info.frames == 0:
+        return info.sample_rate, np.zeros(0, dtype=np.float32)
+
+    if info.bits == 24:
+        raw = np.memmap(wav_path, dtype=np.uint8, mode="r", offset=info.data_offset,
+                        shape=(info.frames, info.channels, 3))
+        first = raw[:, 0, :].astype(np.int32)
+        samples = (first[:, 0] | (first[:, 1] << 8) | (first[:, 2] << 16)) << 8 >> 8  # Sign extend
+        return info.sample_rate, samples
+
+    dtypes = {(1, 8): np.uint8, (1, 16): np.int16, (1, 32): np.int32, (3, 32): np.float32, (3, 64): np.float64}
+    dtype = dtypes.get((info.audio_format, info.bits))
+    if dtype is None:
+        raise ValueError(f"{wav_path}: unsupported WAV format {info.audio_format} with {info.bits} bits")
+    samples = np.memmap(wav_path, dtype=np.dtype(dtype).newbyteorder("<"), mode="r", offset=info.data_offset,
+                        shape=(info.frames, info.channels))
+    return info.sample_rate, samples[:, 0]
+
+
+def spectrogram_columns(samples, sample_rate, width, settings, quality=HIGH):
+    """Power in dB, frequency bins (low to high) by at most `width` time columns.
+
+    At HIGH quality every STFT frame is computed and columns keep the loudest frame they
+    cover, so short calls survive the downscaling. FAST only computes about one frame per
+    column. Frames are transformed in blocks, so memory use does not grow with the recording.
+    """
+    fft_size = settings.fft_size
+    hop = settings.hop()
+    frame_count = 1 + (len(samples) - fft_size) // hop if len(samples) >= fft_size else 0
+
+    freqs = np.fft.rfftfreq(fft_size, 1 / sample_rate)
+    max_freq = settings.max_freq if settings.max_freq is not None else sample_rate / 2
+    band = np.flatnonzero((freqs >= settings.min_freq) & (freqs <= max_freq))
+    if frame_count == 0 or len(band) == 0:
+        return np.zeros((max(len(band), 1), 1), dtype=np.float32)
+    low, high = band[0], band[-1] + 1
+
+    columns = max(1, min(width, frame_count))
+    edges = np.linspace(0, frame_count, columns + 1).astype(np.int64)  # Frames covered by each column
+    window = np.hanning(fft_size).astype(np.float32)
+    result = np.empty((high - low, columns), dtype=np.float32)
+
+    block = max(1, 8192 // max(1, frame_count // columns))  # Columns per block, roughly 8192 frames
+    for first in range(0, columns, block):
+        last = min(columns, first + block)
+        if quality == FAST:
+            frame_starts = edges[first:last] * hop
+        else:
+            frame_starts = np.arange(edges[first], edges[last]) * hop
+        offsets = frame_starts[:, None] + np.arange(fft_size)
+        frames = np.asarray(samples[offsets], dtype=np.float32) * window
+        power = np.abs(np.fft.rfft(frames, axis=1)[:, low:high]) ** 2
+
+        if quality == FAST:
+            result[:, first:last] = power.T
+        else:
+            result[:, first:last] = np.maximum.reduceat(power, edges[first:last] - edges[first], axis=0).T
+
+    return 10 * np.log10(result + 1e-12)
+
+
+def render_spectrogram(wav_path, size, quality=HIGH, settings=None):
+    """Spectrogram of a .wav file as a greyscale image filling `size`, high frequencies at the top."""
+    sample_rate, samples = read_wav(wav_path)
+    try:
+        return spectrogram_image(samples, sample_rate, size, quality, settings)
+    finally:
+        del samples  # Releases the memory map
+
+
+def spectrogram_image(samples, sample_rate, size, quality=HIGH, settings=None):
+    """Like render_spectrogram, for samples that are read already, e.g. part of a recording."""
+    settings = settings if settings is not None else SpectrogramSettings()
+    width, height = max(1, size[0]), max(1, size[1])
+    db = spectrogram_columns(samples, sample_rate, width, settings, quality)
+    scaled = (db - (db.max() - settings.dynamic_range)) * (255.0 / settings.dynamic_range)
+    pixels = np.clip(scaled, 0, 255).astype(np.uint8)[::-1]
+
+    image = Image.fromarray(np.ascontiguousarray(pixels))
+    resample = Image.Resampling.BILINEAR if quality == FAST else Image.Resampling.BICUBIC
+    return image.resize((width, height), resample)
@@ -0,0 +1,411 @@
+"""Benchmarks of the load, navigate and save paths on synthetic projects.
+
+    python speedybat_benchmark.py [--sizes 1000 10000 100000] [--work DIR] [--json results.jsonl]
+    python speedybat_benchmark.py --memory 250000 [--budget 400]
+
+A project per size (spectrogram images and an annotations.xlsx, part of it annotated) is
+generated under --work once and reused. Storage, navigation and decoding are benchmarked
+without a window. SpeedyBat.py itself needs a display; on a plain Linux box run under Xvfb,
+`xvfb-run -a python speedybat_benchmark.py`, otherwise those benchmarks are skipped.
+
+Every benchmark prints one line and, with --json, appends one JSON object per line with
+its throughput and latency percentiles, so results can be tracked over time.
+
+--memory opens a project of that many images the way the annotator does (store, manifest,
+journal, pre-screening results and annotation order) and checks the peak resident memory of
+the process against --budget megabytes; the exit status is 1 when it is over, so it can run
+as a test.
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from annotation_index import RowIndex
+from annotation_journal import AnnotationJournal
+from annotation_model import AnnotationModel
+from annotation_queue import QUEUE_TABLE, AnnotationQueue, compute_queue, stored_queue
+from annotation_schema import COLUMNS, COUNT_COLUMNS, DEFAULTS, KINDS, count_value
+from annotation_storage import SQLiteStore, export_xlsx, import_xlsx
+from folder_scanner import FolderScanner
+from image_cache import FAST, HIGH, thumbnail_image
+from latency_profiler import Profiler
+from pending_mask import PendingMask
+from prescreen import SCREENING_COLUMNS, SCREENING_TABLE, load_suggestions
+
+PROJECT_MARKER = ".benchmark_project"
+TEMPLATE_COUNT = 16  # Distinct images, the others are hard links to them
+WINDOW_SIZE = (1280, 800)
+
+
+def synthetic_spectrogram(rng, size):
+    """Greyscale noise with a few frequency modulated sweeps, like a recording with bat calls."""
+    width, height = size
+    pixels = rng.normal(40, 12, (height, width))
+    for _ in range(rng.integers(0, 12)):
+        start = rng.integers(0, width - 40)
+        length = rng.integers(10, 40)
+        top, bottom = sorted(rng.integers(0, height, 2))
+        columns = np.arange(start, start + length)
+        rows = np.linspace(top, bottom, length).astype(int)
+        for thickness in range(-2, 3):
+            pixels[np.clip(rows + thickness, 0, height - 1), columns] = rng.normal(220, 20)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def image_name(i):
+    return f"IMG_{i:07d}.jpg"
+
+
+def make_project(folder, count, annotated=0.3, image_size=(2400, 1200), seed=0):
+    """Images and an annotations.xlsx in SpeedyBat.py's layout, generated once per folder."""
+    marker = os.path.join(folder, PROJECT_MARKER)
+    if os.path.exists(marker):
+        return folder
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+    rng = np.random.default_rng(seed)
+    templates = []
+    for i in range(min(TEMPLATE_COUNT, count)):
+        path = os.path.join(folder, image_name(i))
+        synthetic_spectrogram(rng, image_size).save(path, quality=90)
+        templates.append(path)
+    for i in range(len(templates), count):
+        path = os.path.join(folder, image_name(i))
+        try:
+            os.link(templates[i % len(templates)], path)
+        except OSError:
+            shutil.copyfile(templates[i % len(templates)], path)
+
+    rows = []
+    for i in range(count):
+        row = [image_name(i), 0, 0, '', '', '', '']
+        if rng.random() < annotated:
+            if rng.random() < 0.5:
+                row[4] = 'x'  # Bat
+                row[1], row[2] = int(rng.integers(0, 3)), int(rng.integers(0, 2))
+            else:
+                row[3] = 'x'  # None
+            row[6] = 'benchmark'
+        rows.append(row)
+    export_xlsx(os.path.join(folder, 'annotations.xlsx'), list(COLUMNS), rows)
+
+    with open(marker, 'w') as file:
+        file.write(str(count))
+    return folder
+
+
+def reset_project(folder):
+    # Back to images and annotations.xlsx only, as if the folder was never opened
+    for name in os.listdir(folder):
+        if name.startswith('IMG_') or name in ('annotations.xlsx', PROJECT_MARKER):
+            continue
+        path = os.path.join(folder, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+class Benchmark:
+    """Times operations and reports one result per operation."""
+
+    def __init__(self, images, json_path=None, environment=None):
+        self.images = images
+        self.json_path = json_path
+        self.environment = environment or {}
+
+    def run(self, name, operation, repeat=1):
+        profiler = Profiler(window=repeat)
+        for i in range(repeat):
+            with profiler.stage(name):
+                operation(i)
+        self.report(name, profiler.summary()[name])
+
+    def report(self, name, stats):
+        total_seconds = stats["total_ms"] / 1000
+        result = dict(self.environment, benchmark=name, images=self.images, count=stats["count"],
+                      total_s=round(total_seconds, 4),
+                      per_second=round(stats["count"] / total_seconds, 2) if total_seconds else None,
+                      p50_ms=round(stats["p50_ms"], 3), p95_ms=round(stats["p95_ms"], 3),
+                      p99_ms=round(stats["p99_ms"], 3), max_ms=round(stats["max_ms"], 3))
+        print(f"{self.images:>8} {name:<28}{stats['count']:>6}{result['per_second'] or 0:>12.1f}/s"
+              f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f} ms")
+        if self.json_path:
+            with open(self.json_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(result) + "\n")
+
+
+def storage_benchmarks(bench, folder, names, repeat):
+    xlsx_file = os.path.join(folder, 'annotations.xlsx')
+    table = {}
+    bench.run("import_xlsx", lambda i: table.update(rows=import_xlsx(xlsx_file)))
+    columns, rows = table["rows"]
+
+    scratch = tempfile.mkdtemp(prefix="speedybat-benchmark-")
+    try:
+        store = SQLiteStore(os.path.join(scratch, "annotations.sqlite"))
+        bench.run("store_write_all", lambda i: store.write(columns, rows))
+        bench.run("store_load", lambda i: store.load())
+
+        bench.run("row_index_reconcile", lambda i: RowIndex(row[0] for row in rows).reconcile(names))
+
+        # What SpeedyBat.py does per image: show the row, edit it, take the edited values for the journal
+        models = {}
+        converters = {column: count_value for column in COUNT_COLUMNS}
+        bench.run("model_from_table", lambda i: models.update(model=AnnotationModel.from_table(columns, rows, DEFAULTS,
+                                                                                              converters, KINDS)))
+        model = models["model"]
+
+        def edit(i):
+            row = model.row_of(names[i % len(names)])
+            record = model.record(row)
+            model.set(row, 'Social Call', record['Social Call'] + 1)
+            return model.take_dirty()
+        bench.run("model_edit_row", edit, repeat)
+
+        pending = PendingMask([not (row[3] or row[4]) for row in rows])
+        starts = random.Random(0).choices(range(len(names)), k=repeat)
+        bench.run("next_pending", lambda i: pending.next_pending(starts[i]), repeat)
+
+        # One saved row per navigation step, then the journal folded into the store
+        journal = AnnotationJournal(os.path.join(scratch, "annotations.journal"))
+        changed = random.Random(1).sample(range(len(rows)), min(repeat, len(rows)))
+        bench.run("journal_append", lambda i: journal.append(rows[changed[i]][0], {'Bat': 'x', 'Annotater': 'bench'}),
+                  len(changed))
+        by_name = {row[0]: row for row in rows}
+        snapshot = lambda images: (columns, [by_name[image] for image in images])
+        bench.run("journal_compact", lambda i: journal.compact(snapshot, lambda table: store.write(*table)))
+        journal.close()
+        store.close()
+
+        bench.run("export_xlsx", lambda i: export_xlsx(os.path.join(scratch, "export.xlsx"), columns, rows))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def decode_benchmarks(bench, folder, names, repeat):
+    paths = [os.path.join(folder, name) for name in names[:min(repeat, len(names))]]
+    for quality in (FAST, HIGH):
+        bench.run(f"decode_{quality}", lambda i: thumbnail_image(paths[i], WINDOW_SIZE, quality), len(paths))
+
+
+def app_benchmarks(bench, folder, names, repeat):
+    """SpeedyBat.py driven through its own methods, needs a display."""
+    import tkinter as tk
+    try:
+        root = tk.Tk()
+    except tk.TclError as error:
+        print(f"{bench.images:>8} app benchmarks skipped, no display ({error}); try xvfb-run -a")
+        return
+
+    import SpeedyBat
+    from thumbnail_cache import ThumbnailCache
+
+    root.geometry(f"{WINDOW_SIZE[0]}x{WINDOW_SIZE[1]}")
+    SpeedyBat.root = root  # The app refers to the module level root for its popups
+    app = SpeedyBat.ImageAnnotatorApp(root)
+    root.update()
+    try:
+        # select_folder without the folder dialog and the background scan
+        app.folder_path = folder
+        app.thumbnails = ThumbnailCache.for_folder(folder, variant="thumbnail")
+        bench.run("app_open_folder", lambda i: app.open_images(names))
+        root.update()
+
+        def step(i):
+            app.next_image()
+            app.navigation.flush()
+            root.update_idletasks()
+        bench.run("app_next_image", step, repeat)
+
+        def annotate(i):
+            app.toggle_bat()
+            step(i)
+        bench.run("app_annotate_and_next", annotate, repeat)
+        bench.run("app_save", lambda i: app.save_annotations())
+        bench.run("app_next_to_annotate", lambda i: (app.next_unannotated_image(), app.navigation.flush()), repeat)
+
+        # What the app measured itself, per stage of the loop
+        for stage, stats in sorted(app.profiler.summary().items()):
+            bench.report(f"app_stage_{stage}", stats)
+    finally:
+        app.navigation.cancel()
+        app.close_journal()
+        app.prefetcher.stop()
+        app.player.close()
+        root.destroy()
+
+
+def resident_mb():
+    # Linux only, the resident set size of this process now
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def peak_mb():
+    # Linux only, the highest resident set size of this process so far. Unlike ru_maxrss it does not
+    # include the peak of a parent that started us with vfork, e.g. pytest through subprocess
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+
+
+def make_memory_project(folder, count, annotated=0.3, seed=0):
+    """A folder as SpeedyBat.py leaves it, without the images: the SQLite store with its screening and
+    queue tables, the scan manifest and a journal of edits that were not compacted. Generated once."""
+    path = os.path.join(folder, "annotations.sqlite")
+    if os.path.exists(path):
+        return
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    names, rows, screening = [], [], []
+    for i in range(count):
+        name = f"IMG_2023{i % 12 + 1:02d}{i % 28 + 1:02d}_{i % 24:02d}{i % 6000:04d}_{i:07d}.jpg"
+        row = [name, 0, 0, '', '', '', '']
+        if rng.random() < annotated:
+            if rng.random() < 0.5:
+                row[4] = 'x'  # Bat
+                row[1], row[2] = rng.randrange(3), rng.randrange(2)
+            else:
+                row[3] = 'x'  # None
+            row[6] = f"annotator{rng.randrange(4)}"
+            if rng.random() < 0.05:
+                row[5] = "two calls overlapping, check the recording"
+        names.append(name)
+        rows.append(row)
+        screening.append([name, rng.choice(('Bat', 'None')), rng.random(), rng.uniform(0, 40)])
+
+    # Every image pre-screened and ordered by confidence per hour, as after a pre-screen
+    suggestions = {name: (suggestion, confidence, score) for name, suggestion, confidence, score in screening}
+    tables = [("annotations", list(COLUMNS), rows), (SCREENING_TABLE, list(SCREENING_COLUMNS), screening),
+              (QUEUE_TABLE, *compute_queue(names, suggestions, "most uncertain", True))]
+    for table, columns, table_rows in tables:
+        store = SQLiteStore(path, table)
+        store.write(list(columns), table_rows)
+        store.close()
+
+    journal = AnnotationJournal(os.path.join(folder, SQLiteStore.journal_name))
+    journal.append_many([(name, {'Bat': 'x', 'Social Call': 1}) for name in rng.sample(names, count // 100)])
+    journal.close()
+    FolderScanner(folder, ('.png', '.jpg'), ignore_case=False)._save_manifest(
+        {name: (150000, 1690000000000000000 + i) for i, name in enumerate(names)})
+
+
+def memory_benchmark(work, size, budget_mb, json_path=None, env=None):
+    """Open a project of `size` images like SpeedyBat.py does and compare the peak resident memory
+    of the process to the budget. The project is generated in a child process, so that does not count."""
+    folder = os.path.join(work, f"memory-{size}")
+    generator = multiprocessing.get_context("spawn").Process(target=make_memory_project, args=(folder, size))
+    generator.start()
+    generator.join()
+    baseline = resident_mb()
+
+    # What select_folder and load_annotations keep: the scanner with its manifest, the model with the
+    # journal replayed, the pending mask, the pre-screening suggestions and the annotation order
+    scanner = FolderScanner(folder, ('.png', '.jpg'), ignore_case=False)
+    names = scanner.cached_names()
+    store = SQLiteStore(os.path.join(folder, "annotations.sqlite"))
+    columns, rows = store.load()
+    model = AnnotationModel.from_table(columns, rows, DEFAULTS, {column: count_value for column in COUNT_COLUMNS},
+                                       KINDS)
+    del rows
+    model.reconcile(names)
+    journal = AnnotationJournal(os.path.join(folder, store.journal_name))
+    for name, values in journal.replay().items():
+        row = model.row_of(name)
+        if row is not None:
+            model.update(row, values, dirty=False)
+    journal.close()
+    pending = PendingMask(~(model.mask('Social Call') | model.mask('Feeding Buzz') | model.mask('None') |
+                            model.mask('Bat')))
+
+    screening_store = SQLiteStore(store.path, SCREENING_TABLE)
+    suggestions = load_suggestions(screening_store)
+
+    def likely_empty(name):
+        suggestion, confidence, _ = suggestions.get(name, (None, 0.0, 0.0))
+        return suggestion == 'None' and confidence >= 0.9  # SpeedyBat.py's skip_confidence
+    pending.set_deferred([likely_empty(name) for name in names])
+    queue_store = SQLiteStore(store.path, QUEUE_TABLE)
+    queue = AnnotationQueue(*stored_queue(queue_store.load(), names, "most uncertain", True), ~pending.pending)
+    for opened in (store, screening_store, queue_store):
+        opened.close()
+    gc.collect()
+
+    steady = resident_mb()
+    peak = peak_mb()
+    result = dict(env or {}, benchmark="memory_open_project", images=size, pending=pending.pending_count,
+                  queued=len(queue), baseline_mb=round(baseline, 1), resident_mb=round(steady, 1),
+                  peak_mb=round(peak, 1), project_mb=round(steady - baseline, 1), budget_mb=budget_mb)
+    print(f"{size:>8} memory: {steady:.1f} MB resident ({steady - baseline:.1f} MB for the project), "
+          f"{peak:.1f} MB peak, budget {budget_mb} MB")
+    if json_path:
+        with open(json_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(result) + "\n")
+    return peak <= budget_mb
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), 'commit': commit,
+            'python': platform.python_version(), 'machine': platform.machine(), 'system': platform.system()}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark SpeedyBat on synthetic projects.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="images per project")
+    parser.add_argument('--work', default=os.path.join(tempfile.gettempdir(), 'speedybat-benchmark'),
+                        help="folder for the generated projects, kept between runs")
+    parser.add_argument('--repeat', type=int, default=200, help="repetitions of the per-image operations")
+    parser.add_argument('--json', help="append machine readable results to this file")
+    parser.add_argument('--no-app', action='store_true', help="skip the benchmarks that need a display")
+    parser.add_argument('--memory', type=int, metavar='IMAGES',
+                        help="only open a project of this many images and check its memory")
+    parser.add_argument('--budget', type=float, default=400, help="peak resident megabytes allowed for --memory")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    env = environment()
+    if args.memory:
+        return 0 if memory_benchmark(args.work, args.memory, args.budget, args.json, env) else 1
+
+    print(f"{'images':>8} {'benchmark':<28}{'n':>6}{'throughput':>14}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for size in args.sizes:
+        started = time.perf_counter()
+        folder = make_project(os.path.join(args.work, f"project-{size}"), size)
+        print(f"{size:>8} project ready in {time.perf_counter() - started:.1f} s: {folder}")
+        reset_project(folder)
+
+        names = [image_name(i) for i in range(size)]
+        bench = Benchmark(size, args.json, env)
+        storage_benchmarks(bench, folder, names, args.repeat)
+        decode_benchmarks(bench, folder, names, min(args.repeat, 50))
+        if not args.no_app:
+            app_benchmarks(bench, folder, names, args.repeat)
+            reset_project(folder)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
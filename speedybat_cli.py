@@ -0,0 +1,362 @@
+"""Headless tools for annotation files of many deployments.
+
+    python speedybat_cli.py merge    ROOT... -o merged.xlsx
+    python speedybat_cli.py validate ROOT...
+    python speedybat_cli.py summary  ROOT... [--by annotator|site] [-o summary.csv]
+    python speedybat_cli.py export   ROOT... -o DATASET [--labels Bat 'Social Call'] [--clip-seconds 2]
+
+Every folder below ROOT that holds annotations (the live store written by the annotators,
+or annotations.xlsx) is one deployment. Its site is the first folder below ROOT, so
+ROOT/<site>/<night>/... groups all nights of a site. Files are read on a process pool.
+"""
+import argparse
+import csv
+import os
+import sys
+from collections import Counter
+from multiprocessing import Pool
+
+import openpyxl
+
+from annotation_journal import pending_changes
+from annotation_schema import COLUMNS, COUNT_COLUMNS, IMAGE_COLUMN, MARKER, detect_layout, label_columns
+from annotation_storage import STORES, import_xlsx, open_read_only, xlsx_columns
+from field_schema import FieldSchema, SCHEMA_TABLE
+from dataset_export import ExportSettings, annotated_samples, export_dataset
+
+
+def find_sources(roots):
+    """(root, folder, path) for every annotation table below the given folders."""
+    store_names = ['annotations' + store_class.extension for store_class in STORES.values()]
+    sources = []
+    for root in roots:
+        for folder, _, files in os.walk(root):
+            # The live store is newer than annotations.xlsx, which is only written on export
+            for name in store_names + ['annotations.xlsx']:
+                if name in files:
+                    sources.append((root, folder, os.path.join(folder, name)))
+                    break
+    return sources
+
+
+def apply_changes(table, changes):
+    """The table with the journaled changes, replayed like SpeedyBat does when it opens the folder:
+    the latest values of images in the table, fields that are not stored yet become new columns."""
+    columns, rows = table
+    columns = list(columns)
+    for values in changes.values():
+        columns += [column for column in values if column not in columns]
+    index = {column: i for i, column in enumerate(columns)}
+    position = {row[0]: i for i, row in enumerate(rows)}
+    for row in rows:
+        row.extend([None] * (len(columns) - len(row)))
+    for image, values in changes.items():
+        if image in position:
+            row = rows[position[image]]
+            for column, value in values.items():
+                row[index[column]] = value
+    return columns, rows
+
+
+def read_table(path):
+    if path.endswith('.xlsx'):
+        return import_xlsx(path)
+    store = open_read_only(path)
+    try:
+        table = store.load()
+    finally:
+        store.close()
+    if table is None:
+        raise ValueError("no annotation table")
+    # Edits that were saved to the journal but not folded into the store yet, e.g. SpeedyBat is still open
+    return apply_changes(table, pending_changes(os.path.dirname(path)))
+
+
+def shown_fields(path, columns):
+    """Column -> label of the fields of a SpeedyBatv2.0.py table, from the schema stored next to it.
+    Removed fields are left out. annotations.xlsx is written with the labels as its header, it has no schema."""
+    table = None
+    if not path.endswith('.xlsx'):
+        store = open_read_only(path, SCHEMA_TABLE)
+        try:
+            table = store.load()
+        finally:
+            store.close()
+    return FieldSchema.from_table(table, columns).labels
+
+
+def resolve_fields(path, columns, rows):
+    """A SpeedyBatv2.0.py table as the annotators see it: the fields under their labels and
+    without the removed ones. Columns keep their first name when a field is renamed."""
+    labels = shown_fields(path, columns[1:])
+    keep = [0] + [i for i, column in enumerate(columns[1:], 1) if column in labels]
+    return [columns[0]] + [labels[columns[i]] for i in keep[1:]], [[row[i] for i in keep] for row in rows]
+
+
+def site_of(root, folder):
+    relative = os.path.relpath(folder, root)
+    return os.path.basename(os.path.abspath(root)) if relative == '.' else relative.split(os.sep)[0]
+
+
+def is_marked(value):
+    return value == MARKER
+
+
+def as_count(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def validate_rows(layout, columns, rows):
+    issues = []
+    seen = set()
+    index = {column: i for i, column in enumerate(columns)}
+    for row in rows:
+        image = row[0]
+        if image in seen:
+            issues.append((image, "appears more than once"))
+        seen.add(image)
+
+        if layout == 'fixed':
+            counts = {column: as_count(row[index[column]]) for column in COUNT_COLUMNS}
+            for column, count in counts.items():
+                if count is None or count < 0:
+                    issues.append((image, f"'{column}' is not a count: {row[index[column]]!r}"))
+            flags = {column: row[index[column]] for column in ('None', 'Bat')}
+            for column, value in flags.items():
+                if value not in ('', None, MARKER):
+                    issues.append((image, f"'{column}' should be empty or '{MARKER}', not {value!r}"))
+            if any(count and count > 0 for count in counts.values()) and not is_marked(flags['Bat']):
+                issues.append((image, "has calls or buzzes but 'Bat' is not marked"))
+            if is_marked(flags['None']) and is_marked(flags['Bat']):
+                issues.append((image, "is marked both 'None' and 'Bat'"))
+            if is_marked(flags['None']) and any(count and count > 0 for count in counts.values()):
+                issues.append((image, "is marked 'None' but has calls or buzzes"))
+        else:
+            for column, value in zip(columns[1:], row[1:]):
+                if value not in ('', None, MARKER):
+                    issues.append((image, f"'{column}' should be empty or '{MARKER}', not {value!r}"))
+    return issues
+
+
+def summarise_rows(layout, columns, rows):
+    """Counter per annotator with image, annotated and label totals."""
+    index = {column: i for i, column in enumerate(columns)}
+    totals = {}
+    for row in rows:
+        if layout == 'fixed':
+            annotator = row[index['Annotater']] or '(unknown)'
+            counts = {column: as_count(row[index[column]]) or 0 for column in COUNT_COLUMNS}
+            flags = {column: is_marked(row[index[column]]) for column in ('None', 'Bat')}
+            annotated = any(counts.values()) or any(flags.values())
+            labels = {**counts, **{column: int(flag) for column, flag in flags.items()}}
+        else:
+            annotator = '(unknown)'  # SpeedyBatv2.0.py does not record who annotated
+            labels = {column: int(is_marked(value)) for column, value in zip(columns[1:], row[1:])}
+            annotated = any(labels.values())
+
+        counter = totals.setdefault(annotator, Counter())
+        counter['Images'] += 1
+        counter['Annotated'] += int(annotated)
+        counter.update(labels)
+    return totals
+
+
+def process_source(job):
+    """Worker: read one table and return its header, issues, summary and (optionally) rows."""
+    root, folder, path, keep_rows = job
+    try:
+        columns, rows = read_table(path)
+    except Exception as error:
+        return {'path': path, 'error': str(error)}
+
+    layout = detect_layout(columns)
+    if layout is None:
+        return {'path': path, 'error': f"unknown column layout {columns}"}
+    if layout == 'fields':
+        columns, rows = resolve_fields(path, columns, rows)
+    return {'path': path,
+            'site': site_of(root, folder),
+            'folder': folder,
+            'layout': layout,
+            'columns': columns,
+            'issues': validate_rows(layout, columns, rows),
+            'summary': summarise_rows(layout, columns, rows),
+            'rows': rows if keep_rows else None}
+
+
+def process_all(sources, keep_rows, processes):
+    jobs = [(root, folder, path, keep_rows) for root, folder, path in sources]
+    with Pool(processes) as pool:
+        for result in pool.imap_unordered(process_source, jobs):
+            if 'error' in result:
+                print(f"{result['path']}: {result['error']}", file=sys.stderr)
+                continue
+            yield result
+
+
+class TableWriter:
+    """Streams rows to a .csv or .xlsx file."""
+
+    def __init__(self, path, header):
+        self.path = path
+        if path.endswith('.xlsx'):
+            self.wb = openpyxl.Workbook(write_only=True)
+            self.ws = self.wb.create_sheet()
+            self.ws.append(header)
+            self.file = None
+        else:
+            self.file = open(path, 'w', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(header)
+
+    def append(self, row):
+        if self.file is None:
+            self.ws.append(row)
+        else:
+            self.writer.writerow(row)
+
+    def close(self):
+        if self.file is None:
+            self.wb.save(self.path)
+        else:
+            self.file.close()
+
+
+def read_columns(source):
+    root, folder, path = source
+    try:
+        if path.endswith('.xlsx'):
+            return xlsx_columns(path)
+        store = open_read_only(path)
+        try:
+            columns = store.columns()
+        finally:
+            store.close()
+        for values in pending_changes(folder).values():
+            columns += [column for column in values if column not in columns]
+        return resolve_fields(path, columns, [])[0] if detect_layout(columns) == 'fields' else columns
+    except Exception:
+        return []
+
+
+def merged_header(sources, processes):
+    # Headers only, so the merged columns are known before the first row is streamed
+    labels = list(COLUMNS[1:])
+    with Pool(processes) as pool:
+        for columns in pool.imap(read_columns, sources):
+            labels += [column for column in label_columns(columns) if column not in labels]
+    return ['Site', 'Folder', IMAGE_COLUMN] + labels
+
+
+def merge(args):
+    sources = find_sources(args.roots)
+    header = merged_header(sources, args.processes)
+    position = {column: i for i, column in enumerate(header)}
+    writer = TableWriter(args.output, header)
+    merged = 0
+    for result in process_all(sources, True, args.processes):
+        for row in result['rows']:
+            out = [None] * len(header)
+            out[0], out[1], out[2] = result['site'], result['folder'], row[0]
+            for column, value in zip(result['columns'][1:], row[1:]):
+                out[position[column]] = value
+            writer.append(out)
+            merged += 1
+    writer.close()
+    print(f"Merged {merged} rows from {len(sources)} annotation files into {args.output}")
+    return 0
+
+
+def validate(args):
+    sources = find_sources(args.roots)
+    problems = 0
+    for result in process_all(sources, False, args.processes):
+        for image, message in result['issues']:
+            print(f"{result['path']}: {image}: {message}")
+            problems += 1
+    print(f"{problems} problems in {len(sources)} annotation files")
+    return 1 if problems else 0
+
+
+def summary(args):
+    sources = find_sources(args.roots)
+    totals = {}
+    for result in process_all(sources, False, args.processes):
+        for annotator, counter in result['summary'].items():
+            key = annotator if args.by == 'annotator' else result['site']
+            totals.setdefault(key, Counter()).update(counter)
+
+    columns = ['Images', 'Annotated'] + sorted({column for counter in totals.values() for column in counter}
+                                               - {'Images', 'Annotated'})
+    header = [args.by.capitalize()] + columns
+    rows = [[key] + [totals[key][column] for column in columns] for key in sorted(totals)]
+
+    if args.output:
+        writer = TableWriter(args.output, header)
+        for row in rows:
+            writer.append(row)
+        writer.close()
+    else:
+        widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+        for row in [header] + rows:
+            print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+    return 0
+
+
+def export(args):
+    # Tables are read on the pool and reduced to their annotated images, the clips are cut on it afterwards
+    sources = find_sources(args.roots)
+    settings = ExportSettings(clip_seconds=args.clip_seconds, crop_size=args.crop_size, shard_size=args.shard_size,
+                              labels=args.labels)
+    samples = []
+    for result in process_all(sources, True, args.processes):
+        samples += annotated_samples(result, settings.labels)
+    print(f"Exporting {len(samples)} annotated images from {len(sources)} annotation files to {args.output}")
+    failed = export_dataset(samples, args.output, settings, args.processes)
+    if failed:
+        print(f"{failed} images could not be exported, their shards are retried when the export runs again")
+    return 0 if failed == 0 else 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='speedybat', description="Merge, validate and summarise SpeedyBat annotations.")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: one per CPU)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    merge_parser = commands.add_parser('merge', help="merge all annotation files into one .xlsx or .csv")
+    merge_parser.add_argument('roots', nargs='+')
+    merge_parser.add_argument('-o', '--output', required=True)
+    merge_parser.set_defaults(run=merge)
+
+    validate_parser = commands.add_parser('validate', help="report inconsistent annotations")
+    validate_parser.add_argument('roots', nargs='+')
+    validate_parser.set_defaults(run=validate)
+
+    summary_parser = commands.add_parser('summary', help="totals per annotator or per site")
+    summary_parser.add_argument('roots', nargs='+')
+    summary_parser.add_argument('--by', choices=('annotator', 'site'), default='annotator')
+    summary_parser.add_argument('-o', '--output')
+    summary_parser.set_defaults(run=summary)
+
+    export_parser = commands.add_parser('export', help="labelled clips and spectrogram crops for model training")
+    export_parser.add_argument('roots', nargs='+')
+    export_parser.add_argument('-o', '--output', required=True, help="dataset folder, an interrupted export resumes")
+    export_parser.add_argument('--labels', nargs='+', help="labels to export (default: all of them)")
+    export_parser.add_argument('--clip-seconds', type=float, default=2.0,
+                               help="clip length around the loudest moment, 0 for whole recordings")
+    export_parser.add_argument('--crop-size', type=int, nargs=2, default=(256, 128), metavar=('WIDTH', 'HEIGHT'))
+    export_parser.add_argument('--shard-size', type=int, default=500, help="images per shard")
+    export_parser.set_defaults(run=export)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
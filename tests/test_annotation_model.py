@@ -0,0 +1,20 @@
+from annotation_model import AnnotationModel
+from annotation_schema import COLUMNS, DEFAULTS, KINDS
+
+
+def test_held_row_stays_dirty_until_kept_or_discarded():
+    model = AnnotationModel.from_table(list(COLUMNS), [["a.jpg", 0, 0, "", "x", "", "first"],
+                                                       ["b.jpg", 0, 0, "", "", "", ""]], DEFAULTS, kinds=KINDS)
+    a, b = model.row_of("a.jpg"), model.row_of("b.jpg")
+    model.set(a, "Social Call", 2)
+    model.set(a, "Annotater", "second")
+    model.set(b, "None", "x")
+
+    # The row waiting for the annotater warning is not handed out with the others
+    assert model.take_dirty(keep={a}) == [("b.jpg", {"None": "x"})]
+    assert model.is_dirty(a)
+
+    model.discard(a)
+    assert not model.is_dirty(a)
+    assert (model.get(a, "Social Call"), model.get(a, "Annotater")) == (0, "first")
+    assert model.take_dirty() == []
@@ -0,0 +1,60 @@
+import time
+import wave
+
+import numpy as np
+import pytest
+
+from audio_playback import NORMAL, AudioConverter, AudioPlayer, PlaybackSettings, sample_scale
+from spectrogram import read_wav, read_wav_info
+
+
+def write_sine(path, bits, sample_rate=48000, seconds=0.2, frequency=1000):
+    # Full scale sine as the recorder stores it: 8-bit unsigned around 128, the others signed
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    peak = 2 ** (bits - 1) - 1
+    values = np.round(np.sin(2 * np.pi * frequency * t) * peak).astype(np.int64)
+    if bits == 8:
+        data = (values + 128).astype(np.uint8).tobytes()
+    else:
+        data = b"".join(int(value).to_bytes(bits // 8, "little", signed=True) for value in values)
+    with wave.open(path, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(bits // 8)
+        file.setframerate(sample_rate)
+        file.writeframes(data)
+
+
+@pytest.mark.parametrize("bits", [8, 16, 24])
+def test_full_scale_recordings_play_at_full_scale(tmp_path, bits):
+    path = str(tmp_path / f"{bits}.wav")
+    write_sine(path, bits)
+    sample_rate, samples = read_wav(path)
+    offset, scale = sample_scale(read_wav_info(path))
+
+    converter = AudioConverter(sample_rate, PlaybackSettings(mode=NORMAL, output_rate=sample_rate), scale, offset)
+    output = converter.process(samples)[200:]  # After the filter has settled
+    assert 0.95 < np.abs(output).max() <= 1.0
+    assert abs(output.mean()) < 0.01
+
+
+def test_prebuffer_survives_a_failing_recording(tmp_path, monkeypatch):
+    good = str(tmp_path / "good.wav")
+    write_sine(good, 16)
+    player = AudioPlayer(PlaybackSettings(mode=NORMAL), prebuffer_seconds=0.1)
+    convert = player._convert_head
+
+    def convert_or_fail(wav_path, settings):
+        if wav_path.endswith("bad.wav"):
+            raise MemoryError("no room for the recording")
+        return convert(wav_path, settings)
+    monkeypatch.setattr(player, "_convert_head", convert_or_fail)
+    bad = str(tmp_path / "bad.wav")
+    write_sine(bad, 16)
+
+    player.prebuffer([bad, good])
+    for _ in range(200):
+        if player._prebuffered:
+            break
+        time.sleep(0.01)
+    player.close()
+    assert [key[0] for key in player._prebuffered] == [good]
@@ -0,0 +1,63 @@
+import csv
+import json
+import sqlite3
+
+from annotation_schema import COLUMNS
+from annotation_storage import open_store
+from field_schema import FieldSchema, SCHEMA_TABLE
+from speedybat_cli import main
+
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as file:
+        return list(csv.reader(file))
+
+
+def test_summary_reads_shared_project_and_journal(tmp_path):
+    folder = tmp_path / "site" / "night"
+    folder.mkdir(parents=True)
+    store = open_store(str(folder), "shared")
+    store.write(list(COLUMNS), [["a.jpg", 0, 0, "", "", "", "first"], ["b.jpg", 0, 0, "", "", "", "first"]])
+    store.close()
+    # Saved by an annotator whose SpeedyBat is still open, not in the store yet
+    with open(folder / "annotations.host.journal", "w", encoding="utf-8") as file:
+        file.write(json.dumps({"image": "b.jpg", "values": {"Bat": "x", "Feeding Buzz": 2}}) + "\n")
+
+    output = str(tmp_path / "summary.csv")
+    assert main(["--processes", "1", "summary", str(tmp_path / "site"), "-o", output]) == 0
+    header, row = read_csv(output)
+    totals = dict(zip(header, row))
+    assert (totals["Images"], totals["Annotated"], totals["Bat"], totals["Feeding Buzz"]) == ("2", "1", "1", "2")
+
+    with sqlite3.connect(str(folder / "annotations.sqlite")) as connection:
+        assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+
+
+def test_commands_use_field_labels_of_a_migrated_project(tmp_path):
+    folder = tmp_path / "site"
+    folder.mkdir()
+    schema = FieldSchema(["Bat", "Noise", "Social"])
+    schema.rename("Bat", "Bat pass")
+    schema.remove("Noise")
+    store = open_store(str(folder), "sqlite", table=SCHEMA_TABLE)
+    store.write(*schema.table())
+    store.close()
+    store = open_store(str(folder))
+    store.write(["Image", "Bat", "Noise", "Social"], [["a.jpg", "x", "?", None], ["b.jpg", None, "x", "x"]])
+    store.close()
+
+    output = str(tmp_path / "merged.csv")
+    assert main(["--processes", "1", "merge", str(folder), "-o", output]) == 0
+    header, *rows = read_csv(output)
+    rows = [dict(zip(header, row)) for row in rows]
+    assert "Noise" not in header
+    assert [(row["Bat pass"], row["Bat"], row["Social"]) for row in rows] == [("x", "", ""), ("", "", "x")]
+
+    # The value in the removed field is not reported
+    assert main(["--processes", "1", "validate", str(folder)]) == 0
+
+    output = str(tmp_path / "summary.csv")
+    assert main(["--processes", "1", "summary", str(folder), "-o", output]) == 0
+    header, row = read_csv(output)
+    assert dict(zip(header, row)) == {"Annotator": "(unknown)", "Images": "2", "Annotated": "2", "Bat pass": "1",
+                                      "Social": "1"}
@@ -0,0 +1,25 @@
+import csv
+import os
+
+from PIL import Image
+
+from dataset_export import MANIFEST_NAME, ExportSettings, export_dataset, shard_name
+
+
+def test_shard_with_a_failed_sample_is_retried(tmp_path):
+    folder = tmp_path / "night"
+    folder.mkdir()
+    Image.new("L", (64, 32)).save(folder / "a.png")
+    (folder / "b.png").write_bytes(b"")  # Still being copied from the recorder
+    samples = [(str(folder), name, "site", "", {"Bat": 1}) for name in ("a.png", "b.png")]
+    output = str(tmp_path / "dataset")
+    settings = ExportSettings(crop_size=(16, 8))
+    manifest = os.path.join(output, shard_name(0), MANIFEST_NAME)
+
+    assert export_dataset(samples, output, settings, processes=1) == 1
+    assert not os.path.exists(manifest)
+
+    Image.new("L", (64, 32)).save(folder / "b.png")
+    assert export_dataset(samples, output, settings, processes=1) == 0
+    with open(manifest, newline="", encoding="utf-8") as file:
+        assert [row[3] for row in list(csv.reader(file))[1:]] == ["a.png", "b.png"]
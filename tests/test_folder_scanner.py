@@ -0,0 +1,13 @@
+from folder_scanner import FolderScanner
+
+
+def test_manifest_of_another_mode_is_not_used(tmp_path):
+    for name in ("a.wav", "a.png"):
+        (tmp_path / name).write_bytes(b"0")
+    assert FolderScanner(str(tmp_path), (".wav",)).scan().names == ["a.wav"]
+
+    scanner = FolderScanner(str(tmp_path), (".png", ".jpg"))
+    assert scanner.cached_names() is None
+    result = scanner.scan()
+    assert (result.names, result.added, result.removed) == (["a.png"], ["a.png"], [])
+    assert FolderScanner(str(tmp_path), (".png", ".jpg")).cached_names() == ["a.png"]
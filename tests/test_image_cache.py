@@ -0,0 +1,37 @@
+import numpy as np
+from PIL import Image
+
+from image_cache import FAST, HIGH, fit_image, open_reduced, thumbnail_image
+from prescreen import ScreenSettings, screen_image
+from thumbnail_cache import ThumbnailCache
+
+
+def make_image(path, mode, size=(4000, 3000)):
+    pixels = np.random.default_rng(0).integers(0, 255, (size[1], size[0]), dtype=np.uint8)
+    image = Image.fromarray(pixels).convert(mode)
+    image.save(path)
+    return path
+
+
+def test_large_palette_png_is_reduced(tmp_path):
+    path = make_image(str(tmp_path / "palette.png"), "P")
+    for quality in (FAST, HIGH):
+        assert thumbnail_image(path, (800, 600), quality).size == (800, 600)
+        assert fit_image(path, (800, 600), quality).size == (800, 600)
+
+
+def test_modes_reduce_cannot_average(tmp_path):
+    for mode in ("1", "I;16"):
+        path = make_image(str(tmp_path / f"image_{mode.replace(';', '')}.png"), mode)
+        with open_reduced(path, (800, 600)) as image:
+            assert image.size == (800, 600)
+
+
+def test_palette_png_is_screened_and_warmed(tmp_path):
+    path = make_image(str(tmp_path / "palette.png"), "P")
+    score, threshold = screen_image(path, ScreenSettings())
+    assert np.isfinite(score)
+
+    cache = ThumbnailCache(str(tmp_path / "cache"))
+    assert cache.warm([path], (800, 600), thumbnail_image, processes=1) == 1
+    assert cache.load(path, (800, 600)).size == (800, 600)
@@ -0,0 +1,12 @@
+import os
+import subprocess
+import sys
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "speedybat_benchmark.py")
+
+
+def test_opening_a_project_stays_within_its_memory_budget(tmp_path):
+    # A fresh process, so the peak is the annotator's and not pytest's. 20,000 images peak at about 75 MB
+    result = subprocess.run([sys.executable, BENCHMARK, "--memory", "20000", "--budget", "110",
+                             "--work", str(tmp_path)], capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
@@ -0,0 +1,63 @@
+import sqlite3
+
+from annotation_storage import ProjectStore, open_store
+
+COLUMNS = ["Image", "Bat"]
+
+
+def stored(path, image):
+    with sqlite3.connect(path) as connection:
+        return connection.execute('SELECT "Bat" FROM annotations WHERE "Image" = ?', (image,)).fetchone()[0]
+
+
+def open_pair(tmp_path):
+    path = str(tmp_path / "annotations.sqlite")
+    first = ProjectStore(path, annotator="first")
+    first.write(COLUMNS, [["a.jpg", ""], ["b.jpg", ""]])
+    second = ProjectStore(path, annotator="second")
+    second.load()
+    return first, second
+
+
+def test_change_to_image_on_screen_is_held_back(tmp_path):
+    first, second = open_pair(tmp_path)
+    first.write(COLUMNS, [["a.jpg", "x"]])
+
+    # `a.jpg` is on screen for the second annotator: not merged, reported, and a save of it is refused
+    columns, rows = second.changes_since(on_screen=["a.jpg"])
+    assert rows == []
+    assert second.take_conflicts() == [("a.jpg", "first")]
+    second.write(COLUMNS, [["a.jpg", ""]])
+    assert second.take_conflicts() == []
+    assert stored(second.path, "a.jpg") == "x"
+
+    # Once it is off screen the change comes in and later saves go through again
+    columns, rows = second.changes_since(on_screen=["b.jpg"])
+    assert rows == [["a.jpg", "x"]]
+    second.write(COLUMNS, [["a.jpg", ""]])
+    assert second.take_conflicts() == []
+    assert stored(second.path, "a.jpg") == ""
+    first.close()
+    second.close()
+
+
+def test_other_tables_of_a_shared_project_are_plain(tmp_path):
+    folder = str(tmp_path)
+    store = open_store(folder, "shared")
+    store.write(COLUMNS, [["a.jpg", ""]])
+    other = ProjectStore(store.path, annotator="other")
+    assert other.claim(["a.jpg"]) == ["a.jpg"]
+    assert store.claim(["b.jpg"]) == ["b.jpg"]
+
+    screening = open_store(folder, "shared", table="screening")
+    screening.write(["Image", "Suggestion"], [["a.jpg", "Bat"]])  # Leased by the other annotator
+    assert screening.load()[1] == [["a.jpg", "Bat"]]
+    screening.close()
+
+    assert store.leases() == {"a.jpg": "other"}
+    with sqlite3.connect(store.path) as connection:
+        assert connection.execute("SELECT image FROM leases WHERE annotator = ?", (store.annotator,)).fetchall() \
+            == [("b.jpg",)]
+        assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    store.close()
+    other.close()
@@ -0,0 +1,27 @@
+import wave
+
+import numpy as np
+import pytest
+
+from spectrogram import read_wav, read_wav_info
+
+
+@pytest.mark.parametrize("size", [0, 4, 12, 20, 30])
+def test_truncated_wav_is_a_value_error(tmp_path, size):
+    path = str(tmp_path / "full.wav")
+    with wave.open(path, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(48000)
+        file.writeframes(np.zeros(100, dtype=np.int16).tobytes())
+    with open(path, "rb") as file:
+        data = file.read(size)
+    truncated = str(tmp_path / "truncated.wav")
+    with open(truncated, "wb") as file:
+        file.write(data)
+
+    # The handlers of the prefetchers, the pre-screener and the export only catch OSError and ValueError
+    with pytest.raises(ValueError, match="not a complete WAV file"):
+        read_wav_info(truncated)
+    with pytest.raises(ValueError):
+        read_wav(truncated)
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from image_cache import HIGH
+
+
+CACHE_FOLDER = ".speedybat_cache"
+
+
+class ThumbnailCache:
+    """Display-sized copies of spectrograms on disk, so showing an image again is a small file read.
+
+    Entries are keyed by source path, file size, mtime and target size, so an edited
+    spectrogram or another window size never returns a stale copy. The folder is
+    kept under `max_bytes` by removing the least recently used entries.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, variant=""):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.variant = variant  # Separates caches of different resampling pipelines
+
+        self._lock = threading.Lock()
+        self._total_bytes = None  # Counted on first write
+
+    @classmethod
+    def for_folder(cls, folder_path, **kwargs):
+        return cls(os.path.join(folder_path, CACHE_FOLDER), **kwargs)
+
+    def entry_path(self, image_path, size):
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        key = f"{os.path.abspath(image_path)}|{stat.st_size}|{stat.st_mtime_ns}|{size[0]}x{size[1]}|{self.variant}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".png")
+
+    def load(self, image_path, size):
+        entry_path = self.entry_path(image_path, size)
+        if entry_path is None or not os.path.exists(entry_path):
+            return None
+        try:
+            with Image.open(entry_path) as image:
+                image.load()
+            os.utime(entry_path)  # Marks the entry as recently used for eviction
+            return image
+        except OSError:
+            return None  # Half written or removed by eviction meanwhile
+
+    def store(self, image_path, size, image, evict=True):
+        entry_path = self.entry_path(image_path, size)
+        if entry_path is None:
+            return
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(temp_path, format="PNG", compress_level=1)  # Fast to write, still small for spectrograms
+        os.replace(temp_path, entry_path)
+        if not evict:
+            return
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._disk_usage()
+            else:
+                self._total_bytes += os.path.getsize(entry_path)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def get_or_render(self, image_path, size, render, quality=HIGH):
+        # Only full quality renders are stored, a fast preview still uses a stored copy if there is one
+        image = self.load(image_path, size)
+        if image is None:
+            image = render(image_path, size, quality)
+            if quality == HIGH:
+                self.store(image_path, size, image)
+        return image
+
+    def _entries(self):
+        for shard in os.scandir(self.cache_dir):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".png"):
+                        yield entry
+
+    def _disk_usage(self):
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _evict(self):
+        # Drop the least recently used entries until we are at 90% of the budget
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        target = self.max_bytes * 0.9
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+                total -= size
+            except OSError:
+                pass
+        self._total_bytes = total
+
+    def warm(self, image_paths, size, render, processes=None):
+        """Render every missing entry on a process pool, returns the number rendered."""
+        jobs = []
+        for path in image_paths:
+            entry_path = self.entry_path(path, size)
+            if entry_path is not None and not os.path.exists(entry_path):
+                jobs.append((self.cache_dir, self.variant, path, size, render))
+        if not jobs:
+            return 0
+
+        with ProcessPoolExecutor(processes) as executor:
+            rendered = sum(executor.map(_warm_one, jobs, chunksize=16))
+
+        # The workers do not evict, count the folder once now that they are done
+        with self._lock:
+            self._total_bytes = self._disk_usage()
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+        return rendered
+
+
+def _warm_one(job):
+    # Runs in a worker process, `render` has to be a module level function
+    cache_dir, variant, image_path, size, render = job
+    cache = ThumbnailCache(cache_dir, variant=variant)
+    try:
+        cache.store(image_path, size, render(image_path, size), evict=False)
+        return 1
+    except (OSError, ValueError) as error:
+        # One image that cannot be decoded must not end the whole pass
+        print(f"Unable to render {image_path} for the cache: {error}")
+        return 0
@@ -0,0 +1,218 @@
+import math
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from image_cache import ImageCache, FAST, HIGH
+from spectrogram import SpectrogramSettings, read_wav, spectrogram_columns
+
+
+class ImageSource:
+    """A spectrogram image as a pyramid of levels, each half the size of the one before.
+
+    The file is decoded once, the first time a tile needs it; uncompressed TIFFs and
+    other raw formats are memory-mapped by Pillow instead of read. Tiles are resampled
+    from the coarsest level that still has enough pixels, so zoomed out views of very
+    long images do not resample the full resolution.
+    """
+
+    stretch = False  # Zoomed out, the whole image fits with its aspect ratio
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+        with Image.open(image_path) as image:
+            self.size = image.size
+        self._levels = {}
+
+    def _level(self, level):
+        image = self._levels.get(level)
+        if image is None:
+            if level == 0:
+                image = Image.open(self.image_path)
+                image.load()
+                if image.mode not in ("L", "RGB"):
+                    image = image.convert("RGB")
+            else:
+                image = self._level(level - 1).reduce(2)
+            self._levels[level] = image
+        return image
+
+    def render(self, box, size):
+        # Coarsest level with at least one source pixel per output pixel
+        factor = min((box[2] - box[0]) / size[0], (box[3] - box[1]) / size[1])
+        level = int(math.floor(math.log2(factor))) if factor >= 2 else 0
+        image = self._level(level)
+        scale = 2 ** level
+        level_box = (box[0] / scale, box[1] / scale,
+                     min(box[2] / scale, image.width), min(box[3] / scale, image.height))
+        return image.resize(size, Image.Resampling.BICUBIC, box=level_box)
+
+    def close(self):
+        for image in self._levels.values():
+            image.close()
+        self._levels = {}
+
+
+class WavSource:
+    """Spectrogram of a .wav recording, computed only for the time window of a tile.
+
+    Source pixels are STFT frames by frequency bins (highest first), samples are read
+    from the memory-mapped file. Brightness is relative to the loudest bin of a decimated
+    pass over the whole recording, so neighbouring tiles match. Tiles above each other
+    share one STFT.
+    """
+
+    stretch = True  # Zoomed out, the spectrogram fills the view like render_spectrogram
+    reference_frames = 2048  # STFT frames for the brightness reference
+
+    def __init__(self, wav_path, settings=None):
+        self.settings = settings if settings is not None else SpectrogramSettings()
+        self.sample_rate, self.samples = read_wav(wav_path)
+
+        fft_size = self.settings.fft_size
+        self.hop = self.settings.hop()
+        frame_count = 1 + (len(self.samples) - fft_size) // self.hop if len(self.samples) >= fft_size else 1
+        bins = spectrogram_columns(self.samples[:0], self.sample_rate, 1, self.settings).shape[0]  # Band height only
+        self.size = (frame_count, bins)
+        # One frame every few thousand samples is enough for the loudest level and opens long recordings at once
+        self.reference_db = float(spectrogram_columns(self.samples, self.sample_rate, self.reference_frames,
+                                                      self.settings, FAST).max())
+        self._strips = OrderedDict()  # (first frame, last frame, width) -> dB, highest frequency first
+
+    def _strip(self, first, last, width):
+        key = first, last, width
+        db = self._strips.get(key)
+        if db is None:
+            segment = self.samples[first * self.hop:(last - 1) * self.hop + self.settings.fft_size]
+            db = spectrogram_columns(segment, self.sample_rate, width, self.settings, HIGH)[::-1]
+            self._strips[key] = db
+            while len(self._strips) > 32:
+                self._strips.popitem(last=False)
+        return db
+
+    def render(self, box, size):
+        first = int(math.floor(box[0]))
+        last = max(first + 1, int(math.ceil(box[2])))
+        db = self._strip(first, last, size[0])
+
+        top, bottom = int(math.floor(box[1])), max(int(math.floor(box[1])) + 1, int(math.ceil(box[3])))
+        dynamic_range = self.settings.dynamic_range
+        scaled = (db[top:bottom] - (self.reference_db - dynamic_range)) * (255.0 / dynamic_range)
+        image = Image.fromarray(np.ascontiguousarray(np.clip(scaled, 0, 255).astype(np.uint8)))
+        return image.resize(size, Image.Resampling.BICUBIC)
+
+    def close(self):
+        self.samples = None  # Releases the memory map
+        self._strips.clear()
+
+
+class TileView:
+    """Zoomable, pannable view of a source, rendered from cached tiles.
+
+    The zoom is in steps of a factor sqrt(2) from the scale where the whole source fits
+    the viewport. At every step the source is cut into tiles of `tile_size` display
+    pixels; only tiles that are visible get rendered, and panning reuses the ones that
+    were rendered already.
+    """
+
+    tile_size = 256
+    max_step = 16  # 256 times the fitted scale
+
+    def __init__(self, source, viewport, cache_bytes=64 * 1024 * 1024):
+        self.source = source
+        self.viewport = tuple(viewport)
+        self.step = 0
+        self.center = (source.size[0] / 2, source.size[1] / 2)  # In source pixels
+        self.tiles = ImageCache(cache_bytes)
+
+        width, height = self.viewport
+        fit = (width / source.size[0], height / source.size[1])
+        self.fit = fit if source.stretch else (min(fit),) * 2
+
+    def scale(self):
+        zoom = 2 ** (self.step / 2)
+        return self.fit[0] * zoom, self.fit[1] * zoom
+
+    def origin(self):
+        """Top left of the viewport in display pixels of the current step."""
+        scale = self.scale()
+        origin = []
+        for center, source_size, scale_axis, view in zip(self.center, self.source.size, scale, self.viewport):
+            extent = source_size * scale_axis
+            if extent <= view:
+                origin.append((extent - view) / 2)  # Smaller than the view, centred
+            else:
+                origin.append(min(max(center * scale_axis - view / 2, 0), extent - view))
+        return origin
+
+    def zoom(self, steps, anchor=None):
+        """Zoom in (positive) or out keeping the source point under `anchor`, a viewport pixel, in place."""
+        anchor = anchor if anchor is not None else (self.viewport[0] / 2, self.viewport[1] / 2)
+        scale = self.scale()
+        origin = self.origin()
+        point = [(origin[i] + anchor[i]) / scale[i] for i in range(2)]
+
+        self.step = min(max(self.step + steps, 0), self.max_step)
+        scale = self.scale()
+        self.center = tuple(point[i] + (self.viewport[i] / 2 - anchor[i]) / scale[i] for i in range(2))
+        self._clamp()
+
+    def pan(self, dx, dy):
+        """Move the image by (dx, dy) viewport pixels."""
+        scale = self.scale()
+        self.center = (self.center[0] - dx / scale[0], self.center[1] - dy / scale[1])
+        self._clamp()
+
+    def _clamp(self):
+        # Keep the centre where the viewport still shows the source
+        scale = self.scale()
+        center = []
+        for value, source_size, scale_axis, view in zip(self.center, self.source.size, scale, self.viewport):
+            half = view / 2 / scale_axis
+            center.append(source_size / 2 if half * 2 >= source_size else min(max(value, half), source_size - half))
+        self.center = tuple(center)
+
+    def visible_box(self):
+        """The shown part of the source, in source pixels."""
+        scale = self.scale()
+        origin = self.origin()
+        return (max(origin[0] / scale[0], 0), max(origin[1] / scale[1], 0),
+                min((origin[0] + self.viewport[0]) / scale[0], self.source.size[0]),
+                min((origin[1] + self.viewport[1]) / scale[1], self.source.size[1]))
+
+    def _tile(self, column, row, scale):
+        key = (self.step, column, row)
+        tile = self.tiles.get(key)
+        if tile is None:
+            size = self.tile_size
+            extent = (self.source.size[0] * scale[0], self.source.size[1] * scale[1])
+            width = int(min(size, math.ceil(extent[0]) - column * size))
+            height = int(min(size, math.ceil(extent[1]) - row * size))
+            box = (column * size / scale[0], row * size / scale[1],
+                   min((column * size + width) / scale[0], self.source.size[0]),
+                   min((row * size + height) / scale[1], self.source.size[1]))
+            tile = self.source.render(box, (width, height))
+            self.tiles.put(key, tile)
+        return tile
+
+    def render(self):
+        """The viewport as an image, from the visible tiles."""
+        scale = self.scale()
+        origin = self.origin()
+        size = self.tile_size
+        canvas = None
+        first_column, first_row = max(int(origin[0] // size), 0), max(int(origin[1] // size), 0)
+        last_column = int(min(origin[0] + self.viewport[0], self.source.size[0] * scale[0] - 1) // size)
+        last_row = int(min(origin[1] + self.viewport[1], self.source.size[1] * scale[1] - 1) // size)
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                tile = self._tile(column, row, scale)
+                if canvas is None:
+                    canvas = Image.new(tile.mode, self.viewport)
+                canvas.paste(tile, (int(round(column * size - origin[0])), int(round(row * size - origin[1]))))
+        return canvas if canvas is not None else Image.new("L", self.viewport)
+
+    def close(self):
+        self.tiles.clear()
+        self.source.close()